@@ -0,0 +1,351 @@
+import argparse
+import itertools
+import json
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import dgl
+import torch
+
+from flowmol.model_utils.load import model_from_config
+from flowmol.data_processing.dataset import MoleculeDataset
+from flowmol.data_processing.device_batcher import DeviceBatchBuilder
+from flowmol.data_processing.priors import coupled_node_prior
+from flowmol.data_processing.utils import get_upper_edge_mask
+from flowmol.analysis.molecule_builder import SampledMolecule
+from flowmol.analysis.metrics import SampleAnalyzer
+from flowmol.utils.precision import autocast_context, autocast_dtypes
+from benchmarks.synthetic import write_synthetic_dataset, synthetic_config, parameterization_configs
+
+# disable rdkit logging
+from rdkit import RDLogger
+RDLogger.DisableLog('rdApp.*')
+
+benchmark_names = ['getitem', 'collate', 'prior', 'forward_backward', 'checkpointing', 'train_step', 'sample', 'sampled_molecule', 'analyze']
+
+def parse_args():
+    p = argparse.ArgumentParser(description='FlowMol performance benchmarks on synthetic data')
+    p.add_argument('--benchmarks', type=str, nargs='+', default=benchmark_names, choices=benchmark_names)
+    p.add_argument('--atom_counts', type=int, nargs='+', default=[10, 25, 50], help='number of atoms in every synthetic molecule')
+    p.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64])
+    p.add_argument('--parameterizations', type=str, nargs='+', default=list(parameterization_configs.keys()), choices=list(parameterization_configs.keys()))
+    p.add_argument('--precisions', type=str, nargs='+', default=['32'], choices=list(autocast_dtypes.keys()), help='precisions to run the model benchmarks in')
+    p.add_argument('--n_timesteps', type=int, default=20, help='number of integration steps in the sampling benchmark')
+    p.add_argument('--n_items', type=int, default=64, help='number of molecules timed in the per-molecule benchmarks')
+    p.add_argument('--n_repeats', type=int, default=5)
+    p.add_argument('--n_warmup', type=int, default=1)
+    p.add_argument('--device', type=str, default='cpu')
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--output', type=Path, default=Path('benchmarks/results.json'))
+    p.add_argument('--baseline', type=Path, default=None, help='baseline results to compare against')
+    p.add_argument('--save_baseline', action='store_true', help='also write the results to the --baseline file')
+    p.add_argument('--tolerance', type=float, default=0.2, help='slowdown relative to the baseline that is reported as a regression')
+
+    return p.parse_args()
+
+def sync(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def time_fn(fn, device: torch.device, n_repeats: int, n_warmup: int) -> dict:
+    """Times fn, returning the median and minimum wall time in seconds over n_repeats calls."""
+    for _ in range(n_warmup):
+        fn()
+
+    times = []
+    for _ in range(n_repeats):
+        sync(device)
+        start = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - start)
+
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'n_repeats': n_repeats}
+
+def peak_memory_mb(device: torch.device) -> float:
+    """Peak memory since the last reset_peak_memory. On cpu this is the peak resident set size of the whole process."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is reported in kilobytes on linux and bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+def reset_peak_memory(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+def precision_suffix(precision: str) -> str:
+    # fp32 results keep their original names so that existing baselines stay comparable
+    return '' if precision in ['32', '32-true'] else f'/precision={precision}'
+
+def clear_priors(g: dgl.DGLGraph, node_feats: list):
+    # FlowMol.forward only samples priors that are missing from the graph, so the ones left by a previous call are removed
+    for feat in node_feats:
+        g.ndata.pop(f'{feat}_0', None)
+    g.edata.pop('e_0', None)
+
+def graph_to_sampled_molecule(g: dgl.DGLGraph, atom_map: list) -> SampledMolecule:
+    """Builds a SampledMolecule from a dataset graph by treating the true features as the sampled ones."""
+    for feat in 'xace':
+        data_src = g.edata if feat == 'e' else g.ndata
+        data_src[f'{feat}_1'] = data_src[f'{feat}_1_true']
+    g.edata['ue_mask'] = get_upper_edge_mask(g)
+    return SampledMolecule(g, atom_map)
+
+
+def run_benchmarks(args, data_dir: Path) -> dict:
+    device = torch.device(args.device)
+    results = {}
+    max_batch_size = max(args.batch_sizes)
+
+    def record(name: str, result: dict):
+        results[name] = result
+        print(f"{name:<60} {result['median_s']*1000:10.2f} ms", flush=True)
+
+    for n_atoms in args.atom_counts:
+        torch.manual_seed(args.seed)
+        processed_data_dir = data_dir / f'n_atoms_{n_atoms}'
+
+        # use the ctmc config to define the dataset, all of the shipped qm9 configs share the same atom map
+        base_config = synthetic_config('ctmc', processed_data_dir)
+        atom_map = base_config['dataset']['atom_map']
+        write_synthetic_dataset(processed_data_dir, atom_map, n_mols=max(max_batch_size, args.n_items), n_atoms=n_atoms, seed=args.seed)
+
+        datasets = {}
+        for align in [False, True]:
+            config = synthetic_config('ctmc', processed_data_dir, align=align)
+            datasets[align] = MoleculeDataset('train', config['dataset'], prior_config=config['mol_fm']['prior_config'])
+        n_items = min(args.n_items, len(datasets[True]))
+
+        # MoleculeDataset.__getitem__, with and without OT alignment of the position prior
+        if 'getitem' in args.benchmarks:
+            for align, dataset in datasets.items():
+                result = time_fn(lambda: [dataset[idx] for idx in range(n_items)], device, args.n_repeats, args.n_warmup)
+                result['per_item_ms'] = result['median_s'] / n_items * 1000
+                record(f'getitem/n_atoms={n_atoms}/align={align}', result)
+
+        # collating a batch of graphs
+        if 'collate' in args.benchmarks:
+            for batch_size in args.batch_sizes:
+                graphs = [datasets[False][idx] for idx in range(batch_size)]
+                record(f'collate/n_atoms={n_atoms}/batch_size={batch_size}', time_fn(lambda: dgl.batch(graphs), device, args.n_repeats, args.n_warmup))
+
+        # coupled_node_prior on single molecules
+        if 'prior' in args.benchmarks:
+            dataset = datasets[True]
+            dst_dicts = []
+            for idx in range(n_items):
+                g = dataset[idx]
+                dst_dicts.append({feat: g.ndata[f'{feat}_1_true'] for feat in 'xac'})
+            for align in [False, True]:
+                prior_config = synthetic_config('ctmc', processed_data_dir, align=align)['mol_fm']['prior_config']
+                result = time_fn(lambda: [coupled_node_prior(dst_dict=dst_dict, prior_config=prior_config) for dst_dict in dst_dicts], device, args.n_repeats, args.n_warmup)
+                result['per_item_ms'] = result['median_s'] / n_items * 1000
+                record(f'prior/n_atoms={n_atoms}/align={align}', result)
+
+        # training forward and backward pass of the endpoint model
+        if 'forward_backward' in args.benchmarks:
+            config = synthetic_config('endpoint', processed_data_dir, align=False)
+            model = model_from_config(config).to(device)
+            model.train()
+            dataset = MoleculeDataset('train', config['dataset'], prior_config=config['mol_fm']['prior_config'])
+            for batch_size, precision in itertools.product(args.batch_sizes, args.precisions):
+                g = dgl.batch([dataset[idx] for idx in range(batch_size)]).to(device)
+                suffix = precision_suffix(precision)
+
+                def forward():
+                    clear_priors(g, model.node_feats)
+                    with autocast_context(device, precision):
+                        losses = model(g)
+                    return sum(losses.values())
+
+                def forward_backward():
+                    model.zero_grad(set_to_none=True)
+                    forward().backward()
+
+                reset_peak_memory(device)
+                with torch.no_grad():
+                    fwd_result = time_fn(forward, device, args.n_repeats, args.n_warmup)
+                    # the loss on the same batch, priors and timepoints is recorded to compare precisions
+                    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+                        torch.manual_seed(args.seed)
+                        fwd_result['loss'] = float(forward())
+                record(f'forward/n_atoms={n_atoms}/batch_size={batch_size}{suffix}', fwd_result)
+
+                reset_peak_memory(device)
+                result = time_fn(forward_backward, device, args.n_repeats, args.n_warmup)
+                result['peak_memory_mb'] = peak_memory_mb(device)
+                record(f'forward_backward/n_atoms={n_atoms}/batch_size={batch_size}{suffix}', result)
+
+        # forward and backward pass of the largest batch under each activation checkpointing mode,
+        # with the number of edges that would fit in device memory extrapolated from the memory used per edge
+        if 'checkpointing' in args.benchmarks:
+            config = synthetic_config('endpoint', processed_data_dir, align=False)
+            model = model_from_config(config).to(device)
+            model.train()
+            dataset = MoleculeDataset('train', config['dataset'], prior_config=config['mol_fm']['prior_config'])
+            g = dgl.batch([dataset[idx] for idx in range(max_batch_size)]).to(device)
+            n_edges = g.num_edges()
+
+            def forward_backward():
+                model.zero_grad(set_to_none=True)
+                clear_priors(g, model.node_feats)
+                sum(model(g).values()).backward()
+
+            reference_s = None
+            for mode in [None, 'convs', 'updaters', 'all']:
+                model.vector_field.activation_checkpointing = mode
+                model.zero_grad(set_to_none=True)
+                reset_peak_memory(device)
+                static_mb = torch.cuda.memory_allocated(device) / 2**20 if device.type == 'cuda' else 0.0
+                result = time_fn(forward_backward, device, args.n_repeats, args.n_warmup)
+                result['peak_memory_mb'] = peak_memory_mb(device)
+                result['n_edges'] = n_edges
+                if mode is None:
+                    reference_s = result['median_s']
+                    result['estimated_activation_mb'] = model.vector_field.estimate_activation_mb(g.num_nodes(), n_edges)
+                result['overhead'] = result['median_s'] / reference_s - 1
+                if device.type == 'cuda':
+                    total_mb = torch.cuda.get_device_properties(device).total_memory / 2**20
+                    mb_per_edge = (result['peak_memory_mb'] - static_mb) / n_edges
+                    result['max_edges'] = int((total_mb - static_mb) / mb_per_edge)
+                record(f'checkpointing/mode={mode}/n_atoms={n_atoms}/batch_size={max_batch_size}', result)
+
+        # a full training step with batches built by dataset workers (here, inline) versus the device-resident batch builder
+        if 'train_step' in args.benchmarks:
+            config = synthetic_config('endpoint', processed_data_dir, align=False)
+            model = model_from_config(config).to(device)
+            model.train()
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+            dataset = MoleculeDataset('train', config['dataset'], prior_config=config['mol_fm']['prior_config'])
+            batch_builder = DeviceBatchBuilder(dataset, device=device)
+            generator = torch.Generator().manual_seed(args.seed)
+
+            batch_fns = {
+                'workers': lambda mol_idxs: dgl.batch([dataset[idx] for idx in mol_idxs.tolist()]).to(device),
+                'device': lambda mol_idxs: batch_builder.build_batch(mol_idxs),
+            }
+            for batch_size, precision in itertools.product(args.batch_sizes, args.precisions):
+                # fp16 gradients need loss scaling, the scaler is a no-op for the other precisions and on cpu
+                # torch.cuda.amp rather than torch.amp, whose GradScaler needs torch 2.3 and build_env.sh pins 2.2
+                scaler = torch.cuda.amp.GradScaler(enabled=precision == '16-mixed' and device.type == 'cuda')
+                for mode, batch_fn in batch_fns.items():
+
+                    def train_step():
+                        mol_idxs = torch.randperm(len(dataset), generator=generator)[:batch_size]
+                        g = batch_fn(mol_idxs)
+                        optimizer.zero_grad(set_to_none=True)
+                        with autocast_context(device, precision):
+                            loss = sum(model(g).values())
+                        scaler.scale(loss).backward()
+                        scaler.step(optimizer)
+                        scaler.update()
+
+                    result = time_fn(train_step, device, args.n_repeats, args.n_warmup)
+                    result['steps_per_s'] = 1 / result['median_s']
+                    record(f'train_step/{mode}/n_atoms={n_atoms}/batch_size={batch_size}{precision_suffix(precision)}', result)
+
+        # the full sampling loop for each parameterization, including conversion to SampledMolecule objects
+        if 'sample' in args.benchmarks:
+            for parameterization in args.parameterizations:
+                config = synthetic_config(parameterization, processed_data_dir)
+                model = model_from_config(config).to(device).eval()
+                for batch_size, precision in itertools.product(args.batch_sizes, args.precisions):
+                    n_atoms_per_mol = torch.full((batch_size,), n_atoms, dtype=torch.long, device=device)
+                    sample_fn = lambda: model.sample(n_atoms_per_mol, n_timesteps=args.n_timesteps, device=device, precision=precision)
+                    reset_peak_memory(device)
+                    result = time_fn(sample_fn, device, args.n_repeats, args.n_warmup)
+                    result['peak_memory_mb'] = peak_memory_mb(device)
+                    result['n_timesteps'] = args.n_timesteps
+                    if len(args.precisions) > 1:
+                        # metrics of molecules sampled from the same seed, to compare precisions
+                        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+                            torch.manual_seed(args.seed)
+                            metrics = SampleAnalyzer().analyze(sample_fn())
+                        result['metrics'] = {name: float(value) for name, value in metrics.items()}
+                    record(f'sample/{parameterization}/n_atoms={n_atoms}/batch_size={batch_size}{precision_suffix(precision)}', result)
+
+        # SampledMolecule construction and SampleAnalyzer.analyze
+        if 'sampled_molecule' in args.benchmarks or 'analyze' in args.benchmarks:
+            sample_analyzer = SampleAnalyzer()
+            for batch_size in args.batch_sizes:
+                graphs = [datasets[False][idx] for idx in range(batch_size)]
+                if 'sampled_molecule' in args.benchmarks:
+                    result = time_fn(lambda: [graph_to_sampled_molecule(g, atom_map) for g in graphs], device, args.n_repeats, args.n_warmup)
+                    record(f'sampled_molecule/n_atoms={n_atoms}/batch_size={batch_size}', result)
+                if 'analyze' in args.benchmarks:
+                    molecules = [graph_to_sampled_molecule(g, atom_map) for g in graphs]
+                    result = time_fn(lambda: sample_analyzer.analyze(molecules, functional_validity=True), device, args.n_repeats, args.n_warmup)
+                    record(f'analyze/n_atoms={n_atoms}/batch_size={batch_size}', result)
+
+    return results
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """Prints the speed of each benchmark relative to the baseline and returns the names of benchmarks that regressed."""
+    regressions = []
+    print(f"\n{'benchmark':<60} {'baseline (ms)':>14} {'current (ms)':>14} {'ratio':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_s = baseline[name]['median_s']
+        ratio = result['median_s'] / baseline_s
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<60} {baseline_s*1000:14.2f} {result['median_s']*1000:14.2f} {ratio:8.2f}{flag}")
+
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print(f'{len(missing)} benchmarks are not in the baseline')
+
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        results = run_benchmarks(args, Path(data_dir))
+
+    output = {
+        'metadata': {
+            'timestamp': datetime.now().isoformat(),
+            'device': args.device,
+            'torch_version': torch.__version__,
+            'dgl_version': dgl.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'n_threads': torch.get_num_threads(),
+            'n_timesteps': args.n_timesteps,
+            'n_repeats': args.n_repeats,
+        },
+        'results': results,
+    }
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'wrote results to {args.output}')
+
+    if args.baseline is not None:
+        if args.save_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump(output, f, indent=2)
+            print(f'wrote baseline to {args.baseline}')
+        elif args.baseline.exists():
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+            regressions = compare_to_baseline(results, baseline['results'], args.tolerance)
+            if regressions:
+                print(f'{len(regressions)} benchmarks are more than {args.tolerance:.0%} slower than the baseline')
+                sys.exit(1)
+        else:
+            raise FileNotFoundError(f'baseline file {args.baseline} not found, pass --save_baseline to create it')
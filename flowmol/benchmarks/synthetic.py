@@ -0,0 +1,85 @@
+from pathlib import Path
+import torch
+from torch.nn.functional import one_hot
+
+from flowmol.model_utils.load import read_config_file
+from flowmol.utils.dataset_stats import MarginalDistAccumulator
+
+# synthetic molecules and configs for the benchmarks, so that they can run without downloading or processing a real dataset.
+# molecules are zig-zag chains with single bonds between consecutive atoms. they are not chemically sensible,
+# but they have the same array layout as the processed datasets, so every code path sees realistic shapes.
+
+configs_dir = Path(__file__).parent.parent / 'configs'
+
+# the config used for each parameterization, vector-field reuses the gaussian config with a different parameterization
+parameterization_configs = {
+    'endpoint': 'qm9_gaussian.yaml',
+    'vector-field': 'qm9_gaussian.yaml',
+    'dirichlet': 'qm9_dirichlet.yaml',
+    'ctmc': 'qm9_ctmc.yaml',
+}
+
+def synthetic_molecules(n_mols: int, n_atoms: int, n_atom_types: int, seed: int = 0):
+    """Returns the processed data dict for n_mols synthetic molecules with n_atoms atoms each,
+    along with the bond order counts summed over all of them."""
+    generator = torch.Generator().manual_seed(seed)
+
+    # a zig-zag chain with 1.5 angstrom bonds, plus some noise so that no two molecules are identical
+    chain_idx = torch.arange(n_atoms).float()
+    chain = torch.stack([chain_idx*1.25, (chain_idx % 2)*0.85, torch.zeros(n_atoms)], dim=1)
+    positions = chain.unsqueeze(0) + torch.randn(n_mols, n_atoms, 3, generator=generator)*0.1
+
+    atom_type_idxs = torch.randint(n_atom_types, (n_mols, n_atoms), generator=generator)
+    atom_types = one_hot(atom_type_idxs.flatten(), num_classes=n_atom_types).bool()
+    atom_charges = torch.zeros(n_mols*n_atoms, dtype=torch.int32)
+
+    # bonds between consecutive atoms, stored once per bond as in the processed datasets
+    n_bonds = n_atoms - 1
+    bond_idxs = torch.stack([torch.arange(n_bonds), torch.arange(1, n_atoms)], dim=1).repeat(n_mols, 1).int()
+    bond_types = torch.ones(n_mols*n_bonds, dtype=torch.int32)
+
+    node_starts = torch.arange(n_mols)*n_atoms
+    edge_starts = torch.arange(n_mols)*n_bonds
+    data_dict = {
+        'positions': positions.reshape(-1, 3),
+        'atom_types': atom_types,
+        'atom_charges': atom_charges,
+        'bond_types': bond_types,
+        'bond_idxs': bond_idxs,
+        'node_idx_array': torch.stack([node_starts, node_starts + n_atoms], dim=1),
+        'edge_idx_array': torch.stack([edge_starts, edge_starts + n_bonds], dim=1),
+    }
+
+    bond_order_counts = torch.zeros(5, dtype=torch.int64)
+    bond_order_counts[0] = n_mols*(n_atoms*(n_atoms - 1)//2 - n_bonds)
+    bond_order_counts[1] = n_mols*n_bonds
+
+    return data_dict, bond_order_counts
+
+def write_synthetic_dataset(processed_data_dir: Path, atom_map: list, n_mols: int, n_atoms: int, seed: int = 0):
+    """Writes a processed dataset of synthetic molecules in the layout read by MoleculeDataset and FlowMol."""
+    processed_data_dir = Path(processed_data_dir)
+    processed_data_dir.mkdir(parents=True, exist_ok=True)
+
+    for split_idx, split in enumerate(['train', 'val']):
+        data_dict, bond_order_counts = synthetic_molecules(n_mols, n_atoms, len(atom_map), seed=seed + split_idx)
+        torch.save(data_dict, processed_data_dir / f'{split}_data_processed.pt')
+
+        if split == 'train':
+            dataset_stats = MarginalDistAccumulator(len(atom_map))
+            n_atoms_per_mol = data_dict['node_idx_array'][:, 1] - data_dict['node_idx_array'][:, 0]
+            dataset_stats.update(data_dict['atom_types'], data_dict['atom_charges'], n_atoms_per_mol, bond_order_counts)
+            torch.save(dataset_stats.marginal_dists(), processed_data_dir / 'train_data_marginal_dists.pt')
+            torch.save(dataset_stats.n_atoms_histogram(), processed_data_dir / 'train_data_n_atoms_histogram.pt')
+
+def synthetic_config(parameterization: str, processed_data_dir: Path, align: bool = True) -> dict:
+    """Returns the config shipped for the given parameterization, pointed at a synthetic dataset."""
+    if parameterization not in parameterization_configs:
+        raise ValueError(f'parameterization must be one of {list(parameterization_configs.keys())}, got {parameterization}')
+
+    config = read_config_file(configs_dir / parameterization_configs[parameterization])
+    config['dataset']['processed_data_dir'] = str(processed_data_dir)
+    config['dataset'].pop('dataset_size', None)
+    config['mol_fm']['parameterization'] = parameterization
+    config['mol_fm']['prior_config']['x']['align'] = align
+    return config
@@ -1,48 +1,136 @@
 import argparse
+import json
 from pathlib import Path
-import yaml
-from flowmol.model_utils.load import data_module_from_config, read_config_file
-from flowmol.analysis.molecule_builder import SampledMolecule
-from flowmol.analysis.metrics import SampleAnalyzer
-from flowmol.utils.divergences import save_reference_dist
-from typing import List
+from multiprocessing import Pool
 import numpy as np
 import pickle
+import shutil
+import torch
 from tqdm import tqdm
-from flowmol.data_processing.utils import get_upper_edge_mask
-import math
-from collections import defaultdict
+from flowmol.model_utils.load import read_config_file
+from flowmol.analysis.molecule_builder import build_molecule, compute_valencies
+from flowmol.analysis.metrics import SampleAnalyzer, check_atom_stability, combine_counts, counts_to_metrics
+from flowmol.analysis.ff_energy import compute_mmff_energy
+from flowmol.utils.divergences import save_reference_dist
 
 # disable rdkit logging
 from rdkit.Chem import AllChem as Chem
 from rdkit import RDLogger
 RDLogger.DisableLog('rdApp.*')
 
+# this range of bins captures ~99% of the density for the MMFF energies of both QM9 and GEOM-DRUGS datasets -- is that reasonable?
+energy_bins = np.linspace(-200, 500, 200)
+
 def parse_args():
     p = argparse.ArgumentParser(description='Dataset Metrics')
     p.add_argument('--config', type=Path, required=True, help='Path to config file')
-    p.add_argument('--n_mols', type=int, default=None)
-    p.add_argument('--batch_size', type=int, default=None)
+    p.add_argument('--split', type=str, default='train', help='which split of the processed dataset to compute metrics on')
+    p.add_argument('--n_mols', type=int, default=None, help='compute metrics on a random subset of this many molecules')
+    p.add_argument('--seed', type=int, default=0, help='random seed used to select the subset of molecules when n_mols is set')
+    p.add_argument('--shard_size', type=int, default=5000, help='number of molecules in each shard')
+    p.add_argument('--n_cpus', type=int, default=1, help='number of worker processes')
+    p.add_argument('--overwrite', action='store_true', help='recompute shards left over from a previous run instead of reusing them')
 
     return p.parse_args()
 
-def dataset_to_mols(train_dataset, atom_type_map) -> List[SampledMolecule]:
-    print('converting dataset from graphs to molecules')
-    mols = []
-    for g in tqdm(train_dataset, mininterval=15):
-
-        for feat in 'xace':
-            if feat == 'e':
-                data_src = g.edata
-            else:
-                data_src = g.ndata
-            data_src[f'{feat}_1'] = data_src[f'{feat}_1_true']
 
-        g.edata['ue_mask'] = get_upper_edge_mask(g)
-        sampled_mol = SampledMolecule(g, atom_type_map)
-        mols.append(sampled_mol)
-
-    return mols
+# state shared by all shards processed in one worker process, set by init_worker
+worker_state = {}
+
+def init_worker(data_file: Path, atom_map: list):
+    # memory-map the processed arrays so that worker processes share the same pages instead of each holding a copy
+    worker_state['data'] = torch.load(data_file, mmap=True)
+    worker_state['atom_map'] = atom_map
+    worker_state['sample_analyzer'] = SampleAnalyzer()
+    RDLogger.DisableLog('rdApp.*')
+
+def processed_mol_to_rdkit(data: dict, atom_map: list, idx: int):
+    """Builds an rdkit molecule straight from the processed arrays of molecule idx.
+    Returns the molecule along with the atom types, charges and valencies needed for the stability check."""
+    node_start, node_end = data['node_idx_array'][idx].tolist()
+    edge_start, edge_end = data['edge_idx_array'][idx].tolist()
+
+    positions = data['positions'][node_start:node_end]
+    atom_types = [atom_map[i] for i in data['atom_types'][node_start:node_end].float().argmax(dim=1).tolist()]
+    atom_charges = data['atom_charges'][node_start:node_end].long()
+    bond_idxs = data['bond_idxs'][edge_start:edge_end].long()
+    bond_types = data['bond_types'][edge_start:edge_end].long()
+
+    rdmol = build_molecule(positions, atom_types, atom_charges, bond_idxs[:, 0], bond_idxs[:, 1], bond_types)
+    valencies = compute_valencies(len(atom_types), bond_idxs[:, 0], bond_idxs[:, 1], bond_types)
+    return rdmol, atom_types, atom_charges, valencies
+
+def shard_counts(shard: tuple):
+    """Computes the metric counts for one shard of molecules and writes them to disk."""
+    shard_file, mol_idxs = shard
+    data = worker_state['data']
+    atom_map = worker_state['atom_map']
+    sample_analyzer: SampleAnalyzer = worker_state['sample_analyzer']
+
+    n_atoms = 0
+    n_stable_atoms = 0
+    n_stable_molecules = 0
+    n_valid = 0
+    frag_fracs = []
+    num_components = []
+    energies = []
+    rd_mols = []
+    for idx in mol_idxs:
+        rdmol, atom_types, atom_charges, valencies = processed_mol_to_rdkit(data, atom_map, int(idx))
+
+        # atom and molecule stability
+        n_atoms += len(atom_types)
+        n_stable_atoms_this_mol, mol_stable = check_atom_stability(atom_types, valencies, atom_charges)
+        n_stable_atoms += n_stable_atoms_this_mol
+        n_stable_molecules += int(mol_stable)
+
+        if rdmol is None:
+            continue
+
+        # validity of the largest fragment, same as SampleAnalyzer.compute_validity
+        try:
+            mol_frags = Chem.rdmolops.GetMolFrags(rdmol, asMols=True, sanitizeFrags=False)
+            num_components.append(len(mol_frags))
+            largest_mol = max(mol_frags, default=rdmol, key=lambda m: m.GetNumAtoms())
+            frag_fracs.append(largest_mol.GetNumAtoms() / len(atom_types))
+            Chem.SanitizeMol(largest_mol)
+            n_valid += 1
+        except (Chem.rdchem.AtomValenceException, Chem.rdchem.KekulizeException, Chem.rdchem.AtomKekulizeException, ValueError):
+            pass
+
+        # force-field energy, same as SampleAnalyzer.compute_sample_energy
+        try:
+            Chem.SanitizeMol(rdmol)
+        except:
+            continue
+        energy = compute_mmff_energy(rdmol)
+        if energy is not None:
+            energies.append(energy)
+        rd_mols.append(rdmol)
+
+    counts = {
+        'n_stable_atoms': n_stable_atoms,
+        'n_atoms': n_atoms,
+        'n_stable_molecules': n_stable_molecules,
+        'n_molecules': len(mol_idxs),
+        'n_valid': n_valid,
+        'sum_frag_fracs': sum(frag_fracs),
+        'n_frag_fracs': len(frag_fracs),
+        'sum_num_components': sum(num_components),
+        'n_num_components': len(num_components),
+        'energy_counts': np.histogram(energies, bins=energy_bins, density=False)[0],
+        'n_energies': len(energies),
+    }
+
+    # REOS flags and ring systems of the sanitized molecules
+    counts.update(sample_analyzer.functional_validity_counts(rd_mols))
+
+    tmp_file = shard_file.with_suffix('.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(counts, f)
+    tmp_file.rename(shard_file)
+
+    return shard_file
 
 
 if __name__ == "__main__":
@@ -51,80 +139,73 @@ if __name__ == "__main__":
 
     # read config file
     config: dict = read_config_file(args.config)
+    atom_map = config['dataset']['atom_map']
+    processed_data_dir = Path(config['dataset']['processed_data_dir'])
+    data_file = processed_data_dir / f'{args.split}_data_processed.pt'
 
-    # get the training dataset
-    data_module = data_module_from_config(config)
-
-    # run setup so that the data module creates dataset classes
-    data_module.setup(stage='fit')
-
-    # get training dataset
-    train_dataset = data_module.train_dataset
-
-    # create sample analyzer
-    sample_analyzer = SampleAnalyzer()
+    # get the number of molecules in the dataset without loading every array
+    n_dataset_mols = torch.load(data_file, mmap=True)['node_idx_array'].shape[0]
 
     if args.n_mols is not None:
         # randomly select n_mols numbers from the range (0, len(dataset))
-        indices = np.random.choice(len(train_dataset), args.n_mols, replace=False)
-        train_dataset = [train_dataset[i] for i in indices]
-    
-    # compute metrics
-    if args.batch_size:
-        n_batches = math.ceil(len(train_dataset) / args.batch_size)
-        energies = []
-        batch_metrics = []
-        for i in range(n_batches):
-            start = i * args.batch_size
-            end = min(start + args.batch_size, len(train_dataset))
-            mols = [ train_dataset[dataset_idx] for dataset_idx in range(start, end)]
-            mols = dataset_to_mols(mols, config['dataset']['atom_map'])
-            energies.extend(sample_analyzer.compute_sample_energy(mols))
-            batch_metrics.append(sample_analyzer.analyze(mols, return_counts=True))
-
-        # compute metrics on the sampled molecules
-        numerators = defaultdict(float)
-        denominators = defaultdict(float)
-        for count_dict in batch_metrics:
-            numerators['frac_atoms_stable'] += count_dict['n_stable_atoms']
-            numerators['frac_mols_stable_valence'] += count_dict['n_stable_molecules']
-            numerators['frac_valid_mols'] += count_dict['n_valid']
-            numerators['avg_frag_frac'] += count_dict['sum_frag_fracs']
-            numerators['avg_num_components'] += count_dict['sum_num_components']
-
-            denominators['frac_atoms_stable'] += count_dict['n_atoms']
-            denominators['frac_mols_stable_valence'] += count_dict['n_molecules']
-            denominators['frac_valid_mols'] += count_dict['n_molecules']
-            denominators['avg_frag_frac'] += count_dict['n_frag_fracs']
-            denominators['avg_num_components'] += count_dict['n_num_components']
-        
-        metrics = {}
-        for key in numerators.keys():
-            metrics[key] = numerators[key] / denominators[key]
-
+        rng = np.random.default_rng(args.seed)
+        mol_idxs = np.sort(rng.choice(n_dataset_mols, args.n_mols, replace=False))
     else:
-        # convert the training dataset to a list of SampledMolecule objects
-        mols = dataset_to_mols(train_dataset, config['dataset']['atom_map'])
-
-        # compute the energies for the dataset
-        energies = sample_analyzer.compute_sample_energy(mols)
-
-        # compute metrics on the sampled molecules
-        metrics = sample_analyzer.analyze(mols)
+        mol_idxs = np.arange(n_dataset_mols)
+
+    # shard results are written to disk so that an interrupted run can pick up where it stopped
+    shard_dir = processed_data_dir / f'{args.split}_dataset_metrics_shards'
+    params_file = shard_dir / 'params.json'
+    params = {'split': args.split, 'n_mols': args.n_mols, 'seed': args.seed, 'shard_size': args.shard_size}
+    if args.overwrite and shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    if params_file.exists():
+        with open(params_file, 'r') as f:
+            if json.load(f) != params:
+                raise ValueError(f'{shard_dir} contains shards computed with different arguments, rerun with --overwrite to discard them')
+    else:
+        with open(params_file, 'w') as f:
+            json.dump(params, f)
+
+    n_shards = (len(mol_idxs) + args.shard_size - 1) // args.shard_size
+    shard_files = [shard_dir / f'shard_{shard_idx:06d}.pkl' for shard_idx in range(n_shards)]
+    shards = []
+    for shard_idx, shard_file in enumerate(shard_files):
+        if not shard_file.exists():
+            shards.append((shard_file, mol_idxs[shard_idx*args.shard_size:(shard_idx+1)*args.shard_size]))
+    print(f'{n_shards - len(shards)}/{n_shards} shards already computed')
+
+    # compute counts for the remaining shards
+    if args.n_cpus == 1:
+        init_worker(data_file, atom_map)
+        for shard in tqdm(shards, desc='Computing shard metrics'):
+            shard_counts(shard)
+    else:
+        with Pool(args.n_cpus, initializer=init_worker, initargs=(data_file, atom_map)) as pool:
+            for _ in tqdm(pool.imap_unordered(shard_counts, shards), total=len(shards), desc='Computing shard metrics'):
+                pass
+
+    # merge the exact counts from every shard
+    shard_count_dicts = []
+    for shard_file in shard_files:
+        with open(shard_file, 'rb') as f:
+            shard_count_dicts.append(pickle.load(f))
+    counts = combine_counts(shard_count_dicts)
+    metrics = counts_to_metrics(counts)
 
     # compute a discrete distribution of energies
-    bins = np.linspace(-200, 500, 200) # this range of bins captures ~99% of the density for the MMFF energies of both QM9 and GEOM-DRUGS datasets -- is that reasonable?
-    counts_dataset, _ = np.histogram(energies, bins=bins, density=False)
+    counts_dataset = counts['energy_counts']
+    n_energies = counts['n_energies']
     # compute the fraction of the molecules which fall outside these bins
-    frac_outside = 1 - counts_dataset.sum() / len(energies)
+    frac_outside = 1 - counts_dataset.sum() / n_energies
     # print the fraction of the molecules which fall outside the bins
     print(f'fraction of molecules outside the bins: {frac_outside:.4f}')
-    p_dataset = counts_dataset / len(energies)
+    p_dataset = counts_dataset / n_energies
 
     # save the reference distribution
-    processed_data_dir = Path(config['dataset']['processed_data_dir'])
     energy_dist_file = processed_data_dir / 'energy_dist.npz'
-    save_reference_dist(bins, p_dataset, energy_dist_file)
+    save_reference_dist(energy_bins, p_dataset, energy_dist_file)
 
     # write metrics
     metrics_file = processed_data_dir / 'metrics.pkl'
@@ -133,4 +214,4 @@ if __name__ == "__main__":
 
     # print metrics
     for k, v in metrics.items():
-        print(f'{k}= {v:.2f}')
\ No newline at end of file
+        print(f'{k}= {v:.2f}')
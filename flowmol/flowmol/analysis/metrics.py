@@ -2,13 +2,16 @@ from typing import List
 from .molecule_builder import SampledMolecule
 from pathlib import Path
 import torch
+import dgl
 from rdkit import Chem
 from collections import Counter
 import wandb
+import numpy as np
 from flowmol.utils.divergences import DivergenceCalculator
 from flowmol.analysis.ff_energy import compute_mmff_energy
 from flowmol.analysis.reos import REOS
 from flowmol.analysis.ring_systems import RingSystemCounter, ring_counts_to_df
+from flowmol.analysis.smiles_index import SmilesIndex, hash_smiles
 
 allowed_bonds = {'H': {0: 1, 1: 0, -1: 0},
                  'C': {0: [3, 4], 1: 3, -1: 3},
@@ -35,9 +38,40 @@ class SampleAnalyzer():
 
         energy_dist_file = self.processed_data_dir / 'energy_dist.npz'
         self.energy_div_calculator = DivergenceCalculator(energy_dist_file)
+
+        # REOS and ring system lookups are expensive to construct, so they are built on first use
+        self._reos = None
+        self._ring_system_counter = None
+        self._smiles_index = None
+        self._smiles_index_checked = False # whether a missing index was already reported
+
+    @property
+    def reos(self) -> REOS:
+        if self._reos is None:
+            self._reos = REOS(active_rules=["Glaxo", "Dundee"])
+        return self._reos
+
+    @property
+    def ring_system_counter(self) -> RingSystemCounter:
+        if self._ring_system_counter is None:
+            self._ring_system_counter = RingSystemCounter()
+        return self._ring_system_counter
+
+    @property
+    def smiles_index(self) -> SmilesIndex:
+        """Index of the training set SMILES used for novelty, None if it has not been built for processed_data_dir."""
+        if self._smiles_index is None and not self._smiles_index_checked:
+            self._smiles_index_checked = True
+            index_file = Path(self.processed_data_dir) / 'train_data_smiles_index.npy'
+            if not index_file.exists():
+                print(f'WARNING: no training smiles index found at {index_file}, novelty will not be computed')
+                return None
+            self._smiles_index = SmilesIndex.load(index_file)
+        return self._smiles_index
             
 
-    def analyze(self, sampled_molecules: List[SampledMolecule], return_counts: bool = False, energy_div: bool = False, functional_validity: bool = False):
+    def analyze(self, sampled_molecules: List[SampledMolecule], return_counts: bool = False, energy_div: bool = False, functional_validity: bool = False,
+                novelty: bool = False):
 
         # compute the atom-level stabiltiy of a molecule. this is the number of atoms that have valid valencies.
         # note that since is computed at the atom level, even if the entire molecule is unstable, we can still get an idea
@@ -56,7 +90,8 @@ class SampleAnalyzer():
         frac_mols_stable_valence = n_stable_molecules / n_molecules # the fraction of generated molecules whose atoms all have valid valencies
 
         # compute validity as determined by rdkit, and the average size of the largest fragment, and the average number of fragments
-        validity_result = self.compute_validity(sampled_molecules, return_counts=return_counts)
+        valid_smiles = []
+        validity_result = self.compute_validity(sampled_molecules, return_counts=return_counts, valid_smiles=valid_smiles)
         if return_counts:
             frac_valid_mols, avg_frag_frac, avg_num_components, n_valid, sum_frag_fracs, n_frag_fracs, sum_num_components, n_num_components = validity_result
         else:
@@ -69,14 +104,15 @@ class SampleAnalyzer():
             'avg_frag_frac': avg_frag_frac,
             'avg_num_components': avg_num_components
         }
-        # TODO: i think the return_counts functionality was so that we could
-        # compute metrics on the  entire dataset by chunking it and combining the counts at the end
-        # this functionality is not supported yet for reos and rings`
-        # before we compute dataset-level metrics, we need to implement the functionality to combine counts
-        # of reos/rings outputs. 
-        if functional_validity:
+        # the return_counts functionality is so that we can compute metrics on the entire dataset
+        # by chunking it and combining the counts at the end, see combine_counts and counts_to_metrics
+        if functional_validity and not return_counts:
             metrics_dict.update(self.reos_and_rings(sampled_molecules, return_raw=False))
 
+        # uniqueness among valid molecules, and novelty of the unique ones with respect to the training set
+        if novelty and not return_counts:
+            metrics_dict.update(uniqueness_and_novelty(hash_smiles(valid_smiles), self.smiles_index))
+
         if return_counts:
             counts_dict = {}
             counts_dict['n_stable_atoms'] = n_stable_atoms
@@ -88,6 +124,10 @@ class SampleAnalyzer():
             counts_dict['n_frag_fracs'] = n_frag_fracs
             counts_dict['sum_num_components'] = sum_num_components
             counts_dict['n_num_components'] = n_num_components
+            if functional_validity:
+                counts_dict.update(self.functional_validity_counts([sample.rdkit_mol for sample in sampled_molecules]))
+            if novelty:
+                counts_dict['smiles_hashes'] = hash_smiles(valid_smiles)
             return counts_dict
         
         if self.processed_data_dir is not None and Path(self.processed_data_dir).exists() and energy_div:
@@ -97,8 +137,8 @@ class SampleAnalyzer():
         return metrics_dict
 
     # this function taken from MiDi molecular_metrics.py script
-    def compute_validity(self, sampled_molecules: List[SampledMolecule], return_counts: bool = False):
-        """ generated: list of couples (positions, atom_types)"""
+    def compute_validity(self, sampled_molecules: List[SampledMolecule], return_counts: bool = False, valid_smiles: List[str] = None):
+        """ generated: list of couples (positions, atom_types). If valid_smiles is a list, the SMILES of valid molecules are appended to it."""
         n_valid = 0
         num_components = []
         frag_fracs = []
@@ -117,6 +157,8 @@ class SampleAnalyzer():
                     frag_fracs.append(largest_frag_frac)
                     Chem.SanitizeMol(largest_mol)
                     smiles = Chem.MolToSmiles(largest_mol)
+                    if valid_smiles is not None:
+                        valid_smiles.append(smiles)
                     n_valid += 1
                     error_message[-1] += 1
                 except Chem.rdchem.AtomValenceException:
@@ -172,60 +214,148 @@ class SampleAnalyzer():
     def reos_and_rings(self, samples: List[SampledMolecule], return_raw=False):
         """ samples: list of SampledMolecule objects. """
         rd_mols = [sample.rdkit_mol for sample in samples]
-        valid_idxs = []
-        sanitized_mols = []
-        for i, mol in enumerate(rd_mols):
-            try:
-                Chem.SanitizeMol(mol)
-                sanitized_mols.append(mol)
-                valid_idxs.append(i)
-            except:
-                continue
-        reos = REOS(active_rules=["Glaxo", "Dundee"])
-        ring_system_counter = RingSystemCounter()
+
+        if not return_raw:
+            return functional_validity_metrics(self.functional_validity_counts(rd_mols))
+
+        sanitized_mols, valid_idxs = sanitize_mols(rd_mols)
+        reos = self.reos
 
         if len(sanitized_mols) != 0:
             reos_flags = reos.mols_to_flag_arr(sanitized_mols)
-            ring_counts = ring_system_counter.count_ring_systems(sanitized_mols)
+            ring_counts = self.ring_system_counter.count_ring_systems(sanitized_mols)
         else:
             reos_flags = None
             ring_counts = None
 
-        if return_raw:
-            result = {
-                        'reos_flag_arr': reos_flags,
-                        'reos_flag_header': reos.flag_arr_header,
-                        'smarts_arr': reos.smarts_arr,
-                        'ring_counts': ring_counts,
-                        'valid_idxs': valid_idxs
-                    }
-            return result
-        
-        if reos_flags is not None:
-            n_flags = reos_flags.sum()
-            n_mols = reos_flags.shape[0]
-            flag_rate = n_flags / n_mols
-
-            sample_counts, chembl_counts, n_mols = ring_counts
-            df_ring = ring_counts_to_df(sample_counts, chembl_counts, n_mols)
-            ood_ring_count = df_ring[df_ring['chembl_count'] == 0]['sample_count'].sum()
-            ood_rate = ood_ring_count / n_mols
+        result = {
+                    'reos_flag_arr': reos_flags,
+                    'reos_flag_header': reos.flag_arr_header,
+                    'smarts_arr': reos.smarts_arr,
+                    'ring_counts': ring_counts,
+                    'valid_idxs': valid_idxs
+                }
+        return result
+
+    def functional_validity_counts(self, rd_mols: List[Chem.Mol]) -> dict:
+        """Counts REOS flags and ring systems over the molecules in rd_mols that can be sanitized.
+
+        Counts from different batches of molecules can be merged with combine_counts.
+        """
+        sanitized_mols, _ = sanitize_mols(rd_mols)
+
+        if len(sanitized_mols) != 0:
+            reos_flag_counts = self.reos.mols_to_flag_arr(sanitized_mols).sum(axis=0).astype(np.int64)
+            ring_counts = self.ring_system_counter.count_ring_systems(sanitized_mols)
         else:
-            flag_rate = -1
-            ood_rate = -1
-        
-        return dict(flag_rate=flag_rate, ood_rate=ood_rate)
+            reos_flag_counts = np.zeros(len(self.reos.flag_arr_header), dtype=np.int64)
+            ring_counts = ({}, {}, 0)
+
+        return {
+            'reos_flag_counts': reos_flag_counts,
+            'n_reos_mols': len(sanitized_mols),
+            'ring_counts': ring_counts,
+        }
+
+
+def sanitize_mols(rd_mols: List[Chem.Mol]):
+    """Sanitizes molecules in place. Returns the molecules that could be sanitized and their indices in rd_mols."""
+    valid_idxs = []
+    sanitized_mols = []
+    for i, mol in enumerate(rd_mols):
+        if mol is None:
+            continue
+        try:
+            Chem.SanitizeMol(mol)
+            sanitized_mols.append(mol)
+            valid_idxs.append(i)
+        except:
+            continue
+    return sanitized_mols, valid_idxs
+
+
+def functional_validity_metrics(counts: dict) -> dict:
+    """Computes the REOS flag rate and out-of-distribution ring rate from functional validity counts."""
+    n_mols = counts['n_reos_mols']
+    if n_mols == 0:
+        return dict(flag_rate=-1, ood_rate=-1)
+
+    flag_rate = counts['reos_flag_counts'].sum() / n_mols
+
+    sample_counts, chembl_counts, n_ring_mols = counts['ring_counts']
+    df_ring = ring_counts_to_df(sample_counts, chembl_counts, n_ring_mols)
+    ood_ring_count = df_ring[df_ring['chembl_count'] == 0]['sample_count'].sum()
+    ood_rate = ood_ring_count / n_ring_mols
+
+    return dict(flag_rate=flag_rate, ood_rate=ood_rate)
+
+
+# numerator and denominator keys in the counts dict returned by SampleAnalyzer.analyze(return_counts=True) for each metric
+count_ratio_metrics = {
+    'frac_atoms_stable': ('n_stable_atoms', 'n_atoms'),
+    'frac_mols_stable_valence': ('n_stable_molecules', 'n_molecules'),
+    'frac_valid_mols': ('n_valid', 'n_molecules'),
+    'avg_frag_frac': ('sum_frag_fracs', 'n_frag_fracs'),
+    'avg_num_components': ('sum_num_components', 'n_num_components'),
+}
+
+def combine_counts(counts_list: List[dict]) -> dict:
+    """Merges counts dicts returned by SampleAnalyzer.analyze(return_counts=True) for different batches of molecules."""
+    combined = {}
+    ring_counts = []
+    for counts in counts_list:
+        for key, value in counts.items():
+            if key == 'ring_counts':
+                ring_counts.append(value)
+            elif key == 'smiles_hashes' and key in combined:
+                combined[key] = np.concatenate([combined[key], value])
+            elif key in combined:
+                combined[key] = combined[key] + value
+            else:
+                combined[key] = value
+
+    if ring_counts:
+        combined['ring_counts'] = RingSystemCounter.combine_counts(ring_counts)
+
+    return combined
+
+def counts_to_metrics(counts: dict, smiles_index: SmilesIndex = None) -> dict:
+    """Converts (possibly merged) counts into the metrics reported by SampleAnalyzer.analyze."""
+    metrics = {}
+    for metric, (numerator, denominator) in count_ratio_metrics.items():
+        metrics[metric] = counts[numerator] / counts[denominator]
+
+    if 'ring_counts' in counts:
+        metrics.update(functional_validity_metrics(counts))
+
+    if 'smiles_hashes' in counts:
+        metrics.update(uniqueness_and_novelty(counts['smiles_hashes'], smiles_index))
+
+    return metrics
+
+def uniqueness_and_novelty(smiles_hashes: np.ndarray, smiles_index: SmilesIndex = None) -> dict:
+    """Fraction of valid molecules that are unique and, if a training set index is given, fraction of unique molecules that are novel.
+
+    smiles_hashes are the hashes of the SMILES of every valid molecule, see hash_smiles.
+    """
+    if smiles_hashes.shape[0] == 0:
+        return dict(frac_unique=-1, frac_novel=-1) if smiles_index is not None else dict(frac_unique=-1)
+
+    unique_hashes = np.unique(smiles_hashes)
+    metrics = dict(frac_unique=unique_hashes.shape[0] / smiles_hashes.shape[0])
+    if smiles_index is not None:
+        metrics['frac_novel'] = float((~smiles_index.contains_hashes(unique_hashes)).mean())
+    return metrics
 
 def check_stability(molecule: SampledMolecule):
     """ molecule: Molecule object. """
-    atom_types = molecule.atom_types
-    # edge_types = molecule.bond_types
-
-    valencies = molecule.valencies
+    return check_atom_stability(molecule.atom_types, molecule.valencies, molecule.atom_charges)
 
+def check_atom_stability(atom_types: List[str], valencies, atom_charges):
+    """Counts the atoms with valid valencies. Returns the count and whether every atom is stable."""
     n_stable_atoms = 0
     mol_stable = True
-    for i, (atom_type, valency, charge) in enumerate(zip(atom_types, valencies, molecule.atom_charges)):
+    for i, (atom_type, valency, charge) in enumerate(zip(atom_types, valencies, atom_charges)):
         valency = int(valency)
         charge = int(charge)
         possible_bonds = allowed_bonds[atom_type]
@@ -240,4 +370,69 @@ def check_stability(molecule: SampledMolecule):
             mol_stable = False
         n_stable_atoms += int(is_stable)
 
-    return n_stable_atoms, mol_stable
\ No newline at end of file
+    return n_stable_atoms, mol_stable
+
+
+def build_valence_table(atom_type_map: List[str], max_valency: int = 8, ctmc_mol: bool = False) -> torch.Tensor:
+    """Tabulates allowed_bonds as a boolean tensor of shape (n_atom_types, 6, max_valency + 1).
+
+    Entry [atom_type_idx, charge + 2, valency] is True if an atom of that type and formal charge is stable with that valency.
+    Atom types without an entry in allowed_bonds are never stable. For CTMC models the mask token is tabulated as
+    selenium, the type SampledMolecule gives it, so that both agree on which molecules are stable.
+    """
+    if ctmc_mol:
+        atom_type_map = list(atom_type_map) + ['Se']
+    charges = range(-2, 4) # hard-coded assumption that charges are in range [-2, 3]
+    table = torch.zeros(len(atom_type_map), len(charges), max_valency + 1, dtype=torch.bool)
+    for type_idx, atom_type in enumerate(atom_type_map):
+        if atom_type not in allowed_bonds:
+            continue
+        possible_bonds = allowed_bonds[atom_type]
+        for charge_idx, charge in enumerate(charges):
+            if type(possible_bonds) == dict:
+                expected_bonds = possible_bonds[charge] if charge in possible_bonds.keys() else possible_bonds[0]
+            else:
+                expected_bonds = possible_bonds
+            if type(expected_bonds) == int:
+                expected_bonds = [expected_bonds]
+            for valency in expected_bonds:
+                if valency <= max_valency:
+                    table[type_idx, charge_idx, valency] = True
+    return table
+
+def batched_molecule_stability(g: dgl.DGLGraph, valence_table: torch.Tensor, exclude_charges: bool = False) -> torch.Tensor:
+    """Vectorized equivalent of check_stability for every molecule in a batched graph of sampled molecules.
+
+    Reads the sampled features x_1, a_1, c_1, e_1 and the upper edge mask ue_mask, as produced by FlowMol.sample_batched_graph.
+    Returns a boolean tensor of shape (batch_size,) that is True for molecules where every atom has a valid valency.
+    """
+    atom_types = g.ndata['a_1'].argmax(dim=1)
+    if exclude_charges:
+        charge_idxs = torch.full_like(atom_types, 2)
+    else:
+        charge_idxs = g.ndata['c_1'].argmax(dim=1) # index 2 is a charge of zero
+
+    # bond orders of the upper triangle edges, aromatic bonds count as 1.5 and masked bonds (index 5) as no bond,
+    # like extract_moldata_from_graph and compute_valencies do for SampledMolecule
+    upper_edge_mask = g.edata['ue_mask']
+    bond_types = g.edata['e_1'][upper_edge_mask].argmax(dim=1)
+    bond_orders = bond_types.float()
+    bond_orders[bond_types == 4] = 1.5
+    bond_orders[bond_types == 5] = 0
+    src_idxs, dst_idxs = g.edges()
+    valencies = torch.zeros(g.num_nodes(), device=bond_orders.device)
+    valencies.index_add_(0, src_idxs[upper_edge_mask].long(), bond_orders)
+    valencies.index_add_(0, dst_idxs[upper_edge_mask].long(), bond_orders)
+    valencies = valencies.long()
+
+    # atoms with valencies beyond the table, or with types that are not in it, are unstable
+    max_valency = valence_table.shape[2] - 1
+    in_table = (valencies <= max_valency) & (atom_types < valence_table.shape[0])
+    atom_stable = torch.zeros_like(in_table)
+    atom_stable[in_table] = valence_table.to(atom_types.device)[atom_types[in_table], charge_idxs[in_table], valencies[in_table]]
+
+    # a molecule is stable if none of its atoms are unstable
+    node_batch_idx = torch.arange(g.batch_size, device=atom_types.device).repeat_interleave(g.batch_num_nodes())
+    n_unstable = torch.zeros(g.batch_size, dtype=torch.long, device=atom_types.device)
+    n_unstable.index_add_(0, node_batch_idx, (~atom_stable).long())
+    return n_unstable == 0
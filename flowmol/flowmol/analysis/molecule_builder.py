@@ -116,14 +116,7 @@ class SampledMolecule:
     
     def compute_valencies(self):
         """Compute the valencies of every atom in the molecule. Returns a tensor of shape (num_atoms,)."""
-        adj = torch.zeros((self.num_atoms, self.num_atoms))
-        adjusted_bond_types = self.bond_types.clone()
-        adjusted_bond_types[adjusted_bond_types == 4] = 1.5
-        adjusted_bond_types = adjusted_bond_types.float()
-        adj[self.bond_src_idxs, self.bond_dst_idxs] = adjusted_bond_types
-        adj[self.bond_dst_idxs, self.bond_src_idxs] = adjusted_bond_types
-        valencies = torch.sum(adj, dim=-1).long()
-        return valencies
+        return compute_valencies(self.num_atoms, self.bond_src_idxs, self.bond_dst_idxs, self.bond_types)
     
     def process_traj_frames(self, traj_frames: Dict[str, torch.Tensor], ep_traj: bool = False):
         """Converts the trajectory frames to a list of rdkit molecules."""
@@ -219,6 +212,17 @@ def extract_moldata_from_graph(g: dgl.DGLGraph, atom_type_map: List[str], exclud
     return positions, atom_types, atom_charges, bond_types, bond_src_idxs, bond_dst_idxs
 
 
+def compute_valencies(num_atoms: int, bond_src_idxs: torch.Tensor, bond_dst_idxs: torch.Tensor, bond_types: torch.Tensor):
+    """Compute the valency of every atom from a list of bonds, each bond appearing once. Returns a tensor of shape (num_atoms,)."""
+    bond_orders = bond_types.float()
+    bond_orders[bond_types == 4] = 1.5 # aromatic bonds
+    bond_orders[bond_types == 5] = 0 # masked bonds from CTMC models are no bond, as in batched_molecule_stability
+    valencies = torch.zeros(num_atoms)
+    valencies.index_add_(0, bond_src_idxs.long(), bond_orders)
+    valencies.index_add_(0, bond_dst_idxs.long(), bond_orders)
+    return valencies.long()
+
+
 def build_molecule(positions, atom_types, atom_charges, bond_src_idxs, bond_dst_idxs, bond_types):
     """Builds a rdkit molecule from the given atom and bond information."""
     # create a rdkit molecule and add atoms to it
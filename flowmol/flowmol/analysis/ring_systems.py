@@ -26,7 +26,8 @@ class RingSystemCounter:
                 chembl_counts[ring_system_smi] = chembl_count
         return sample_counts, chembl_counts, n_mols
     
-    def combine_counts(self, counts_list: List[Tuple[Dict[str, int], Dict[str, int], int]]) -> Tuple[Dict[str, int], Dict[str, int], int]:
+    @staticmethod
+    def combine_counts(counts_list: List[Tuple[Dict[str, int], Dict[str, int], int]]) -> Tuple[Dict[str, int], Dict[str, int], int]:
         """
         Accepts a list of tuples, each containing two dictionaries and an integer: 
         one with the counts of ring systems observed in the sample, 
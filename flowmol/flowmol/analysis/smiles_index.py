@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import numpy as np
+from rdkit import Chem
+
+EMPTY_SLOT = np.uint64(0)
+
+
+def canonical_smiles(smiles: str) -> Optional[str]:
+    """The key molecules are compared by: RDKit canonical SMILES without stereochemistry or explicit hydrogens.
+
+    Training SMILES carry stereochemistry that sampled molecules, built from 3D coordinates and bond orders, do not have,
+    so stereochemistry is dropped on both sides. Returns None if the SMILES cannot be parsed.
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    return Chem.MolToSmiles(mol, isomericSmiles=False)
+
+def hash_smiles(smiles_list: Iterable[str], canonicalize: bool = True) -> np.ndarray:
+    """64-bit hashes of SMILES strings, as an array of dtype uint64. SMILES that cannot be parsed are skipped.
+
+    The hash value 0 marks empty slots in SmilesIndex, so it is never returned.
+    """
+    hashes = []
+    for smiles in smiles_list:
+        key = canonical_smiles(smiles) if canonicalize else smiles
+        if key is None:
+            continue
+        hashes.append(int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1)
+    return np.array(hashes, dtype=np.uint64)
+
+
+class SmilesIndex:
+    """A hash set of SMILES, stored as an open-addressing table of 64-bit hashes in a single numpy array.
+
+    Lookups are vectorized and take O(1) time per SMILES. The table is saved as a .npy file and loaded memory-mapped,
+    so processes that open the same index share its pages instead of each holding a copy; SmilesIndex objects sent to
+    worker processes reopen the file rather than pickling the table. SMILES are canonicalized with canonical_smiles before
+    hashing. Two different molecules only collide if their 64-bit hashes are equal, which is negligible at the size of
+    molecular datasets.
+    """
+
+    max_load = 0.5
+
+    def __init__(self, capacity: int = 1024):
+        capacity = 1 << max(int(capacity) - 1, 1).bit_length() # round up to a power of 2
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.n_items = 0
+        self.path: Path = None
+
+    def __len__(self):
+        return self.n_items
+
+    def __contains__(self, smiles: str):
+        return bool(self.contains([smiles])[0])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.table, np.memmap):
+            state['table'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.table is None:
+            self.table = np.load(self.path, mmap_mode='r')
+
+    @classmethod
+    def from_smiles(cls, smiles_list: List[str]) -> 'SmilesIndex':
+        index = cls(capacity=len(smiles_list) / cls.max_load)
+        index.add(smiles_list)
+        return index
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> 'SmilesIndex':
+        path = Path(path)
+        with open(path.with_suffix('.json'), 'r') as f:
+            metadata = json.load(f)
+        index = cls.__new__(cls)
+        index.table = np.load(path, mmap_mode='r' if mmap else None)
+        index.n_items = metadata['n_items']
+        index.path = path
+        return index
+
+    def save(self, path: Path):
+        """Writes the table to path (a .npy file) and the number of items to a .json file next to it."""
+        path = Path(path)
+        # write to temporary files and rename them so that readers never see a partial index
+        tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npy')
+        np.save(tmp_path, np.asarray(self.table))
+        os.replace(tmp_path, path)
+        tmp_metadata = path.with_name(f'{path.stem}.{os.getpid()}.tmp.json')
+        with open(tmp_metadata, 'w') as f:
+            json.dump({'n_items': self.n_items, 'key': 'non-isomeric canonical smiles', 'hash': 'blake2b-64'}, f)
+        os.replace(tmp_metadata, path.with_suffix('.json'))
+        self.path = path
+
+    def slots(self, hashes: np.ndarray) -> np.ndarray:
+        # hashes are uniformly distributed, so their low bits are used as the slot index
+        return (hashes & np.uint64(self.table.shape[0] - 1)).astype(np.int64)
+
+    def contains_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        """Returns a boolean array that is True for every hash in the index."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        capacity_mask = self.table.shape[0] - 1
+        found = np.zeros(hashes.shape[0], dtype=bool)
+        slots = self.slots(hashes)
+        active = np.arange(hashes.shape[0])
+
+        # linear probing, all lookups advance together until they hit their hash or an empty slot
+        while active.size > 0:
+            slot_values = self.table[slots[active]]
+            hit = slot_values == hashes[active]
+            found[active[hit]] = True
+            active = active[~hit & (slot_values != EMPTY_SLOT)]
+            slots[active] = (slots[active] + 1) & capacity_mask
+        return found
+
+    def contains(self, smiles_list: List[str]) -> np.ndarray:
+        """Returns a boolean array that is True for every SMILES in the index. SMILES that cannot be parsed are not in the index."""
+        found = np.zeros(len(smiles_list), dtype=bool)
+        keys = [canonical_smiles(smiles) for smiles in smiles_list]
+        parsed_idxs = [i for i, key in enumerate(keys) if key is not None]
+        hashes = hash_smiles([keys[i] for i in parsed_idxs], canonicalize=False)
+        found[parsed_idxs] = self.contains_hashes(hashes)
+        return found
+
+    def add(self, smiles_list: List[str]) -> int:
+        """Adds SMILES to the index, returning the number that were not already in it."""
+        return self.add_hashes(hash_smiles(smiles_list))
+
+    def hashes(self) -> np.ndarray:
+        """All hashes in the index."""
+        return np.asarray(self.table[self.table != EMPTY_SLOT])
+
+    def add_hashes(self, hashes: np.ndarray) -> int:
+        hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+        hashes = hashes[~self.contains_hashes(hashes)]
+        if hashes.shape[0] == 0:
+            return 0
+
+        # a memory-mapped table is read-only, updates are made in memory and persisted with save()
+        if isinstance(self.table, np.memmap) or not self.table.flags.writeable:
+            self.table = np.array(self.table)
+
+        if (self.n_items + hashes.shape[0]) > self.max_load * self.table.shape[0]:
+            self.resize((self.n_items + hashes.shape[0]) / self.max_load)
+
+        self.insert(hashes)
+        return int(hashes.shape[0])
+
+    def resize(self, min_capacity: int):
+        existing = self.table[self.table != EMPTY_SLOT]
+        capacity = 1 << max(int(min_capacity) - 1, 1).bit_length()
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.n_items = 0
+        self.insert(existing)
+
+    def insert(self, hashes: np.ndarray):
+        """Inserts hashes that are known to be unique and not in the table, which must have room for them."""
+        capacity_mask = self.table.shape[0] - 1
+        table = self.table
+        for h, slot in zip(hashes.tolist(), self.slots(hashes).tolist()):
+            while table[slot] != EMPTY_SLOT:
+                slot = (slot + 1) & capacity_mask
+            table[slot] = h
+        self.n_items += int(hashes.shape[0])
+
+
+def update_smiles_index(index_file: Path, smiles_list: List[str]) -> SmilesIndex:
+    """Adds SMILES to the index saved at index_file, creating it if it does not exist.
+
+    The index is loaded, extended and saved again without a lock, so processes must not update the same file at once.
+    """
+    index_file = Path(index_file)
+    if index_file.exists():
+        index = SmilesIndex.load(index_file)
+        n_added = index.add(smiles_list)
+    else:
+        index = SmilesIndex.from_smiles(smiles_list)
+        n_added = len(index)
+    index.save(index_file)
+    print(f'added {n_added} smiles to {index_file}, which now contains {len(index)}')
+    return index
+
+
+def merge_smiles_indices(index_files: List[Path]) -> SmilesIndex:
+    """A new index holding the SMILES of every index in index_files."""
+    indices = [SmilesIndex.load(index_file) for index_file in index_files]
+    merged = SmilesIndex(capacity=sum(len(index) for index in indices) / SmilesIndex.max_load)
+    for index in indices:
+        merged.add_hashes(index.hashes())
+    return merged
@@ -0,0 +1,187 @@
+import math
+import time
+from multiprocessing import Pool
+from typing import List, Optional
+
+import dgl
+import torch
+from rdkit import Chem, RDLogger
+
+from flowmol.analysis.molecule_builder import SampledMolecule, extract_moldata_from_graph, build_molecule
+from flowmol.analysis.metrics import build_valence_table, batched_molecule_stability
+
+
+def init_worker():
+    RDLogger.DisableLog('rdApp.*')
+
+def screen_molecule(mol_data: tuple, allow_fragments: bool = False) -> Optional[str]:
+    """Builds and sanitizes a molecule from the data returned by extract_moldata_from_graph.
+
+    Returns the canonical SMILES of the molecule, or of its largest fragment if allow_fragments is True.
+    Returns None if the molecule cannot be sanitized or, when allow_fragments is False, has more than one fragment.
+    """
+    mol = build_molecule(*mol_data)
+    if mol is None:
+        return None
+
+    try:
+        mol_frags = Chem.rdmolops.GetMolFrags(mol, asMols=True, sanitizeFrags=False)
+        if len(mol_frags) > 1 and not allow_fragments:
+            return None
+        largest_mol = max(mol_frags, default=mol, key=lambda m: m.GetNumAtoms())
+        Chem.SanitizeMol(largest_mol)
+        return Chem.MolToSmiles(largest_mol)
+    except Exception:
+        return None
+
+def screen_molecules(mol_datas: List[tuple], allow_fragments: bool = False) -> List[Optional[str]]:
+    return [screen_molecule(mol_data, allow_fragments) for mol_data in mol_datas]
+
+
+class ValidMoleculeSampler:
+    """Samples from a FlowMol model until a requested number of valid, unique molecules has been collected.
+
+    Every batch goes through a vectorized valence check on the batched graph. The molecules that pass are built and
+    sanitized with RDKit in a worker pool while the next batch is sampled, and they are deduplicated by canonical SMILES.
+    Batches are sized from the yield of valid unique molecules observed so far, so the last batches only sample about as many
+    molecules as are still needed.
+    """
+
+    def __init__(self, model, device, max_batch_size: int = 128, n_workers: int = 4,
+                 require_stable: bool = True, allow_fragments: bool = False, n_atoms_per_mol: int = None,
+                 max_stalled_batches: int = 10, **sample_kwargs):
+        """
+        Args:
+            model: a FlowMol model.
+            require_stable: only keep molecules where every atom has a valid valency.
+            allow_fragments: keep molecules with several fragments, deduplicated by the SMILES of their largest fragment.
+            n_atoms_per_mol: the number of atoms in every molecule, if None it is sampled from the training data distribution.
+            max_stalled_batches: sampling stops after this many batches in a row add no new molecule, e.g. because the model
+                yields no valid molecules or cannot produce n_valid unique ones.
+            sample_kwargs: passed to FlowMol.sample_batched_graph, e.g. n_timesteps, stochasticity, high_confidence_threshold, precision.
+        """
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.n_workers = n_workers
+        self.require_stable = require_stable
+        self.allow_fragments = allow_fragments
+        self.n_atoms_per_mol = n_atoms_per_mol
+        self.max_stalled_batches = max_stalled_batches
+        self.sample_kwargs = sample_kwargs
+        self.valence_table = build_valence_table(model.atom_type_map, ctmc_mol=model.parameterization == 'ctmc')
+
+        self.seen_smiles = set()
+        self.molecules: List[SampledMolecule] = []
+        self.stats = {}
+
+    def sample(self, n_valid: int, max_samples: int = None) -> List[SampledMolecule]:
+        """Returns n_valid valid, unique molecules, or fewer if max_samples molecules were sampled first or
+        max_stalled_batches batches in a row added no new molecule. stats['n_missing'] is the shortfall."""
+        self.seen_smiles = set()
+        self.molecules = []
+        self.stats = dict(n_sampled=0, n_stable=0, n_valid=0, n_unique=0, sampling_time=0.0)
+        n_stalled = 0
+        start = time.perf_counter()
+
+        pool = Pool(self.n_workers, initializer=init_worker) if self.n_workers > 0 else None
+        try:
+            pending = None
+            while True:
+                # the molecules still needed, counting on the batch being screened to yield as much as the batches before it
+                n_needed = n_valid - len(self.molecules)
+                if pending is not None:
+                    n_needed -= len(pending[1]) * self.observed_yield(default=1.0)
+                budget = math.inf if max_samples is None else max_samples - self.stats['n_sampled']
+
+                launched = None
+                stalled = n_stalled >= self.max_stalled_batches
+                if n_needed > 0 and budget > 0 and not stalled:
+                    observed_yield = self.observed_yield(default=None)
+                    batch_size = self.max_batch_size if observed_yield is None else math.ceil(n_needed / observed_yield)
+                    batch_size = int(min(max(batch_size, 1), self.max_batch_size, budget))
+                    launched = self.launch_batch(batch_size, pool)
+
+                # screening of the previous batch overlaps with sampling of this one
+                if pending is not None:
+                    n_stalled = n_stalled + 1 if self.collect(pending) == 0 else 0
+                pending = launched
+
+                if pending is None and (len(self.molecules) >= n_valid or budget <= 0 or stalled):
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.molecules = self.molecules[:n_valid]
+        elapsed = time.perf_counter() - start
+        self.stats['n_unique'] = len(self.molecules)
+        self.stats['n_missing'] = n_valid - len(self.molecules)
+        self.stats['stalled'] = n_stalled >= self.max_stalled_batches
+        if self.stats['stalled']:
+            print(f"WARNING: stopped sampling after {n_stalled} batches in a row added no new molecule, "
+                  f"collected {len(self.molecules)} of {n_valid} valid, unique molecules")
+        self.stats['elapsed'] = elapsed
+        self.stats['valid_unique_per_s'] = len(self.molecules) / elapsed
+        return self.molecules
+
+    def observed_yield(self, default=None):
+        """Fraction of sampled molecules that were valid and unique so far."""
+        if len(self.molecules) == 0:
+            return default
+        return len(self.molecules) / self.stats['n_sampled']
+
+    def launch_batch(self, batch_size: int, pool):
+        if self.n_atoms_per_mol is None:
+            n_atoms = self.model.sample_n_atoms(batch_size).to(self.device)
+        else:
+            n_atoms = torch.full((batch_size,), self.n_atoms_per_mol, dtype=torch.long, device=self.device)
+
+        sampling_start = time.perf_counter()
+        g, _ = self.model.sample_batched_graph(n_atoms, device=self.device, **self.sample_kwargs)
+        self.stats['sampling_time'] += time.perf_counter() - sampling_start
+        self.stats['n_sampled'] += batch_size
+
+        # only molecules that pass the valence check are built with rdkit
+        if self.require_stable:
+            stable_mask = batched_molecule_stability(g, self.valence_table, exclude_charges=self.model.exclude_charges)
+        else:
+            stable_mask = torch.ones(batch_size, dtype=torch.bool)
+        graphs = [g_i for g_i, stable in zip(dgl.unbatch(g), stable_mask.tolist()) if stable]
+        self.stats['n_stable'] += len(graphs)
+
+        atom_type_map = list(self.model.atom_type_map)
+        if self.model.parameterization == 'ctmc':
+            atom_type_map.append('Se') # masked atoms, as in SampledMolecule
+        mol_datas = []
+        for g_i in graphs:
+            positions, atom_types, atom_charges, bond_types, bond_src_idxs, bond_dst_idxs = extract_moldata_from_graph(
+                g_i, atom_type_map, exclude_charges=self.model.exclude_charges, ctmc_mol=self.model.parameterization == 'ctmc')
+            if atom_charges is None:
+                atom_charges = torch.zeros(len(atom_types), dtype=torch.long)
+            mol_datas.append((positions.numpy(), atom_types, atom_charges.tolist(), bond_src_idxs.tolist(), bond_dst_idxs.tolist(), bond_types.tolist()))
+
+        if pool is None:
+            result = screen_molecules(mol_datas, self.allow_fragments)
+        else:
+            result = pool.apply_async(screen_molecules, (mol_datas, self.allow_fragments))
+        return result, graphs
+
+    def collect(self, pending) -> int:
+        """Keeps the valid, unique molecules of a screened batch and returns how many were added."""
+        result, graphs = pending
+        n_added = 0
+        smiles_list = result if isinstance(result, list) else result.get()
+        for g_i, smiles in zip(graphs, smiles_list):
+            if smiles is None:
+                continue
+            self.stats['n_valid'] += 1
+            if smiles in self.seen_smiles:
+                continue
+            self.seen_smiles.add(smiles)
+            self.molecules.append(SampledMolecule(g_i, self.model.atom_type_map,
+                ctmc_mol=self.model.parameterization == 'ctmc',
+                exclude_charges=self.model.exclude_charges))
+            n_added += 1
+        return n_added
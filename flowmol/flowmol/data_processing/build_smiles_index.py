@@ -0,0 +1,56 @@
+import argparse
+import pickle
+import re
+from pathlib import Path
+
+from flowmol.analysis.smiles_index import merge_smiles_indices, update_smiles_index
+
+# builds the smiles indices used by SampleAnalyzer to compute novelty for datasets that were processed before
+# process_geom.py and process_qm9.py started writing them. the index of a split is extended if it already exists,
+# so this can also be used to add smiles from newly processed data to an existing index.
+# with --from_chunks, the index of a split is instead rebuilt from the indices that process_geom.py wrote for each
+# chunk of the split (processed with --start_idx/--end_idx) in processed_data_dir/chunks.
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Build or extend the smiles index of processed dataset splits')
+    p.add_argument('--processed_data_dir', type=Path, required=True)
+    p.add_argument('--splits', type=str, nargs='+', default=['train_data'], help='splits whose {split}_smiles.pkl file is indexed')
+    p.add_argument('--smiles_files', type=Path, nargs='+', default=[], help='additional pickled lists of smiles to add to the index of the first split')
+    p.add_argument('--from_chunks', action='store_true', help='merge the chunk indices in processed_data_dir/chunks into the index of each split')
+
+    return p.parse_args()
+
+
+def chunk_index_files(chunks_dir: Path, split: str):
+    """Index files written by process_geom.py for chunks of split, named {split}_{start_idx}_{end_idx}_smiles_index.npy."""
+    pattern = re.compile(rf'{re.escape(split)}_\d+_(\d+|None)_smiles_index\.npy')
+    return sorted(f for f in chunks_dir.glob(f'{split}_*_smiles_index.npy') if pattern.fullmatch(f.name))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    for split_idx, split in enumerate(args.splits):
+        index_file = args.processed_data_dir / f'{split}_smiles_index.npy'
+
+        if args.from_chunks:
+            chunk_files = chunk_index_files(args.processed_data_dir / 'chunks', split)
+            if len(chunk_files) == 0:
+                raise FileNotFoundError(f'no chunk smiles indices for {split} in {args.processed_data_dir / "chunks"}')
+            index = merge_smiles_indices(chunk_files)
+            index.save(index_file)
+            print(f'merged {len(chunk_files)} chunk indices into {index_file}, which now contains {len(index)}')
+            continue
+
+        smiles_files = [args.processed_data_dir / f'{split}_smiles.pkl']
+        if split_idx == 0:
+            smiles_files.extend(args.smiles_files)
+
+        all_smiles = []
+        for smiles_file in smiles_files:
+            if not smiles_file.exists():
+                raise FileNotFoundError(f'{smiles_file} not found')
+            with open(smiles_file, 'rb') as f:
+                all_smiles.extend(pickle.load(f))
+
+        update_smiles_index(index_file, all_smiles)
@@ -5,10 +5,13 @@ import dgl
 
 from flowmol.data_processing.dataset import MoleculeDataset
 from flowmol.data_processing.samplers import SameSizeMoleculeSampler, SameSizeDistributedMoleculeSampler
+from flowmol.data_processing.validation_cache import ValidationCache
+from flowmol.data_processing.device_batcher import DeviceBatchBuilder
 
 class MoleculeDataModule(pl.LightningDataModule):
 
-    def __init__(self, dataset_config: dict, dm_prior_config: dict, batch_size: int, num_workers: int = 0, distributed: bool = False, max_num_edges: int = 40000):
+    def __init__(self, dataset_config: dict, dm_prior_config: dict, batch_size: int, num_workers: int = 0, distributed: bool = False, max_num_edges: int = 40000,
+                 val_cache_size: int = None, val_cache_seed: int = 0, device_resident: bool = False):
         super().__init__()
         self.distributed = distributed
         self.dataset_config = dataset_config
@@ -16,6 +19,11 @@ class MoleculeDataModule(pl.LightningDataModule):
         self.num_workers = num_workers
         self.prior_config = dm_prior_config
         self.max_num_edges = max_num_edges
+        self.val_cache_size = val_cache_size # if set, validate on a fixed, prebatched subset of this many validation molecules
+        self.val_cache_seed = val_cache_seed
+        self.val_cache = None
+        self.device_resident = device_resident # if true, keep the dataset arrays on the training device and build batches there
+        self.batch_builders = {}
         self.save_hyperparameters()
 
     def setup(self, stage: str):
@@ -24,10 +32,36 @@ class MoleculeDataModule(pl.LightningDataModule):
             self.train_dataset = self.load_dataset('train')
             self.val_dataset = self.load_dataset('val')
 
+            if self.val_cache_size is not None and self.val_cache is None:
+                self.val_cache = ValidationCache(self.val_dataset, self.val_cache_size, batch_size=self.batch_size*2, seed=self.val_cache_seed)
+
+            # batch builders are moved to the training device on the first batch
+            if self.device_resident:
+                self.batch_builders = {
+                    'train': DeviceBatchBuilder(self.train_dataset),
+                    'val': DeviceBatchBuilder(self.val_dataset),
+                }
+
     def load_dataset(self, dataset_name: str):
         return MoleculeDataset(dataset_name, self.dataset_config, prior_config=self.prior_config)
 
+    def index_dataloader(self, n_mols: int, batch_size: int, shuffle: bool):
+        # in device-resident mode the dataloader only yields molecule indices, batches are built in on_after_batch_transfer
+        return DataLoader(torch.arange(n_mols), batch_size=batch_size, shuffle=shuffle, num_workers=0)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        if not self.device_resident or isinstance(batch, dgl.DGLGraph):
+            return batch
+
+        builder = self.batch_builders['train' if self.trainer.training else 'val']
+        if builder.device != batch.device:
+            builder.to(batch.device)
+        return builder.build_batch(batch)
+
     def train_dataloader(self):
+        if self.device_resident:
+            return self.index_dataloader(len(self.train_dataset), self.batch_size, shuffle=True)
+
         dataloader = DataLoader(self.train_dataset, 
                                 batch_size=self.batch_size, 
                                 shuffle=True, 
@@ -58,9 +92,16 @@ class MoleculeDataModule(pl.LightningDataModule):
         return dataloader
     
     def val_dataloader(self):
-        dataloader = DataLoader(self.train_dataset, 
+        if self.val_cache is not None:
+            # the cache holds whole batches which live on the training device once FlowMol has prepared them, so no workers or collation
+            return DataLoader(self.val_cache, batch_size=None, shuffle=False, num_workers=0)
+
+        if self.device_resident:
+            return self.index_dataloader(len(self.val_dataset), self.batch_size*2, shuffle=False)
+
+        dataloader = DataLoader(self.val_dataset, 
                                 batch_size=self.batch_size*2, 
-                                shuffle=True, 
+                                shuffle=False, 
                                 collate_fn=dgl.batch, 
                                 num_workers=self.num_workers)
         return dataloader
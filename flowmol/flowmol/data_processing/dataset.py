@@ -2,7 +2,8 @@ import torch
 from pathlib import Path
 import dgl
 from torch.nn.functional import one_hot
-from flowmol.data_processing.priors import coupled_node_prior, edge_prior
+from flowmol.data_processing.priors import coupled_node_prior
+from flowmol.data_processing.prealign import prior_cache_dir, cache_prior_config, open_prior_cache
 
 # create a function named collate that takes a list of samples from the dataset and combines them into a batch
 # this might not be necessary. I think we can pass the argument collate_fn=dgl.batch to the DataLoader
@@ -64,6 +65,35 @@ class MoleculeDataset(torch.utils.data.Dataset):
         self.node_idx_array = data_dict['node_idx_array']
         self.edge_idx_array = data_dict['edge_idx_array']
 
+        # if requested, use prior draws that were OT-aligned offline by prealign.py
+        self.prealigned = dataset_config.get('prealigned', False)
+        self.epoch = 0
+        self.prior_cache = None
+        if self.prealigned:
+            self.prior_cache_dir = prior_cache_dir(processed_data_dir, split)
+            if not (self.prior_cache_dir / 'params.json').exists():
+                raise FileNotFoundError(f'prealigned is set but no complete prior cache was found at {self.prior_cache_dir}, run prealign.py first')
+            cache_params, _ = open_prior_cache(self.prior_cache_dir)
+            if cache_params['n_atoms'] != self.positions.shape[0] or cache_params['n_mols'] != len(self):
+                raise ValueError(f'prior cache at {self.prior_cache_dir} does not match the processed {split} data')
+            if cache_params['prior_config'] != cache_prior_config(self.prior_config):
+                raise ValueError(f'prior cache at {self.prior_cache_dir} was computed with a different prior config')
+            self.n_prior_draws = cache_params['n_draws']
+
+        # priors that are not coupled to the molecule are sampled for the whole batch on the training device by FlowMol.sample_prior,
+        # so node priors are only sampled here when they have to be aligned to the molecule
+        self.align_node_prior = any(self.prior_config[feat]['align'] for feat in ['x', 'a', 'c'])
+
+    def set_epoch(self, epoch: int):
+        """Sets the epoch, which determines which of the cached prior draws is used for each molecule."""
+        self.epoch = epoch
+
+    def __getstate__(self):
+        # memory-mapped arrays are reopened in each dataloader worker rather than copied into it
+        state = self.__dict__.copy()
+        state['prior_cache'] = None
+        return state
+
     def __len__(self):
         return self.node_idx_array.shape[0]
     
@@ -122,20 +152,24 @@ class MoleculeDataset(torch.utils.data.Dataset):
         g.ndata['a_1_true'] = atom_types
         g.ndata['c_1_true'] = atom_charges
 
+        if not (self.prealigned or self.align_node_prior):
+            return g
+
         # sample prior for node features, coupled to the destination features
         dst_dict = {
             'x': positions,
             'a': atom_types,
             'c': atom_charges
         }
-        prior_node_feats = coupled_node_prior(dst_dict=dst_dict, prior_config=self.prior_config)
+        if self.prealigned:
+            if self.prior_cache is None:
+                _, self.prior_cache = open_prior_cache(self.prior_cache_dir)
+            draw_idx = self.epoch % self.n_prior_draws
+            prior_node_feats = {feat: torch.from_numpy(self.prior_cache[feat][draw_idx, node_start_idx:node_end_idx].copy()) for feat in dst_dict}
+        else:
+            prior_node_feats = coupled_node_prior(dst_dict=dst_dict, prior_config=self.prior_config)
         for feat in prior_node_feats:
             g.ndata[f'{feat}_0'] = prior_node_feats[feat]
 
-        # sample the prior for the edge features    
-        upper_edge_mask = torch.zeros(g.num_edges(), dtype=torch.bool)
-        n_upper_edges = upper_edge_idxs.shape[1]
-        upper_edge_mask[:n_upper_edges] = True
-        g.edata['e_0'] = edge_prior(upper_edge_mask, self.prior_config['e'])
-
+        # the edge prior is never coupled to the molecule, it is sampled for the whole batch by FlowMol.sample_prior
         return g
\ No newline at end of file
@@ -1,4 +1,5 @@
-from typing import Dict, List
+from typing import Dict, List, Iterable, Tuple
+from functools import partial
 import torch
 from torch.nn.functional import one_hot
 from rdkit import Chem
@@ -54,22 +55,50 @@ class MoleculeFeaturizer():
                     all_bond_order_counts += bond_order_counts
 
         # find molecules that failed to featurize and count them
-        num_failed = 0
-        failed_idxs = []
-        for i in range(len(all_positions)):
-            if all_positions[i] is None:
-                num_failed += 1
-                failed_idxs.append(i)
+        keep = [positions is not None for positions in all_positions]
+        num_failed = len(keep) - sum(keep)
 
         # remove failed molecules
-        all_positions = [pos for i, pos in enumerate(all_positions) if i not in failed_idxs]
-        all_atom_types = [atom for i, atom in enumerate(all_atom_types) if i not in failed_idxs]
-        all_atom_charges = [charge for i, charge in enumerate(all_atom_charges) if i not in failed_idxs]
-        all_bond_types = [bond for i, bond in enumerate(all_bond_types) if i not in failed_idxs]
-        all_bond_idxs = [idx for i, idx in enumerate(all_bond_idxs) if i not in failed_idxs]
+        all_positions = [pos for pos, k in zip(all_positions, keep) if k]
+        all_atom_types = [atom for atom, k in zip(all_atom_types, keep) if k]
+        all_atom_charges = [charge for charge, k in zip(all_atom_charges, keep) if k]
+        all_bond_types = [bond for bond, k in zip(all_bond_types, keep) if k]
+        all_bond_idxs = [idx for idx, k in zip(all_bond_idxs, keep) if k]
 
         return all_positions, all_atom_types, all_atom_charges, all_bond_types, all_bond_idxs, num_failed, all_bond_order_counts
 
+    def featurize_stream(self, indexed_molecules: Iterable[Tuple[int, Chem.rdchem.Mol]], chunksize: int = 1000):
+        """Featurize a stream of (index, molecule) pairs, yielding (index, features) pairs as they finish.
+
+        Results are yielded in completion order, not input order, which is why every molecule carries its index.
+        Features are returned as numpy arrays (see featurize_indexed_molecule) and are None for molecules that failed.
+        """
+        worker_fn = partial(featurize_indexed_molecule, atom_map_dict=self.atom_map_dict)
+        if self.pool is None:
+            yield from map(worker_fn, indexed_molecules)
+        else:
+            yield from self.pool.imap_unordered(worker_fn, indexed_molecules, chunksize=chunksize)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def featurize_indexed_molecule(indexed_molecule: Tuple[int, Chem.rdchem.Mol], atom_map_dict: Dict[str, int]):
+    """Worker function for MoleculeFeaturizer.featurize_stream.
+
+    Tensors are converted to numpy arrays before being sent back to the parent process. Sending torch tensors through
+    a multiprocessing queue moves each of them into shared memory and holds a file descriptor per tensor, which runs out
+    quickly when millions of small per-molecule tensors are in flight.
+    """
+    idx, molecule = indexed_molecule
+    features = featurize_molecule(molecule, atom_map_dict)
+    if features[0] is None:
+        return idx, None
+    return idx, tuple(feat.numpy() for feat in features)
+
 
 
 def featurize_molecule(molecule: Chem.rdchem.Mol, atom_map_dict: Dict[str, int], explicit_hydrogens=True):
@@ -1,81 +1,164 @@
 import argparse
+import json
 from pathlib import Path
+import numpy as np
 import yaml
 import torch
 from multiprocessing import Pool
+from tqdm import tqdm
 
-from flowmol.data_processing.dataset import MoleculeDataset
+from flowmol.data_processing.priors import coupled_node_prior
 
-# I created this script because I was planning on doing pre-alignment. That is, for every molecule in the dataset, 
-# this script would sample the prior and compute the OT-alignment between the prior and the molecule.
-# however, i think that this is not necessary, and that the alignment can be computed on the fly during training.
-# leaving this script here for now, but it is not used in the current implementation.
-# this script is also not complete, and would need to be modified to work with the current implementation.
+# pre-alignment moves the optimal transport coupling between the prior and the data out of the training loop.
+# for every molecule in a split, this script samples n_draws prior draws for the node features, aligns each of them to the molecule
+# (assignment + rigid alignment for positions, assignment for categorical features), and writes them to memory-mapped arrays.
+# when the dataset config sets prealigned: true, MoleculeDataset reads one of these draws per epoch instead of solving the assignment online.
 
-def parse_args():
-    p = argparse.ArgumentParser(description='Training Script')
-    p.add_argument('--config', type=Path, default=None)
-    p.add_argument('--split', type=str, default=None)
+node_feats = ['x', 'a', 'c']
 
-    # TODO: make these arguments do something
+def parse_args():
+    p = argparse.ArgumentParser(description='Precompute OT-aligned prior draws')
+    p.add_argument('--config', type=Path, required=True)
+    p.add_argument('--split', type=str, default=None, help='split to align, all splits are aligned if not specified')
+    p.add_argument('--n_draws', type=int, default=8, help='number of aligned prior draws to store for each molecule')
+    p.add_argument('--chunk_size', type=int, default=1000, help='number of molecules aligned by a worker at a time')
     p.add_argument('--n_cpus', type=int, default=1)
-
     p.add_argument('--seed', type=int, default=42)
 
-def align_split(split: str, config: dict, n_cpus: int):
-
-    dataset_config = config['dataset']
-    processed_data_dir: Path = Path(dataset_config['processed_data_dir'])
-    data_file = processed_data_dir / f'{split}_data_processed.pt'
-
-    # load data from processed data directory
-    data_dict = torch.load(data_file)
-
-    # positions = data_dict['positions']
-    # atom_types = data_dict['atom_types']
-    # atom_charges = data_dict['atom_charges']
-    # bond_types = data_dict['bond_types']
-    # bond_idxs = data_dict['bond_idxs']
-    node_idx_array = data_dict['node_idx_array']
-    # edge_idx_array = data_dict['edge_idx_array']
-
-    n_atoms = node_idx_array[:, 1] - node_idx_array[:, 0]
-    n_atoms = n_atoms.tolist()
-    positions_split = torch.split(data_dict['positions'], n_atoms)
-    atom_types_split = torch.split(data_dict['atom_types'], n_atoms)
-    atom_charges_split = torch.split(data_dict['atom_charges'], n_atoms)
-
-
-    # construct arguments for computing optimal transport prior for each molecule
-    compute_ot_args = []
-    for dataset_idx, (mol_pos, mol_types, mol_charges) in enumerate(zip(positions_split, atom_types_split, atom_charges_split)):
+    return p.parse_args()
+
+def prior_cache_dir(processed_data_dir: Path, split: str) -> Path:
+    return Path(processed_data_dir) / f'{split}_prior_cache'
+
+def cache_prior_config(prior_config: dict) -> dict:
+    """Returns the parts of the node prior config that determine the cached draws, without the marginal distributions
+    that MoleculeDataset adds at runtime (those are fixed by the processed dataset)."""
+    cache_config = {}
+    for feat in node_feats:
+        feat_config = prior_config[feat]
+        kwargs = {k: v for k, v in feat_config['kwargs'].items() if not isinstance(v, torch.Tensor)}
+        cache_config[feat] = {'type': feat_config['type'], 'align': feat_config['align'], 'kwargs': kwargs}
+    return cache_config
+
+def open_prior_cache(cache_dir: Path, mode: str = 'r'):
+    """Opens the memory-mapped prior draws in cache_dir. Returns the cache parameters and a dict mapping each node feature
+    to an array of shape (n_draws, n_atoms_total, n_feats)."""
+    with open(cache_dir / 'params.json', 'r') as f:
+        params = json.load(f)
+    arrays = {feat: np.load(cache_dir / f'{feat}.npy', mmap_mode=mode) for feat in node_feats}
+    return params, arrays
+
+# state shared by all chunks aligned in one worker process, set by init_worker
+worker_state = {}
+
+def init_worker(cache_dir: Path, prior_config: dict, positions, atom_types, atom_charges, node_idx_array, seed: int):
+    worker_state['arrays'] = {feat: np.load(cache_dir / f'{feat}.npy', mmap_mode='r+') for feat in node_feats}
+    worker_state['prior_config'] = prior_config
+    worker_state['positions'] = positions
+    worker_state['atom_types'] = atom_types
+    worker_state['atom_charges'] = atom_charges
+    worker_state['node_idx_array'] = node_idx_array
+    worker_state['seed'] = seed
+
+    # each worker aligns single molecules, so intra-op parallelism only adds contention between workers
+    torch.set_num_threads(1)
+
+def align_chunk(chunk: tuple):
+    """Samples and aligns the prior draws for molecules start_idx to end_idx and writes them into the cache."""
+    chunk_idx, start_idx, end_idx = chunk
+    arrays = worker_state['arrays']
+    node_idx_array = worker_state['node_idx_array']
+    n_draws = arrays['x'].shape[0]
+
+    # seed every chunk separately so the cache does not depend on how chunks are distributed over workers
+    torch.manual_seed(worker_state['seed'] + chunk_idx)
+
+    for mol_idx in range(start_idx, end_idx):
+        node_start_idx, node_end_idx = node_idx_array[mol_idx].tolist()
+
+        # these match the destination features constructed in MoleculeDataset.__getitem__
+        positions = worker_state['positions'][node_start_idx:node_end_idx]
+        positions = positions - positions.mean(dim=0, keepdim=True)
+        atom_charges = worker_state['atom_charges'][node_start_idx:node_end_idx].long()
         dst_dict = {
-            'x': mol_pos,
-            'a': mol_types,
-            'c': mol_charges
+            'x': positions,
+            'a': worker_state['atom_types'][node_start_idx:node_end_idx].float(),
+            'c': torch.nn.functional.one_hot(atom_charges + 2, num_classes=6).float()
         }
-        compute_ot_args.append((dst_dict, dataset_idx))
 
+        for draw_idx in range(n_draws):
+            prior_feats = coupled_node_prior(dst_dict=dst_dict, prior_config=worker_state['prior_config'])
+            for feat in node_feats:
+                arrays[feat][draw_idx, node_start_idx:node_end_idx] = prior_feats[feat].numpy()
+
+    for feat in node_feats:
+        arrays[feat].flush()
+
+    return end_idx - start_idx
+
+def align_split(split: str, config: dict, n_draws: int, chunk_size: int, n_cpus: int, seed: int):
+
+    # build the dataset so that the prior config is filled in with the marginal distributions exactly as it is during training
+    # (imported here because dataset.py imports this module to read the cache)
+    from flowmol.data_processing.dataset import MoleculeDataset
+    dataset_config = dict(config['dataset'])
+    dataset_config['prealigned'] = False
+    dataset = MoleculeDataset(split, dataset_config, prior_config=config['mol_fm']['prior_config'])
+    prior_config = dataset.prior_config
+
+    if not any(prior_config[feat]['align'] for feat in node_feats):
+        print('WARNING: no node feature has align: true in the prior config, the cached draws will not be aligned')
+
+    n_mols = len(dataset)
+    n_atoms_total = dataset.positions.shape[0]
+
+    # sample one prior to get the dimension of each node feature
+    node_start_idx, node_end_idx = dataset.node_idx_array[0].tolist()
+    example_dst = {
+        'x': dataset.positions[node_start_idx:node_end_idx],
+        'a': dataset.atom_types[node_start_idx:node_end_idx].float(),
+        'c': torch.nn.functional.one_hot(dataset.atom_charges[node_start_idx:node_end_idx].long() + 2, num_classes=6).float()
+    }
+    example_prior = coupled_node_prior(dst_dict=example_dst, prior_config=prior_config)
+
+    # params.json is written last, MoleculeDataset only uses a cache once it exists
+    cache_dir = prior_cache_dir(dataset.processed_data_dir, split)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    params_file = cache_dir / 'params.json'
+    params_file.unlink(missing_ok=True)
+
+    # allocate the memory-mapped arrays, workers write directly into them
+    params = {
+        'n_draws': n_draws,
+        'n_mols': n_mols,
+        'n_atoms': n_atoms_total,
+        'seed': seed,
+        'prior_config': cache_prior_config(prior_config),
+    }
+    for feat in node_feats:
+        n_feats = example_prior[feat].shape[1]
+        np.lib.format.open_memmap(cache_dir / f'{feat}.npy', mode='w+', dtype=np.float32, shape=(n_draws, n_atoms_total, n_feats))
+
+    chunks = [(chunk_idx, start_idx, min(start_idx + chunk_size, n_mols)) for chunk_idx, start_idx in enumerate(range(0, n_mols, chunk_size))]
+    worker_args = (cache_dir, prior_config, dataset.positions, dataset.atom_types, dataset.atom_charges, dataset.node_idx_array, seed)
+
+    pbar = tqdm(total=n_mols, desc=f'Aligning {split} priors')
     if n_cpus == 1:
-        results = [compute_ot_prior(*args) for args in compute_ot_args]
+        init_worker(*worker_args)
+        for chunk in chunks:
+            pbar.update(align_chunk(chunk))
     else:
-        with Pool(n_cpus) as pool:
-            results = pool.starmap(compute_ot_prior, compute_ot_args)
-
-def compute_ot_prior(dst_dict, dataset_idx):
-    prior_dict = {}
-    cat_features = ['a', 'c']
+        with Pool(n_cpus, initializer=init_worker, initargs=worker_args) as pool:
+            for n_aligned in pool.imap_unordered(align_chunk, chunks):
+                pbar.update(n_aligned)
+    pbar.close()
 
-    for feat in dst_dict.keys():
-
-        # get destination features (t=1)
-        dst_feat = dst_dict[feat]
+    with open(params_file, 'w') as f:
+        json.dump(params, f)
 
 if __name__ == "__main__":
     args = parse_args()
 
-    # TODO: set seed
-
     if args.split is None:
         splits = ['train', 'val', 'test']
     else:
@@ -85,5 +168,4 @@ if __name__ == "__main__":
         config = yaml.load(f, Loader=yaml.FullLoader)
 
     for split in splits:
-        align_split(split, config, args.n_cpus)
-
+        align_split(split, config, args.n_draws, args.chunk_size, args.n_cpus, args.seed)
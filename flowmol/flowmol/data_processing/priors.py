@@ -5,29 +5,29 @@ from torch.nn.functional import softmax, one_hot
 import dgl
 from flowmol.utils.dirflow import simplex_proj
 
-def gaussian(n: int, d: int, std: float = 1.0, simplex_center: bool = False):
+def gaussian(n: int, d: int, std: float = 1.0, simplex_center: bool = False, device=None):
     """
     Generate a prior feature by sampling from a Gaussian distribution.
     """
-    p = torch.randn(n, d) * std
+    p = torch.randn(n, d, device=device) * std
     
     if simplex_center:
         p = p + 1/d
     return p
 
 
-def centered_normal_prior(n: int, d: int, std: float = 4.0):
+def centered_normal_prior(n: int, d: int, std: float = 4.0, device=None):
     """
     Generate a prior feature by sampling from a centered normal distribution.
     """
-    prior_feat = torch.randn(n, d) * std
+    prior_feat = torch.randn(n, d, device=device) * std
     prior_feat = prior_feat - prior_feat.mean(dim=0, keepdim=True)
     return prior_feat
 
 def centered_normal_prior_batched_graph(g: dgl.DGLGraph, node_batch_idx: torch.Tensor, std: float = 4.0):
 
     n = g.num_nodes()
-    prior_sample = torch.randn(n, 3, device=g.device)
+    prior_sample = torch.randn(n, 3, device=g.device) * std
     with g.local_scope():
         g.ndata['prior_sample'] = prior_sample
         prior_sample = prior_sample - dgl.readout_nodes(g, feat='prior_sample', op='mean')[node_batch_idx]
@@ -36,9 +36,9 @@ def centered_normal_prior_batched_graph(g: dgl.DGLGraph, node_batch_idx: torch.T
     
 
 
-def barycenter_prior(n: int, d: int, blur: float = 0.0):
+def barycenter_prior(n: int, d: int, blur: float = 0.0, device=None):
 
-    p = torch.ones(n,d) / d
+    p = torch.ones(n, d, device=device) / d
 
     if blur != 0.0:
         p = p + torch.randn_like(p) * blur
@@ -47,30 +47,33 @@ def barycenter_prior(n: int, d: int, blur: float = 0.0):
     return p
 
 
-def biased_simplex_prior(n, d, vertex_prob: float = 0.75, std: float = 0.2, vertex_idx: int = 0):
+def biased_simplex_prior(n, d, vertex_prob: float = 0.75, std: float = 0.2, vertex_idx: int = 0, device=None):
     """
     Generate samples from a simplex which are biased towards one category.
     """
     non_zero_weight = (1 - vertex_prob) / (d - 1)
-    mu = torch.ones(d)*non_zero_weight
+    mu = torch.ones(d, device=device)*non_zero_weight
     mu[vertex_idx] = vertex_prob
-    simplex_sample = mu.unsqueeze(0) + torch.randn(n, d)*std
+    simplex_sample = mu.unsqueeze(0) + torch.randn(n, d, device=device)*std
     simplex_sample = softmax(simplex_sample/(1/d), dim=1)
     return simplex_sample
 
-def uniform_simplex_prior(n, d):
+def uniform_simplex_prior(n, d, device=None):
     """
     Generate samples from a uniform distribution on a simplex.
     """
-    exp_dist = Exponential(torch.tensor(1.0))
+    exp_dist = Exponential(torch.tensor(1.0, device=device))
     sample = exp_dist.sample((n, d))
     sample = sample / sample.sum(dim=1, keepdim=True)
     return sample
 
-def sample_marginal(n: int, d: int, p: torch.Tensor, blur: float = None):
+def sample_marginal(n: int, d: int, p: torch.Tensor, blur: float = None, device=None):
     """
     Sample from the marginal distribution of a categorical variable.
     """
+    if device is not None and p.device != torch.device(device):
+        p = p.to(device)
+
     prior_idxs = torch.multinomial(p, n, replacement=True)
     prior_one_hot = one_hot(prior_idxs, num_classes=d).float()
 
@@ -80,9 +83,10 @@ def sample_marginal(n: int, d: int, p: torch.Tensor, blur: float = None):
 
     return prior_one_hot
 
-def sample_p_c_given_a(n: int, d: int, atom_types: torch.Tensor, p_c_given_a: torch.Tensor, blur: float = None):
+def sample_p_c_given_a(n: int, d: int, atom_types: torch.Tensor, p_c_given_a: torch.Tensor, blur: float = None, device=None):
     """
     Sample from the conditional distribution of charges given atom type, p(c|a).
+    Samples are placed on the device of atom_types.
     """
     if p_c_given_a.device != atom_types.device:
         p_c_given_a = p_c_given_a.to(atom_types.device)
@@ -98,11 +102,11 @@ def sample_p_c_given_a(n: int, d: int, atom_types: torch.Tensor, p_c_given_a: to
 
     return charge_simplex
 
-def ctmc_masked_prior(n: int, d: int):
+def ctmc_masked_prior(n: int, d: int, device=None):
     """
     Sample from a CTMC masked prior. All samples are assigned the mask token at t=0.
     """
-    p = torch.full((n,), fill_value=d)
+    p = torch.full((n,), fill_value=d, device=device)
     p = one_hot(p, num_classes=d+1).float()
     return p
 
@@ -303,12 +307,15 @@ def coupled_node_prior(dst_dict: dict,
     return prior_dict
 
 def edge_prior(upper_edge_mask: torch.Tensor, edge_prior_config: dict):
-
+    """
+    Sample the prior for the upper triangle edges and copy it to the corresponding lower triangle edges.
+    The prior is sampled on the device of upper_edge_mask, so this works on a single molecule or on a batched graph.
+    """
     n_upper_edges = upper_edge_mask.sum().item()
     prior_fn = train_prior_register[edge_prior_config['type']]
-    upper_edge_prior = prior_fn(n_upper_edges, 5, **edge_prior_config['kwargs'])
+    upper_edge_prior = prior_fn(n_upper_edges, 5, **edge_prior_config['kwargs'], device=upper_edge_mask.device)
 
-    edge_prior = torch.zeros(upper_edge_mask.shape[0], upper_edge_prior.shape[1])
+    edge_prior = torch.empty(upper_edge_mask.shape[0], upper_edge_prior.shape[1], device=upper_edge_mask.device)
     edge_prior[upper_edge_mask] = upper_edge_prior
     edge_prior[~upper_edge_mask] = upper_edge_prior
     return edge_prior
\ No newline at end of file
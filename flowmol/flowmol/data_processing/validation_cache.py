@@ -0,0 +1,50 @@
+from typing import Callable, List
+import torch
+import dgl
+
+from flowmol.data_processing.utils import get_batch_idxs, get_upper_edge_mask
+
+
+class ValidationCache(torch.utils.data.Dataset):
+    """A fixed subset of a dataset, prebatched once so that every validation pass sees exactly the same batches.
+
+    Molecules are selected and their dataset priors (including any OT-aligned couplings) are drawn under a fixed seed
+    when the cache is built. The priors that are sampled per batch by the model are drawn once by prepare(),
+    which also moves the batches to the training device where they stay for the rest of training.
+    Each item of this dataset is a whole batch, so it should be loaded with batch_size=None.
+    """
+
+    def __init__(self, dataset: torch.utils.data.Dataset, n_mols: int, batch_size: int, seed: int = 0):
+        super().__init__()
+        self.seed = seed
+        self.prepared = False
+
+        n_mols = min(n_mols, len(dataset))
+        # only the cpu generator draws the indices, so no cuda device is forked
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            mol_idxs = torch.randperm(len(dataset))[:n_mols].tolist()
+            graphs = [dataset[idx] for idx in mol_idxs]
+
+        self.batches: List[dgl.DGLGraph] = [dgl.batch(graphs[i:i+batch_size]) for i in range(0, n_mols, batch_size)]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, idx):
+        return self.batches[idx]
+
+    def prepare(self, sample_prior_fn: Callable, device: torch.device):
+        """Moves the batches to device and draws their remaining priors with sample_prior_fn(g, node_batch_idx, upper_edge_mask)."""
+        if self.prepared:
+            return
+
+        fork_devices = [device] if device.type == 'cuda' else []
+        with torch.random.fork_rng(devices=fork_devices):
+            torch.manual_seed(self.seed)
+            for batch_idx, g in enumerate(self.batches):
+                g = g.to(device)
+                node_batch_idx, _ = get_batch_idxs(g)
+                self.batches[batch_idx] = sample_prior_fn(g, node_batch_idx, get_upper_edge_mask(g))
+
+        self.prepared = True
@@ -57,10 +57,16 @@ def data_module_from_config(config: dict) -> MoleculeDataModule:
     else:
         distributed = False
 
+    # optionally validate on a fixed, cached subset of the validation set
+    evaluation_config = config['training']['evaluation']
+
     data_module = MoleculeDataModule(dataset_config=config['dataset'],
                                      dm_prior_config=config['mol_fm']['prior_config'],
                                      batch_size=batch_size, 
                                      num_workers=num_workers, 
-                                     distributed=distributed)
+                                     distributed=distributed,
+                                     val_cache_size=evaluation_config.get('val_cache_size'),
+                                     val_cache_seed=evaluation_config.get('val_cache_seed', 0),
+                                     device_resident=config['training'].get('device_resident', False))
     
     return data_module
\ No newline at end of file
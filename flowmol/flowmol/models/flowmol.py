@@ -12,6 +12,8 @@ from flowmol.models.lr_scheduler import LRScheduler
 from flowmol.models.interpolant_scheduler import InterpolantScheduler
 from flowmol.models.vector_field import EndpointVectorField, VectorField, DirichletVectorField
 from flowmol.models.ctmc_vector_field import CTMCVectorField
+from flowmol.models.metric_accumulator import MetricAccumulator
+from flowmol.utils.precision import autocast_context
 
 from flowmol.data_processing.utils import build_edge_idxs, get_upper_edge_mask, get_batch_idxs
 from flowmol.data_processing.priors import uniform_simplex_prior, biased_simplex_prior, batched_rigid_alignment, rigid_alignment
@@ -45,6 +47,7 @@ class FlowMol(pl.LightningModule):
                  vector_field_config: dict = {},
                  prior_config: dict = {},
                  default_n_timesteps: int = 250,
+                 metric_log_interval: int = 50, # how many training steps to accumulate losses over before averaging them across processes and logging
                  ):
         super().__init__()
 
@@ -146,6 +149,11 @@ class FlowMol(pl.LightningModule):
         # align the validation losses with the correspoding training epoch value on W&B
         self.last_epoch_exact = 0
 
+        # losses are accumulated on the device and reduced across processes in one collective
+        self.metric_log_interval = metric_log_interval
+        self.train_metrics = MetricAccumulator()
+        self.val_metrics = MetricAccumulator()
+
         self.save_hyperparameters()
 
     def configure_prior(self):
@@ -235,44 +243,77 @@ class FlowMol(pl.LightningModule):
         # compute losses
         losses = self(g)
 
-        # create a dictionary of values to log
-        train_log_dict = {}
-        train_log_dict['epoch_exact'] = epoch_exact
-
-        for key in losses:
-            train_log_dict[f'{key}_train_loss'] = losses[key]
-
         total_loss = torch.zeros(1, device=g.device, requires_grad=True)
         for feat in self.canonical_feat_order:
             total_loss = total_loss + self.total_loss_weights[feat]*losses[feat]
 
-        self.log_dict(train_log_dict, sync_dist=True)
-        self.log('train_total_loss', total_loss, prog_bar=True, on_step=True, sync_dist=True)
+        # accumulate the losses, they are averaged across processes and logged every metric_log_interval steps
+        train_metrics = {f'{key}_train_loss': losses[key] for key in losses}
+        train_metrics['train_total_loss'] = total_loss
+        self.train_metrics.update(train_metrics)
+        if self.train_metrics.n_updates >= self.metric_log_interval:
+            self.log_accumulated_metrics(self.train_metrics, prog_bar_key='train_total_loss')
+
+        self.log('epoch_exact', epoch_exact)
 
         return total_loss
+
+    def reduce_across_processes(self, x: torch.Tensor) -> torch.Tensor:
+        return self.trainer.strategy.reduce(x, reduce_op='sum')
+
+    def log_accumulated_metrics(self, accumulator: MetricAccumulator, prog_bar_key: str):
+        # every process calls this at the same step, the reduction is a single all-reduce
+        metrics = accumulator.reduce(self.reduce_across_processes)
+        prog_bar_value = metrics.pop(prog_bar_key)
+        self.log_dict(metrics)
+        self.log(prog_bar_key, prog_bar_value, prog_bar=True)
+
+    def on_train_epoch_end(self):
+        # log the losses accumulated since the last reduction
+        if self.train_metrics.n_updates > 0:
+            self.log_accumulated_metrics(self.train_metrics, prog_bar_key='train_total_loss')
+
+    def on_train_epoch_start(self):
+        # datasets with prealigned prior draws use a different draw every epoch
+        datamodule = getattr(self.trainer, 'datamodule', None)
+        train_dataset = getattr(datamodule, 'train_dataset', None)
+        if hasattr(train_dataset, 'set_epoch'):
+            train_dataset.set_epoch(self.current_epoch)
     
+    def on_validation_start(self):
+        # a cached validation set has its priors drawn once and is kept on this device
+        datamodule = getattr(self.trainer, 'datamodule', None)
+        self.val_cache = getattr(datamodule, 'val_cache', None)
+        if self.val_cache is not None:
+            self.val_cache.prepare(self.sample_prior, self.device)
+
     def validation_step(self, g: dgl.DGLGraph, batch_idx: int):
         # compute losses
-        losses = self(g)
-
-        # create dictionary of values to log
-        val_log_dict = {
-            'epoch_exact': self.last_epoch_exact
-        }
-
-        for key in losses:
-            val_log_dict[f'{key}_val_loss'] = losses[key]
-
-        self.log_dict(val_log_dict, batch_size=g.batch_size, sync_dist=True)
+        if getattr(self, 'val_cache', None) is not None:
+            # seed each cached batch so that timesteps and conditional paths are the same on every validation pass
+            fork_devices = [g.device] if g.device.type == 'cuda' else []
+            with torch.random.fork_rng(devices=fork_devices):
+                torch.manual_seed(self.val_cache.seed + batch_idx)
+                losses = self(g)
+        else:
+            losses = self(g)
 
         # combine individual losses into a total loss
         total_loss = torch.zeros(1, device=g.device, requires_grad=False)
         for feat in self.canonical_feat_order:
             total_loss = total_loss + self.total_loss_weights[feat]*losses[feat]
 
-        self.log('val_total_loss', total_loss, prog_bar=True, batch_size=g.batch_size, on_step=True, sync_dist=True)
+        # accumulate the losses weighted by batch size, they are reduced across processes once at the end of validation
+        val_metrics = {f'{key}_val_loss': losses[key] for key in losses}
+        val_metrics['val_total_loss'] = total_loss
+        self.val_metrics.update(val_metrics, weight=g.batch_size)
 
         return total_loss
+
+    def on_validation_epoch_end(self):
+        if self.val_metrics.n_updates > 0:
+            self.log_accumulated_metrics(self.val_metrics, prog_bar_key='val_total_loss')
+        self.log('epoch_exact', self.last_epoch_exact)
     
     def forward(self, g: dgl.DGLGraph):
         
@@ -299,10 +340,10 @@ class FlowMol(pl.LightningModule):
         # g.ndata['x_1_true'] = g.ndata['x_1_true'] - init_coms[node_batch_idx]
 
         # sample molecules from prior
-        # we used to sample the prior in the forward pass at training time,
-        # but now at training time we sample the prior in the __getitem__ method of MoleculeDataset
-        # this is so that we can compute OT alignments in parallel (since they cannot be done in batch)
-        # g = self.sample_prior(g, node_batch_idx, upper_edge_mask)
+        # priors that are OT-aligned to the molecule are sampled in the __getitem__ method of MoleculeDataset
+        # (or read from a prealigned cache), since alignments cannot be done in batch.
+        # all other priors, including the edge prior, are sampled here for the whole batch on the training device
+        g = self.sample_prior(g, node_batch_idx, upper_edge_mask)
 
         # sample timepoints for each molecule in the batch
         t = torch.rand(batch_size, device=device).float()
@@ -389,7 +430,7 @@ class FlowMol(pl.LightningModule):
         return losses
     
     def sample_prior(self, g, node_batch_idx: torch.Tensor, upper_edge_mask: torch.Tensor):
-        """Sample from the prior distribution of the ligand."""
+        """Sample from the prior distribution of the ligand. Features which already have a prior sample in g are left untouched."""
         # sample atom positions from prior
         # TODO: we should set the standard deviation of atom position prior to be like the average distance to the COM in the training set
         # or perhaps the average distance to COM for molecules with the same number of atoms
@@ -399,6 +440,9 @@ class FlowMol(pl.LightningModule):
         
         # sample the prior for node features
         for feat in self.node_feats:
+            if f'{feat}_0' in g.ndata:
+                continue
+
             prior_type = self.prior_config[feat]['type']
             prior_fn = inference_prior_register[prior_type]
             # I tried to design consistent interface for prior functions, but it's not perfect
@@ -412,10 +456,13 @@ class FlowMol(pl.LightningModule):
                 args.append(g.ndata['a_0'])
 
             kwargs = self.prior_config[feat]['kwargs']
-            g.ndata[f'{feat}_0'] = prior_fn(*args, **kwargs).to(device)
+            if feat != 'x':
+                kwargs = {**kwargs, 'device': device}
+            g.ndata[f'{feat}_0'] = prior_fn(*args, **kwargs)
 
         # sample the prior for edge features
-        g.edata['e_0'] = edge_prior(upper_edge_mask, self.prior_config['e']).to(device)
+        if 'e_0' not in g.edata:
+            g.edata['e_0'] = edge_prior(upper_edge_mask, self.prior_config['e'])
             
         return g
     
@@ -460,21 +507,51 @@ class FlowMol(pl.LightningModule):
 
     @torch.no_grad()
     def sample(self, n_atoms: torch.Tensor, n_timesteps: int = None, device="cuda:0",
-        stochasticity=None, high_confidence_threshold=None, xt_traj=False, ep_traj=False, **kwargs):
+        stochasticity=None, high_confidence_threshold=None, xt_traj=False, ep_traj=False, precision: str = '32', **kwargs):
         """Sample molecules with the given number of atoms.
         
         Args:
             n_atoms (torch.Tensor): Tensor of shape (batch_size,) containing the number of atoms in each molecule.
+            precision (str): '32', 'bf16-mixed' or '16-mixed', the precision the vector field is evaluated in during integration.
         """
-        if n_timesteps is None:
-            n_timesteps = self.default_n_timesteps
-
         if xt_traj or ep_traj:
             visualize = True
         else:
             visualize = False
 
-        batch_size = n_atoms.shape[0]
+        g, traj_frames = self.sample_batched_graph(n_atoms,
+            n_timesteps=n_timesteps,
+            device=device,
+            stochasticity=stochasticity,
+            high_confidence_threshold=high_confidence_threshold,
+            visualize=visualize,
+            precision=precision, **kwargs)
+
+        molecules = []
+        for mol_idx, g_i in enumerate(dgl.unbatch(g)):
+
+            args = [g_i, self.atom_type_map]
+            if visualize:
+                args.append(traj_frames[mol_idx])
+
+            molecules.append(SampledMolecule(*args, 
+                ctmc_mol=self.parameterization == 'ctmc', 
+                build_xt_traj=xt_traj,
+                build_ep_traj=ep_traj,
+                exclude_charges=self.exclude_charges))
+
+        return molecules
+
+    @torch.no_grad()
+    def sample_batched_graph(self, n_atoms: torch.Tensor, n_timesteps: int = None, device="cuda:0",
+        stochasticity=None, high_confidence_threshold=None, visualize=False, precision: str = '32', **kwargs):
+        """Integrates a batch of molecules with the given number of atoms, without converting them to SampledMolecule objects.
+
+        Returns the batched graph on the cpu, with the sampled features stored as x_1, a_1, c_1, e_1 and the upper edge mask as ue_mask,
+        and the trajectory frames of each molecule if visualize is True (otherwise None).
+        """
+        if n_timesteps is None:
+            n_timesteps = self.default_n_timesteps
 
         # get the edge indicies for each unique number of atoms
         edge_idxs_dict = {}
@@ -511,33 +588,15 @@ class FlowMol(pl.LightningModule):
             integrate_kwargs['stochasticity'] = stochasticity
             integrate_kwargs['high_confidence_threshold'] = high_confidence_threshold
 
-        itg_result = self.vector_field.integrate(g, node_batch_idx, **integrate_kwargs, **kwargs)
+        with autocast_context(device, precision):
+            itg_result = self.vector_field.integrate(g, node_batch_idx, **integrate_kwargs, **kwargs)
 
         if visualize:
             g, traj_frames = itg_result
         else:
-            g = itg_result
+            g, traj_frames = itg_result, None
 
         g.edata['ue_mask'] = upper_edge_mask
         g = g.to('cpu')
 
-        if self.parameterization == 'ctmc':
-            ctmc_mol = True
-        else:
-            ctmc_mol = False
-
-
-        molecules = []
-        for mol_idx, g_i in enumerate(dgl.unbatch(g)):
-
-            args = [g_i, self.atom_type_map]
-            if visualize:
-                args.append(traj_frames[mol_idx])
-
-            molecules.append(SampledMolecule(*args, 
-                ctmc_mol=ctmc_mol, 
-                build_xt_traj=xt_traj,
-                build_ep_traj=ep_traj,
-                exclude_charges=self.exclude_charges))
-
-        return molecules
+        return g, traj_frames
@@ -14,8 +14,11 @@ def _norm_no_nan(x, axis=-1, keepdims=False, eps=1e-8, sqrt=True):
     L2 norm of tensor clamped above a minimum value `eps`.
     
     :param sqrt: if `False`, returns the square of the L2 norm
+
+    The norm is always computed and returned in fp32, because under mixed precision the square overflows in fp16
+    and eps underflows to zero.
     '''
-    out = torch.clamp(torch.sum(torch.square(x), axis, keepdims), min=eps)
+    out = torch.clamp(torch.sum(torch.square(x.float()), axis, keepdims), min=eps)
     return torch.sqrt(out) if sqrt else out
 
 # the classes GVP, GVPDropout, and GVPLayerNorm are taken from lucidrains' geometric-vector-perceptron repository
@@ -30,7 +33,10 @@ def _rbf(D, D_min=0., D_max=20., D_count=16):
     Returns an RBF embedding of `torch.Tensor` `D` along a new axis=-1.
     That is, if `D` has shape [...dims], then the returned tensor will have
     shape [...dims, D_count].
+
+    The embedding is computed in fp32 regardless of the dtype of `D`.
     '''
+    D = D.float()
     device = D.device
     D_mu = torch.linspace(D_min, D_max, D_count, device=device)
     D_mu = D_mu.view([1, -1])
@@ -182,7 +188,7 @@ class GVPDropout(nn.Module):
 
 
 class GVPLayerNorm(nn.Module):
-    """ Normal layer norm for scalars, nontrainable norm for vectors. """
+    """ Normal layer norm for scalars, nontrainable norm for vectors. Both are computed in fp32 under mixed precision. """
     def __init__(self, feats_h_size, eps = 1e-5):
         super().__init__()
         self.eps = eps
@@ -194,7 +200,7 @@ class GVPLayerNorm(nn.Module):
 
         vn = _norm_no_nan(vectors, axis=-1, keepdims=True, sqrt=False)
         vn = torch.sqrt(torch.mean(vn, dim=-2, keepdim=True) + self.eps ) + self.eps
-        normed_vectors = vectors / vn
+        normed_vectors = vectors.float() / vn
         return normed_feats, normed_vectors
     
 
@@ -374,4 +380,6 @@ class GVPConv(nn.Module):
 
         scalar_message, vector_message = self.edge_message((scalar_feats, vec_feats))
 
-        return {"scalar_msg": scalar_message, "vec_msg": vector_message}
+        # under autocast the messages come out of the GVPs in reduced precision,
+        # they are aggregated in fp32 so that sums over many edges do not lose precision
+        return {"scalar_msg": scalar_message.float(), "vec_msg": vector_message.float()}
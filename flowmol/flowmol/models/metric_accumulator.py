@@ -0,0 +1,54 @@
+from typing import Callable, Dict, List
+import torch
+
+
+class MetricAccumulator:
+    """Accumulates scalar metrics on the device and averages them across processes in a single collective.
+
+    Logging every metric with sync_dist=True launches one all-reduce per metric per step. Instead, metrics are summed
+    locally with update() and reduce() packs the sums and the total weight into one tensor, so that one all-reduce
+    covers every metric since the last reduction.
+    """
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.sums: torch.Tensor = None
+        self.total_weight: torch.Tensor = None
+        self.n_updates = 0
+
+    def update(self, metrics: Dict[str, torch.Tensor], weight: float = 1.0):
+        """Adds a weighted set of scalar metrics. Every update must contain the same metrics."""
+        if self.sums is None:
+            self.names = list(metrics.keys())
+            device = next(iter(metrics.values())).device
+            self.sums = torch.zeros(len(self.names), device=device)
+            self.total_weight = torch.zeros(1, device=device)
+        elif list(metrics.keys()) != self.names:
+            raise ValueError(f'expected metrics {self.names}, got {list(metrics.keys())}')
+
+        values = torch.stack([metrics[name].detach().float().reshape(()) for name in self.names])
+        self.sums += values*weight
+        self.total_weight += weight
+        self.n_updates += 1
+
+    def reduce(self, reduce_fn: Callable[[torch.Tensor], torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """Returns the weighted mean of every metric since the last reduction and resets the accumulator.
+
+        Args:
+            reduce_fn: sums a tensor across processes, e.g. lambda x: trainer.strategy.reduce(x, reduce_op='sum').
+                If None, only the metrics of this process are averaged.
+        """
+        if self.sums is None:
+            return {}
+
+        packed = torch.cat([self.sums, self.total_weight])
+        if reduce_fn is not None:
+            packed = reduce_fn(packed)
+
+        means = packed[:-1] / packed[-1]
+        reduced = {name: means[idx] for idx, name in enumerate(self.names)}
+
+        self.sums = None
+        self.total_weight = None
+        self.n_updates = 0
+        return reduced
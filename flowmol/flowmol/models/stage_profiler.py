@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import time
+from collections import defaultdict
+from functools import wraps
+from typing import Dict, List, Tuple, TYPE_CHECKING
+
+import torch
+import torch.nn as nn
+import pytorch_lightning as pl
+
+from flowmol.models.gvp import GVPConv
+from flowmol.models.vector_field import NodePositionUpdate, EdgeUpdate
+
+if TYPE_CHECKING:
+    from flowmol.models.flowmol import FlowMol
+
+
+class StageProfiler(pl.Callback):
+    """Records a per-stage breakdown of training step time and logs it through the Lightning logger.
+
+    Every log_interval training steps, the following stages are timed:
+        - data_wait: time between the end of the previous training step and the start of this one (data loading and transfer)
+        - sample_conditional_path: construction of the interpolated molecules
+        - every GVPConv, NodePositionUpdate and EdgeUpdate module in the vector field, by module name
+        - loss/<feat>: the loss function of each feature
+        - training_step: the whole training step, including the backward pass and optimizer step
+    For each stage we log the wall time, the CUDA time and the peak CUDA memory. Molecules sampled for evaluation inside a
+    profiled step are timed as one sample_molecules stage and do not count toward the other stages.
+
+    Hooks are only attached for the duration of profiled steps, so other steps pay nothing beyond two time.perf_counter calls.
+    Note that CUDA timings synchronize the device and peak memory statistics are reset per stage during profiled steps.
+    """
+
+    def __init__(self, log_interval: int = 100, cuda_timing: bool = True):
+        super().__init__()
+        self.log_interval = log_interval
+        self.cuda_timing = cuda_timing
+
+        self.last_batch_end = None
+        self.active = False
+        self.paused = False
+        self.hook_handles = []
+        self.patched_methods: List[Tuple[object, str]] = []
+        self.open_stages = {}
+        self.stage_stats: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def use_cuda(self, pl_module: pl.LightningModule) -> bool:
+        return self.cuda_timing and pl_module.device.type == 'cuda'
+
+    def start_stage(self, name: str, use_cuda: bool):
+        if self.paused:
+            return
+        if use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        else:
+            start_event = None
+        self.open_stages[name] = (time.perf_counter(), start_event)
+
+    def end_stage(self, name: str, use_cuda: bool):
+        if self.paused or name not in self.open_stages:
+            return
+        wall_start, start_event = self.open_stages.pop(name)
+        stats = self.stage_stats[name]
+        if use_cuda:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+            end_event.synchronize()
+            stats['cuda_ms'] += start_event.elapsed_time(end_event)
+            stats['peak_mem_mb'] = max(stats['peak_mem_mb'], torch.cuda.max_memory_allocated() / 2**20)
+        stats['wall_ms'] += (time.perf_counter() - wall_start) * 1000
+        stats['calls'] += 1
+
+    def attach(self, pl_module: FlowMol):
+        use_cuda = self.use_cuda(pl_module)
+
+        # forward hooks on the modules that make up the vector field
+        for name, module in pl_module.vector_field.named_modules():
+            if isinstance(module, (GVPConv, NodePositionUpdate, EdgeUpdate)):
+                self.add_module_hooks(module, name, use_cuda)
+
+        # loss functions are created lazily on the first forward pass
+        for feat, loss_fn in getattr(pl_module, 'loss_fn_dict', {}).items():
+            self.add_module_hooks(loss_fn, f'loss/{feat}', use_cuda)
+
+        # methods that are not modules are wrapped for the duration of the step
+        self.patch_method(pl_module.vector_field, 'sample_conditional_path', 'sample_conditional_path', use_cuda)
+        self.patch_method(pl_module, 'sample_random_sizes', 'sample_molecules', use_cuda, pause=True)
+
+    def add_module_hooks(self, module: nn.Module, name: str, use_cuda: bool):
+        pre_hook = lambda module, args: self.start_stage(name, use_cuda)
+        post_hook = lambda module, args, output: self.end_stage(name, use_cuda)
+        self.hook_handles.append(module.register_forward_pre_hook(pre_hook))
+        self.hook_handles.append(module.register_forward_hook(post_hook))
+
+    def patch_method(self, obj, method_name: str, stage_name: str, use_cuda: bool, pause: bool = False):
+        method = getattr(obj, method_name)
+
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            self.start_stage(stage_name, use_cuda)
+            # stages inside a paused method are not recorded separately
+            self.paused = pause
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.paused = False
+                self.end_stage(stage_name, use_cuda)
+
+        # setting the attribute on the instance shadows the method defined on the class
+        setattr(obj, method_name, timed_method)
+        self.patched_methods.append((obj, method_name))
+
+    def detach(self):
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+        for obj, method_name in self.patched_methods:
+            delattr(obj, method_name)
+        self.patched_methods = []
+        self.open_stages = {}
+
+    def on_train_batch_start(self, trainer: pl.Trainer, pl_module: FlowMol, batch, batch_idx: int):
+        batch_start = time.perf_counter()
+        self.active = trainer.global_step % self.log_interval == 0
+        if not self.active:
+            return
+
+        self.stage_stats.clear()
+        if self.last_batch_end is not None:
+            self.stage_stats['data_wait']['wall_ms'] = (batch_start - self.last_batch_end) * 1000
+            self.stage_stats['data_wait']['calls'] = 1
+
+        self.attach(pl_module)
+        self.start_stage('training_step', self.use_cuda(pl_module))
+
+    def on_train_batch_end(self, trainer: pl.Trainer, pl_module: FlowMol, outputs, batch, batch_idx: int):
+        if self.active:
+            use_cuda = self.use_cuda(pl_module)
+            self.end_stage('training_step', use_cuda)
+            self.detach()
+            self.active = False
+
+            # peak memory statistics are reset at the start of every stage, so the peak of the whole step is the largest stage peak
+            if use_cuda:
+                self.stage_stats['training_step']['peak_mem_mb'] = max(stats.get('peak_mem_mb', 0.0) for stats in self.stage_stats.values())
+
+            log_dict = {}
+            for stage, stats in self.stage_stats.items():
+                for stat_name, value in stats.items():
+                    log_dict[f'profile/{stage}/{stat_name}'] = float(value)
+            pl_module.log_dict(log_dict, on_step=True, on_epoch=False)
+
+        self.last_batch_end = time.perf_counter()
+
+    def on_validation_start(self, trainer: pl.Trainer, pl_module: FlowMol):
+        # the time spent in validation is not data wait
+        self.last_batch_end = None
+
+    def on_train_epoch_start(self, trainer: pl.Trainer, pl_module: FlowMol):
+        self.last_batch_end = None
@@ -1,8 +1,9 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import dgl
 import dgl.function as fn
-from typing import Union, Callable
+from typing import Dict, Union, Callable
 import scipy
 
 from flowmol.models.gvp import GVPConv, GVP, _rbf, _norm_no_nan
@@ -33,6 +34,8 @@ class EndpointVectorField(nn.Module):
                     exclude_charges: bool = False,
                     continuous_inv_temp_schedule = None,
                     continuous_inv_temp_max: float = 10.0,
+                    activation_checkpointing: str = None,
+                    activation_memory_budget_mb: float = None,
                     has_mask: bool = False # if we are using CTMC, input categorical features will have mask tokens,
                     # this means their one-hot representations will have an extra dimension,
                     # and the neural network instantiated by this method need to account for this
@@ -65,6 +68,16 @@ class EndpointVectorField(nn.Module):
 
         assert n_vec_channels >= 3, 'n_vec_channels must be >= 3'
 
+        # activation checkpointing recomputes blocks during the backward pass instead of storing their activations
+        # None: no checkpointing, 'convs': every GVPConv, 'updaters': every position and edge updater, 'all': both,
+        # 'auto': per batch, checkpoint the fewest block types needed to keep the estimated activations under activation_memory_budget_mb
+        if activation_checkpointing not in [None, 'convs', 'updaters', 'all', 'auto']:
+            raise ValueError(f'Invalid activation_checkpointing: {activation_checkpointing}')
+        if activation_checkpointing == 'auto' and activation_memory_budget_mb is None:
+            raise ValueError('activation_memory_budget_mb must be set when activation_checkpointing is auto')
+        self.activation_checkpointing = activation_checkpointing
+        self.activation_memory_budget_mb = activation_memory_budget_mb
+
         self.continuous_inv_temp_schedule = continuous_inv_temp_schedule
         self.continouts_inv_temp_max = continuous_inv_temp_max
         self.continuous_inv_temp_func = self.build_continuous_inv_temp_func(self.continuous_inv_temp_schedule, self.continouts_inv_temp_max) 
@@ -179,11 +192,12 @@ class EndpointVectorField(nn.Module):
             edge_features = self.edge_embedding(edge_features)
 
             x_diff, d = self.precompute_distances(g)
+            checkpoint_convs, checkpoint_updaters = self.checkpoint_plan(num_nodes, g.num_edges())
             for recycle_idx in range(self.n_recycles):
                 for conv_idx, conv in enumerate(self.conv_layers):
 
                     # perform a single convolution which updates node scalar and vector features (but not positions)
-                    node_scalar_features, node_vec_features = conv(g, 
+                    node_scalar_features, node_vec_features = self.run_block(conv, checkpoint_convs, g, 
                             scalar_feats=node_scalar_features, 
                             coord_feats=node_positions,
                             vec_feats=node_vec_features,
@@ -200,11 +214,11 @@ class EndpointVectorField(nn.Module):
                         else:
                             updater_idx = 0
 
-                        node_positions = self.node_position_updaters[updater_idx](node_scalar_features, node_positions, node_vec_features)
+                        node_positions = self.run_block(self.node_position_updaters[updater_idx], checkpoint_updaters, node_scalar_features, node_positions, node_vec_features)
 
                         x_diff, d = self.precompute_distances(g, node_positions)
 
-                        edge_features = self.edge_updaters[updater_idx](g, node_scalar_features, edge_features, d=d)
+                        edge_features = self.run_block(self.edge_updaters[updater_idx], checkpoint_updaters, g, node_scalar_features, edge_features, d=d)
 
             
             # predict final charges and atom type logits
@@ -233,6 +247,10 @@ class EndpointVectorField(nn.Module):
         if not self.exclude_charges:
             dst_dict['c'] = atom_charge_logits
 
+        # under mixed precision the output heads produce reduced precision tensors,
+        # predictions are returned in fp32 so that losses and integration steps are unaffected
+        dst_dict = {feat: val.float() for feat, val in dst_dict.items()}
+
         # apply softmax to categorical features, if requested
         # at training time, we don't want to apply softmax because we use cross-entropy loss which includes softmax
         # at inference time, we want to apply softmax to get a vector which lies on the simplex
@@ -243,6 +261,57 @@ class EndpointVectorField(nn.Module):
 
         return dst_dict
     
+    def run_block(self, module: nn.Module, use_checkpoint: bool, *args, **kwargs):
+        if use_checkpoint:
+            return checkpoint(module, *args, use_reentrant=False, **kwargs)
+        return module(*args, **kwargs)
+
+    def estimate_activation_mb(self, n_nodes: int, n_edges: int) -> Dict[str, float]:
+        """Rough estimate of the activations stored for the backward pass by all convolutions and all updaters in one forward pass.
+
+        Counts the inputs, hidden vectors, norms and outputs of every GVP and the hidden layers of the edge updaters, in fp32.
+        This is an estimate meant for choosing what to checkpoint, not an exact account of memory usage.
+        """
+        def gvp_elements(gvp: GVP) -> int:
+            dim_h = gvp.Wu.shape[0] # hidden vectors, including cross-product features
+            dim_feats_out = gvp.to_feats_out[0].out_features
+            return gvp.dim_feats_in + 3*gvp.dim_vectors_in + 4*dim_h + 2*dim_feats_out + 4*gvp.dim_vectors_out
+
+        conv_elements = 0
+        for conv in self.conv_layers:
+            conv_elements += n_edges*sum(gvp_elements(gvp) for gvp in conv.edge_message)
+            conv_elements += n_nodes*sum(gvp_elements(gvp) for gvp in conv.node_update)
+
+        # the updaters run after every convs_per_update convolutions, except after the first one
+        n_updates = sum(1 for conv_idx in range(len(self.conv_layers)) if conv_idx != 0 and (conv_idx + 1) % self.convs_per_update == 0)
+        position_updater, edge_updater = self.node_position_updaters[0], self.edge_updaters[0]
+        updater_elements = n_nodes*sum(gvp_elements(gvp) for gvp in position_updater.gvps)
+        updater_elements += n_edges*(edge_updater.edge_update_fn[0].in_features + 5*self.n_hidden_edge_feats)
+        updater_elements *= n_updates
+
+        return {
+            'convs': conv_elements*self.n_recycles*4 / 2**20,
+            'updaters': updater_elements*self.n_recycles*4 / 2**20,
+        }
+
+    def checkpoint_plan(self, n_nodes: int, n_edges: int):
+        """Returns whether to checkpoint the convolutions and the updaters for a batch of this size."""
+        mode = self.activation_checkpointing
+        if mode is None or not (self.training and torch.is_grad_enabled()):
+            return False, False
+        if mode != 'auto':
+            return mode in ['convs', 'all'], mode in ['updaters', 'all']
+
+        # checkpoint the block type that stores the most activations first, then both if that is not enough
+        activation_mb = self.estimate_activation_mb(n_nodes, n_edges)
+        total_mb = sum(activation_mb.values())
+        if total_mb <= self.activation_memory_budget_mb:
+            return False, False
+        largest = max(activation_mb, key=activation_mb.get)
+        if total_mb - activation_mb[largest] <= self.activation_memory_budget_mb:
+            return largest == 'convs', largest == 'updaters'
+        return True, True
+
     def precompute_distances(self, g: dgl.DGLGraph, node_positions=None):
         """Precompute the pairwise distances between all nodes in the graph."""
 
@@ -517,6 +586,7 @@ class DirichletVectorField(EndpointVectorField):
     def __init__(self, *args, w_max=32, **kwargs):
         super().__init__(*args, **kwargs)
         self.w_max = w_max
+        # the tables behind these flows are loaded from an on-disk cache the first time they are needed
         self.categorical_condflows = {}
         self.categorical_condflows['a'] = DirichletConditionalFlow(K=self.n_atom_types, alpha_min=0, alpha_max=w_max+2, alpha_spacing=0.01)
         self.categorical_condflows['c'] = DirichletConditionalFlow(K=self.n_charges, alpha_min=0, alpha_max=w_max+2, alpha_spacing=0.01)
@@ -602,16 +672,11 @@ class DirichletVectorField(EndpointVectorField):
             w_s_feat = w_s[feat_idx]
             x_t = g.ndata[f'{feat}_t'] # has shape (n_nodes, n_cat)
 
-            c_factor = self.categorical_condflows[feat].c_factor(
-                x_t.cpu().numpy(),
-                w_t_feat.item()
-            )
             # c_factor has shape equal to x_t, which is (n_nodes, n_cat)
-            c_factor = torch.from_numpy(c_factor).to(g.device).float()
-            if torch.isnan(c_factor).any():
-                # print(f'NAN cfactor after: xt.min(): {xt.min()}, out_probs.min(): {out_probs.min()}')
-                print('NAN c_factor')
-                c_factor = torch.nan_to_num(c_factor)
+            # it is computed on the device, nan values are zeroed without checking for them to avoid a host sync.
+            # infinite values are kept as they are, torch.nan_to_num would clamp them
+            c_factor = self.categorical_condflows[feat].c_factor(x_t, w_t_feat)
+            c_factor = torch.where(torch.isnan(c_factor), 0, c_factor)
 
             # get possible endpoints as one-hot vectors
             eps = torch.eye(self.n_cat_dict[feat], device=g.device) # shape (n_cat, n_cat)
@@ -639,15 +704,8 @@ class DirichletVectorField(EndpointVectorField):
         w_t_e = w_t[e_idx]
         w_s_e = w_s[e_idx]
         x_t = g.edata['e_t'][upper_edge_mask] # has shape (n_edges, n_cat)
-        c_factor = self.categorical_condflows['e'].c_factor(
-            x_t.cpu().numpy(),
-            w_t_e.item()
-        )
-        c_factor = torch.from_numpy(c_factor).to(g.device).float()
-        if torch.isnan(c_factor).any():
-            # print(f'NAN cfactor after: xt.min(): {xt.min()}, out_probs.min(): {out_probs.min()}')
-            print('NAN c_factor')
-            c_factor = torch.nan_to_num(c_factor)
+        c_factor = self.categorical_condflows['e'].c_factor(x_t, w_t_e)
+        c_factor = torch.where(torch.isnan(c_factor), 0, c_factor)
         # get possible endpoints as one-hot vectors
         eps = torch.eye(self.n_cat_dict['e'], device=g.device) # shape (n_cat, n_cat)
 
@@ -1,29 +1,93 @@
 import torch
-from typing import List
-
-def compute_p_c_given_a(atom_charges: torch.Tensor, atom_types: torch.Tensor, atom_type_map: List[str]) -> torch.Tensor:
-    """Computes the conditional distribution of charges given atom type, p(c|a)."""
-    charge_idx_to_val = torch.arange(-2,4)
-    charge_val_to_idx = {int(val): idx for idx, val in enumerate(charge_idx_to_val)}
-    
-    n_atom_types = len(atom_type_map)
-    n_charges = len(charge_idx_to_val)
-
-    # convert atom types from one-hots to indices
-    atom_types = atom_types.float().argmax(dim=1)
-
-    # create a tensor to store the conditional distribution of charges given atom type, p(c|a)
-    p_c_given_a = torch.zeros(n_atom_types, n_charges, dtype=torch.float32)
-
-
-    for atom_idx in range(n_atom_types):
-        atom_type_mask = atom_types == atom_idx # mask for atoms with the current atom type
-        unique_charges, charge_counts = torch.unique(atom_charges[atom_type_mask], return_counts=True)
-        for unique_charge, charge_count in zip(unique_charges, charge_counts):
-            charge_idx = charge_val_to_idx[int(unique_charge)]
-            p_c_given_a[atom_idx, charge_idx] = charge_count
-
-    row_sum = p_c_given_a.sum(dim=1, keepdim=True)
-    row_sum[row_sum == 0] = 1.0e-8
-    p_c_given_a = p_c_given_a / row_sum
-    return p_c_given_a
\ No newline at end of file
+
+
+class MarginalDistAccumulator:
+    """Accumulates the counts needed for the marginal distributions and the n_atoms histogram of a dataset.
+
+    Counts can be accumulated one chunk of molecules at a time and accumulators built on different chunks
+    can be merged. Because only integer counts are kept, the merged result is exactly what a single pass
+    over the whole dataset would give.
+    """
+
+    n_charges = 6
+    n_bond_types = 5
+    min_charge = -2
+
+    def __init__(self, n_atom_types: int):
+        self.n_atom_types = n_atom_types
+        self.charge_given_atom_counts = torch.zeros(n_atom_types, self.n_charges, dtype=torch.int64)
+        self.bond_order_counts = torch.zeros(self.n_bond_types, dtype=torch.int64)
+        self.n_atoms_counts = torch.zeros(0, dtype=torch.int64) # n_atoms_counts[n] is the number of molecules with n atoms
+
+    def update(self, atom_types: torch.Tensor, atom_charges: torch.Tensor, n_atoms: torch.Tensor, bond_order_counts: torch.Tensor):
+        """Adds a chunk of molecules to the counts.
+
+        Args:
+            atom_types: one-hot atom types of every atom in the chunk, shape (n_atoms_total, n_atom_types)
+            atom_charges: integer formal charges of every atom in the chunk, shape (n_atoms_total,)
+            n_atoms: number of atoms in each molecule of the chunk, shape (n_molecules,)
+            bond_order_counts: counts of each bond order (including unbonded pairs) in the chunk, shape (5,)
+        """
+        atom_type_idxs = atom_types.long().argmax(dim=1)
+        charge_idxs = atom_charges.long() - self.min_charge
+        if charge_idxs.numel() > 0 and (charge_idxs.min() < 0 or charge_idxs.max() >= self.n_charges):
+            raise ValueError(f'atom charges must lie in [{self.min_charge}, {self.min_charge + self.n_charges - 1}]')
+
+        flat_idxs = atom_type_idxs*self.n_charges + charge_idxs
+        self.charge_given_atom_counts += torch.bincount(flat_idxs, minlength=self.n_atom_types*self.n_charges).view(self.n_atom_types, self.n_charges)
+        self.bond_order_counts += bond_order_counts.long()
+        self._add_n_atoms_counts(torch.bincount(n_atoms.long()))
+
+    def merge(self, other: 'MarginalDistAccumulator'):
+        """Adds the counts of another accumulator to this one."""
+        if other.n_atom_types != self.n_atom_types:
+            raise ValueError('cannot merge accumulators with different numbers of atom types')
+        self.charge_given_atom_counts += other.charge_given_atom_counts
+        self.bond_order_counts += other.bond_order_counts
+        self._add_n_atoms_counts(other.n_atoms_counts)
+        return self
+
+    def _add_n_atoms_counts(self, n_atoms_counts: torch.Tensor):
+        size = max(self.n_atoms_counts.shape[0], n_atoms_counts.shape[0])
+        merged = torch.zeros(size, dtype=torch.int64)
+        merged[:self.n_atoms_counts.shape[0]] += self.n_atoms_counts
+        merged[:n_atoms_counts.shape[0]] += n_atoms_counts
+        self.n_atoms_counts = merged
+
+    def marginal_dists(self):
+        """Returns p(a), p(c), p(e) and p(c|a), in the format written to the marginal dists file."""
+        atom_type_counts = self.charge_given_atom_counts.sum(dim=1)
+        p_a = atom_type_counts / atom_type_counts.sum()
+
+        charge_counts = self.charge_given_atom_counts.sum(dim=0).float()
+        p_c = charge_counts / charge_counts.sum()
+
+        p_e = self.bond_order_counts / self.bond_order_counts.sum()
+
+        p_c_given_a = self.charge_given_atom_counts.float()
+        row_sum = p_c_given_a.sum(dim=1, keepdim=True)
+        row_sum[row_sum == 0] = 1.0e-8
+        p_c_given_a = p_c_given_a / row_sum
+
+        return p_a, p_c, p_e, p_c_given_a
+
+    def n_atoms_histogram(self):
+        """Returns the observed numbers of atoms and their counts, in the format written to the n_atoms histogram file."""
+        n_atoms = torch.nonzero(self.n_atoms_counts).flatten()
+        return n_atoms, self.n_atoms_counts[n_atoms]
+
+    def state_dict(self) -> dict:
+        return {
+            'n_atom_types': self.n_atom_types,
+            'charge_given_atom_counts': self.charge_given_atom_counts,
+            'bond_order_counts': self.bond_order_counts,
+            'n_atoms_counts': self.n_atoms_counts,
+        }
+
+    @classmethod
+    def from_state_dict(cls, state_dict: dict) -> 'MarginalDistAccumulator':
+        accumulator = cls(state_dict['n_atom_types'])
+        accumulator.charge_given_atom_counts = state_dict['charge_given_atom_counts'].clone()
+        accumulator.bond_order_counts = state_dict['bond_order_counts'].clone()
+        accumulator.n_atoms_counts = state_dict['n_atoms_counts'].clone()
+        return accumulator
@@ -1,36 +1,110 @@
+import math
+import os
+from pathlib import Path
+
 import torch
 import numpy as np
 import scipy
+import scipy.special
 
 # this code is adapted from the DirichiletFlow paper
 
+def table_cache_dir() -> Path:
+    """Directory where conditional flow tables are cached, set with the FLOWMOL_CACHE_DIR environment variable."""
+    cache_dir = os.environ.get('FLOWMOL_CACHE_DIR', Path.home() / '.cache' / 'flowmol')
+    return Path(cache_dir) / 'dirichlet_tables'
+
+def interp(x: torch.Tensor, xp: torch.Tensor, fp: torch.Tensor) -> torch.Tensor:
+    """Batched equivalent of np.interp for increasing xp, values of x outside of xp are clamped to the end points of fp."""
+    idx = torch.searchsorted(xp, x.contiguous(), right=True).clamp(1, xp.shape[0] - 1)
+    x_lo, x_hi = xp[idx - 1], xp[idx]
+    f_lo, f_hi = fp[idx - 1], fp[idx]
+    weight = ((x - x_lo) / (x_hi - x_lo)).clamp(0, 1)
+    return f_lo + weight*(f_hi - f_lo)
+
 class DirichletConditionalFlow:
+    """Tables of the regularized incomplete beta function needed for the Dirichlet FM vector field.
+
+    The tables are computed once per (K, alpha range, spacing) and cached on disk, see table_cache_dir(). They are loaded
+    on the first call to c_factor and copied to each device that c_factor is called on, so that c_factor runs entirely on
+    that device without synchronizing with the host.
+    """
+
     def __init__(self, K=20, alpha_min=1, alpha_max=100, alpha_spacing=0.01):
-        self.alphas = np.arange(alpha_min, alpha_max + alpha_spacing, alpha_spacing)
-        self.beta_cdfs = []
-        self.bs = np.linspace(0, 1, 1000)
-        for alph in self.alphas:
-            self.beta_cdfs.append(scipy.special.betainc(alph, K-1, self.bs))
-        self.beta_cdfs = np.array(self.beta_cdfs)
-        self.beta_cdfs_derivative = np.diff(self.beta_cdfs, axis=0) / alpha_spacing
         self.K = K
+        self.alpha_min = alpha_min
+        self.alpha_max = alpha_max
+        self.alpha_spacing = alpha_spacing
+        self.n_bs = 1000
+
+        # tables are loaded on first use, then kept per device
+        self.tables = None
+        self.device_tables = {}
+
+    def cache_file(self) -> Path:
+        return table_cache_dir() / f'K={self.K}_alpha={self.alpha_min}-{self.alpha_max}_spacing={self.alpha_spacing}_nbs={self.n_bs}.npz'
+
+    def compute_tables(self):
+        alphas = np.arange(self.alpha_min, self.alpha_max + self.alpha_spacing, self.alpha_spacing)
+        bs = np.linspace(0, 1, self.n_bs)
+        beta_cdfs = scipy.special.betainc(alphas[:, None], self.K-1, bs[None, :])
+        beta_cdfs_derivative = np.diff(beta_cdfs, axis=0) / self.alpha_spacing
+        return dict(alphas=alphas, bs=bs, beta_cdfs=beta_cdfs, beta_cdfs_derivative=beta_cdfs_derivative)
+
+    def load_tables(self):
+        cache_file = self.cache_file()
+        if cache_file.exists():
+            with np.load(cache_file) as f:
+                self.tables = {key: f[key] for key in f.files}
+            return
+
+        self.tables = self.compute_tables()
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file and rename it so that concurrent processes never read a partial table
+            tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp.npz')
+            np.savez(tmp_file, **self.tables)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print(f'WARNING: could not cache dirichlet flow tables to {cache_file}: {e}')
+
+    def get_device_tables(self, device: torch.device):
+        if device not in self.device_tables:
+            if self.tables is None:
+                self.load_tables()
+            self.device_tables[device] = {
+                key: torch.from_numpy(self.tables[key]).to(device) for key in ['alphas', 'bs', 'beta_cdfs_derivative']
+            }
+        return self.device_tables[device]
+
+    def c_factor(self, bs: torch.Tensor, alpha: torch.Tensor) -> torch.Tensor:
+        """Computes the c factor of the conditional vector field for points bs on the simplex, shape (n, K), at alpha.
+
+        alpha may be a python float or a scalar tensor; the computation is done in float64 on the device of bs and
+        the result is returned with the dtype of bs.
+        """
+        tables = self.get_device_tables(bs.device)
+        x = bs.double()
+        alpha = torch.as_tensor(alpha, dtype=torch.float64, device=bs.device)
 
-    def c_factor(self, bs, alpha):
-        out1 = scipy.special.beta(alpha, self.K - 1)
+        # beta function B(alpha, K-1) through log-gamma functions
+        out1 = torch.exp(torch.lgamma(alpha) + math.lgamma(self.K - 1) - torch.lgamma(alpha + self.K - 1))
 
-        denom = (1 - bs) ** (self.K - 1)
-        really_small_mask = np.isclose(denom, 0, atol=1.0e-8)
-        out2 = np.where(~really_small_mask, out1 / denom, 0)
+        denom = (1 - x) ** (self.K - 1)
+        really_small_mask = denom.abs() <= 1.0e-8
+        out2 = torch.where(~really_small_mask, out1 / denom, torch.zeros_like(denom))
 
-        denom = bs**(alpha - 1)
-        really_small_mask = np.isclose(denom, 0, atol=1.0e-8)
-        out = np.where(~really_small_mask, out2 /denom, 0)
+        denom = x**(alpha - 1)
+        really_small_mask = denom.abs() <= 1.0e-8
+        out = torch.where(~really_small_mask, out2 / denom, torch.zeros_like(denom))
 
-        I_func = self.beta_cdfs_derivative[np.argmin(np.abs(alpha - self.alphas))]
-        interp = -np.interp(bs, self.bs, I_func)
-        final = interp * out
+        # the derivative table has one row fewer than there are alphas
+        alpha_idx = torch.argmin(torch.abs(alpha - tables['alphas'])).clamp(max=tables['beta_cdfs_derivative'].shape[0] - 1)
+        I_func = tables['beta_cdfs_derivative'][alpha_idx]
+        interp_vals = -interp(x.flatten(), tables['bs'], I_func).view(x.shape)
+        final = interp_vals * out
 
-        return final
+        return final.to(bs.dtype)
 
 def simplex_proj(x):
     """Algorithm from https://arxiv.org/abs/1309.1541 Weiran Wang, Miguel Á. Carreira-Perpiñán"""
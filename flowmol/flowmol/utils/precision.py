@@ -0,0 +1,25 @@
+import contextlib
+import torch
+
+# precision settings use the names accepted by pytorch lightning's Trainer(precision=...)
+autocast_dtypes = {
+    '32': None,
+    '32-true': None,
+    'bf16-mixed': torch.bfloat16,
+    '16-mixed': torch.float16,
+}
+
+def autocast_context(device, precision: str = '32'):
+    """Returns a context manager that runs the enclosed computation under autocast for the given precision setting.
+
+    Parameters and the integrated molecule state stay in fp32; only the operations autocast selects (matmuls, einsums, linear layers)
+    run in reduced precision. Norms, RBF embeddings, layer norms and message aggregation in GVPConv are kept in fp32.
+    """
+    precision = str(precision)
+    if precision not in autocast_dtypes:
+        raise ValueError(f'precision must be one of {list(autocast_dtypes.keys())}, got {precision}')
+
+    dtype = autocast_dtypes[precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
@@ -1,36 +1,41 @@
 import argparse
 import atexit
 import json
+import os
 import pickle
+import shutil
 import signal
 import sys
+from collections import defaultdict
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 import numpy as np
 import torch
 import tqdm
 import yaml
 from rdkit import Chem
-from multiprocessing import Pool
 
 from flowmol.data_processing.geom import MoleculeFeaturizer
-from flowmol.utils.dataset_stats import compute_p_c_given_a
-
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+from flowmol.utils.dataset_stats import MarginalDistAccumulator
+from flowmol.analysis.smiles_index import SmilesIndex
 
 def get_exit_handler(running_file: Path):
     def exit_handler(*args, **kwargs):
-        running_file.unlink()
+        running_file.unlink(missing_ok=True)
     return exit_handler
 
+def get_signal_handler(running_file: Path):
+    def signal_handler(*args, **kwargs):
+        running_file.unlink(missing_ok=True)
+        sys.exit(1)
+    return signal_handler
+
 def setup_exit_handler(running_file: Path):
 
     if running_file.exists():
         print(f"Running file {running_file} already exists. Exiting.")
+        print(f"If no other job is processing this split, delete the running file and rerun to resume from the last completed shard.")
         sys.exit(0)
 
     # create running file
@@ -39,9 +44,9 @@ def setup_exit_handler(running_file: Path):
     # remove running file when script exits
     atexit.register(get_exit_handler(running_file))
 
-    # register exit handler on SIGTERM signal using signal module
-    signal.signal(signal.SIGTERM, get_exit_handler(running_file))
-    signal.signal(signal.SIGINT, get_exit_handler(running_file))
+    # remove running file and exit on SIGTERM/SIGINT
+    signal.signal(signal.SIGTERM, get_signal_handler(running_file))
+    signal.signal(signal.SIGINT, get_signal_handler(running_file))
 
 def parse_args():
     """Parse command line arguments using argparse."""
@@ -50,37 +55,169 @@ def parse_args():
     p.add_argument('split_file', type=Path, help='path to split file')
     p.add_argument('--config', type=Path, help='config file path')
 
-    p.add_argument('--start_idx', type=int, default=0, help='start index')
-    p.add_argument('--end_idx', type=int, default=np.inf, help='end index')
+    p.add_argument('--start_idx', type=int, default=0, help='index of the first conformer to process')
+    p.add_argument('--end_idx', type=int, default=None, help='index one past the last conformer to process, defaults to the end of the split')
 
-    p.add_argument('--n_cpus', type=int, default=1, help='number of cpus to use when computing partial charges for confomers')
-    p.add_argument('--chunk_size', type=int, default=100, help='number of molecules to process at a time')
+    p.add_argument('--n_cpus', type=int, default=1, help='number of cpus to use when featurizing conformers')
+    p.add_argument('--chunk_size', type=int, default=1000, help='number of conformers sent to a worker process at a time')
 
-    p.add_argument('--overwrite', action='store_true', help='overwrite existing files')
-    p.add_argument('--save_interval', type=int, default=5, help='number of molecules after which to save processed data')
-
-    # p.add_argument('--dataset_size', type=int, default=None, help='number of molecules in dataset, only used to truncate dataset for debugging')
+    p.add_argument('--overwrite', action='store_true', help='discard shards from a previous run instead of resuming from them')
+    p.add_argument('--save_interval', type=int, default=10000, help='number of conformers in each shard written to disk')
 
     args = p.parse_args()
 
     # check that start_idx is before end_idx
-    if args.start_idx >= args.end_idx:
+    if args.end_idx is not None and args.start_idx >= args.end_idx:
         raise ValueError(f"start_idx must be less than end_idx")
 
+    if args.save_interval <= 0 or args.chunk_size <= 0:
+        raise ValueError(f"save_interval and chunk_size must be positive")
+
     return args
 
 
-if __name__ == "__main__":
+def indexed_conformers(raw_data: list, n_confs_per_mol: np.ndarray, start_idx: int, end_idx: int, shard_size: int, completed_shards: set):
+    """Yields (conformer_idx, conformer) for every conformer in [start_idx, end_idx) that is not in a completed shard."""
+    mol_conf_starts = np.concatenate([[0], np.cumsum(n_confs_per_mol)[:-1]])
+    for mol_idx, molecule_chunk in enumerate(raw_data):
+        conf_start = int(mol_conf_starts[mol_idx])
+        n_confs_this_mol = int(n_confs_per_mol[mol_idx])
+
+        # skip molecules whose conformers all lie outside of the requested range
+        if conf_start + n_confs_this_mol <= start_idx:
+            continue
+        if conf_start >= end_idx:
+            break
+
+        for conf_offset, conformer in enumerate(molecule_chunk[1][:n_confs_this_mol]):
+            conformer_idx = conf_start + conf_offset
+            if conformer_idx < start_idx or conformer_idx >= end_idx:
+                continue
+            if (conformer_idx - start_idx) // shard_size in completed_shards:
+                continue
+            yield conformer_idx, conformer
+
+
+def write_shard(shard_file: Path, shard_results: Dict[int, tuple], n_atom_types: int) -> dict:
+    """Writes the featurized conformers of one shard to disk, along with the shard's dataset statistics.
+    Returns the manifest record for the shard."""
+    conformer_idxs = sorted(shard_results.keys())
+    featurized = [shard_results[idx] for idx in conformer_idxs if shard_results[idx] is not None]
+    n_failed = len(conformer_idxs) - len(featurized)
+
+    n_atoms = torch.tensor([feats[0].shape[0] for feats in featurized], dtype=torch.int64)
+    n_bonds = torch.tensor([feats[4].shape[0] for feats in featurized], dtype=torch.int64)
+    shard_stats = MarginalDistAccumulator(n_atom_types)
+
+    if len(featurized) > 0:
+        positions, atom_types, atom_charges, bond_types, bond_idxs, mol_bond_order_counts = (np.concatenate(feats, axis=0) for feats in zip(*featurized))
+        bond_order_counts = torch.from_numpy(mol_bond_order_counts.reshape(-1, 5).sum(axis=0))
+        shard_stats.update(torch.from_numpy(atom_types), torch.from_numpy(atom_charges), n_atoms, bond_order_counts)
+        shard_dict = {
+            'positions': torch.from_numpy(positions).type(torch.float32),
+            'atom_types': torch.from_numpy(atom_types),
+            'atom_charges': torch.from_numpy(atom_charges).type(torch.int32),
+            'bond_types': torch.from_numpy(bond_types),
+            'bond_idxs': torch.from_numpy(bond_idxs).type(torch.int32),
+        }
+    else:
+        shard_dict = {}
+
+    shard_dict['n_atoms'] = n_atoms
+    shard_dict['n_bonds'] = n_bonds
+    shard_dict['stats'] = shard_stats.state_dict()
+
+    # write to a temporary file first so that a crash never leaves a truncated shard behind
+    tmp_file = shard_file.with_suffix('.tmp')
+    torch.save(shard_dict, tmp_file)
+    os.replace(tmp_file, shard_file)
+
+    return {
+        'file': shard_file.name,
+        'n_mols': len(featurized),
+        'n_failed': n_failed,
+        'n_atoms': int(n_atoms.sum()),
+        'n_bonds': int(n_bonds.sum()),
+    }
+
+
+def save_manifest(manifest: dict, manifest_file: Path):
+    tmp_file = manifest_file.with_suffix('.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+
+def load_manifest(manifest_file: Path, params: dict, overwrite: bool) -> dict:
+    """Loads the manifest of a previous run, or creates a new one if there is nothing to resume from."""
+    shard_dir = manifest_file.parent
+    if overwrite and shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    if not manifest_file.exists():
+        return {'params': params, 'shards': {}}
+
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['params'] != params:
+        raise ValueError(f"shards in {shard_dir} were produced with different parameters ({manifest['params']}), rerun with --overwrite to discard them")
+
+    return manifest
+
+
+def concatenate_shards(manifest: dict, shard_dir: Path, n_atom_types: int):
+    """Concatenates all shards into flat arrays.
+
+    The output arrays are allocated once from the totals recorded in the manifest and filled one shard at a time,
+    so at most one shard is held in memory alongside the final arrays. The per-shard statistics are merged
+    along the way, so the marginal distributions need no pass over the final arrays.
+    """
+    shard_ids = sorted(manifest['shards'].keys(), key=int)
+    total_atoms = sum(manifest['shards'][shard_id]['n_atoms'] for shard_id in shard_ids)
+    total_bonds = sum(manifest['shards'][shard_id]['n_bonds'] for shard_id in shard_ids)
+
+    all_positions = torch.empty((total_atoms, 3), dtype=torch.float32)
+    all_atom_types = torch.empty((total_atoms, n_atom_types), dtype=torch.bool)
+    all_atom_charges = torch.empty(total_atoms, dtype=torch.int32)
+    all_bond_types = torch.empty(total_bonds, dtype=torch.int32)
+    all_bond_idxs = torch.empty((total_bonds, 2), dtype=torch.int32)
+    dataset_stats = MarginalDistAccumulator(n_atom_types)
+    n_atoms_list = []
+    n_bonds_list = []
+
+    atom_offset = 0
+    bond_offset = 0
+    for shard_id in tqdm.tqdm(shard_ids, desc='Concatenating shards'):
+        shard = torch.load(shard_dir / manifest['shards'][shard_id]['file'])
+        n_atoms_list.append(shard['n_atoms'])
+        n_bonds_list.append(shard['n_bonds'])
+        dataset_stats.merge(MarginalDistAccumulator.from_state_dict(shard['stats']))
+
+        if shard['n_atoms'].shape[0] == 0:
+            continue
+
+        n_shard_atoms = shard['positions'].shape[0]
+        n_shard_bonds = shard['bond_idxs'].shape[0]
+        all_positions[atom_offset:atom_offset+n_shard_atoms] = shard['positions']
+        all_atom_types[atom_offset:atom_offset+n_shard_atoms] = shard['atom_types']
+        all_atom_charges[atom_offset:atom_offset+n_shard_atoms] = shard['atom_charges']
+        all_bond_types[bond_offset:bond_offset+n_shard_bonds] = shard['bond_types']
+        all_bond_idxs[bond_offset:bond_offset+n_shard_bonds] = shard['bond_idxs']
+        atom_offset += n_shard_atoms
+        bond_offset += n_shard_bonds
+        del shard
+
+    n_atoms_list = torch.cat(n_atoms_list)
+    n_bonds_list = torch.cat(n_bonds_list)
+
+    return all_positions, all_atom_types, all_atom_charges, all_bond_types, all_bond_idxs, dataset_stats, n_atoms_list, n_bonds_list
 
-    args = parse_args()
 
-    # start_idx is not 0 or end_idx is not np.inf, then raise NotImplementedError
-    if args.start_idx != 0 or args.end_idx != np.inf:
-        raise NotImplementedError(f"dataset chunking not yet implemented")
+if __name__ == "__main__":
 
-    # if the overwrite or save_interval flags are set, then raise NotImplementedError
-    if args.overwrite or args.save_interval != 5:
-        raise NotImplementedError(f"overwrite and save_interval flags not yet implemented")
+    args = parse_args()
 
     # load config file
     with open(args.config, 'r') as f:
@@ -93,44 +230,26 @@ if __name__ == "__main__":
         n_conformers = None
     print(f'n_conformers set to {n_conformers}')
 
-
     # get processed data directory and create it if it doesn't exist
     processed_data_dir = Path(config['dataset']['processed_data_dir'])
     processed_data_dir.mkdir(exist_ok=True)
 
-    output_dir = processed_data_dir 
-
-    # determine output file name
-    output_file = output_dir / f'{args.split_file.stem}_processed.pt'
-
-    # get the raw data file
-    raw_data_file = args.split_file
-
-    # load the raw data
-    with open(raw_data_file, 'rb') as f:
-        raw_data = pickle.load(f)
-
     # determine if we are processing the entire dataset or just a subset
-    if args.start_idx == 0 and args.end_idx == np.inf:
-        full_dataset = True
-        args.save_interval = np.inf
-    else:
-        full_dataset = False
+    full_dataset = args.start_idx == 0 and args.end_idx is None
 
     if full_dataset:
         output_dir = processed_data_dir
+        output_stem = args.split_file.stem
     else:
         output_dir = processed_data_dir / 'chunks'
         output_dir.mkdir(exist_ok=True)
-
-    if not full_dataset:
-        raise NotImplementedError(f"dataset chunking is a stupid idea, make multiprocessing work instead")
+        output_stem = f'{args.split_file.stem}_{args.start_idx}_{args.end_idx}'
 
     # determine output file name
     if full_dataset:
-        output_file = output_dir / f'{args.split_file.stem}_processed.pt'
+        output_file = output_dir / f'{output_stem}_processed.pt'
     else:
-        output_file = output_dir / f'{args.split_file.stem}_{args.start_idx}_{args.end_idx}.pt'
+        output_file = output_dir / f'{output_stem}.pt'
 
     # get the directory where we write files for currently running jobs
     running_dir = processed_data_dir / 'running'
@@ -142,90 +261,88 @@ if __name__ == "__main__":
     # setup exit handler
     setup_exit_handler(running_file)
 
-    # combine all the conformers from all the molecules into a single list
-    all_molecules = []
-    all_smiles = []
-    for molecule_chunk in raw_data:
-        all_smiles.append(molecule_chunk[0])
-
-        if n_conformers is not None:
-            n_confs_this_mol = min(n_conformers, len(molecule_chunk[1]))
-        else:
-            n_confs_this_mol = len(molecule_chunk[1])
-            
-        for conformer in molecule_chunk[1][:n_confs_this_mol]:
-            all_molecules.append(conformer)
-    del raw_data
+    # load the raw data
+    with open(args.split_file, 'rb') as f:
+        raw_data = pickle.load(f)
 
-    # determine start_idx and end_idx for molecule processing
-    if full_dataset:
-        start_idx = 0
-        end_idx = len(all_molecules)
+    # count the conformers we will take from each molecule
+    if n_conformers is not None:
+        n_confs_per_mol = np.array([min(n_conformers, len(molecule_chunk[1])) for molecule_chunk in raw_data], dtype=np.int64)
     else:
-        start_idx = args.start_idx
-        end_idx = args.end_idx
+        n_confs_per_mol = np.array([len(molecule_chunk[1]) for molecule_chunk in raw_data], dtype=np.int64)
+    n_total_conformers = int(n_confs_per_mol.sum())
 
-    # get the molecules we are going to process
-    molecules = all_molecules[start_idx:end_idx]
-    all_smiles = all_smiles[start_idx:end_idx]
+    # determine start_idx and end_idx for conformer processing
+    start_idx = args.start_idx
+    end_idx = n_total_conformers if args.end_idx is None else min(args.end_idx, n_total_conformers)
 
+    # truncate the dataset - a feature only used for debugging / creating small datasets
     dataset_size = config['dataset']['dataset_size']
+    if dataset_size is not None:
+        end_idx = min(end_idx, start_idx + dataset_size)
+
+    if start_idx >= end_idx:
+        raise ValueError(f"start_idx {start_idx} is past the last conformer in the split ({n_total_conformers} conformers)")
+
+    # the smiles of every molecule with at least one conformer in [start_idx, end_idx)
+    mol_conf_ends = np.cumsum(n_confs_per_mol)
+    first_mol_idx = int(np.searchsorted(mol_conf_ends, start_idx, side='right'))
+    last_mol_idx = int(np.searchsorted(mol_conf_ends, end_idx - 1, side='right'))
+    all_smiles = [molecule_chunk[0] for molecule_chunk in raw_data[first_mol_idx:last_mol_idx+1]]
+
+    # load the manifest of completed shards, if we are resuming a previous run
+    shard_size = args.save_interval
+    shard_dir = output_dir / f'{output_stem}_shards'
+    manifest_file = shard_dir / 'manifest.json'
+    manifest_params = {
+        'split_file': args.split_file.name,
+        'atom_map': config['dataset']['atom_map'],
+        'n_conformers': n_conformers,
+        'start_idx': start_idx,
+        'end_idx': end_idx,
+        'shard_size': shard_size,
+        'shard_format': 2, # shards carry their own dataset statistics
+    }
+    manifest = load_manifest(manifest_file, manifest_params, overwrite=args.overwrite)
+    completed_shards = set(int(shard_id) for shard_id in manifest['shards'])
 
+    n_shards = (end_idx - start_idx + shard_size - 1) // shard_size
+    n_remaining = sum(min(shard_size, end_idx - start_idx - shard_id*shard_size) for shard_id in range(n_shards) if shard_id not in completed_shards)
+    print(f'{len(completed_shards)}/{n_shards} shards already processed, {n_remaining} conformers remaining')
 
-    all_positions = []
-    all_atom_types = []
-    all_atom_charges = []
-    all_bond_types = []
-    all_bond_idxs = []
-    all_bond_order_counts = torch.zeros(5, dtype=torch.int64)
+    def expected_shard_size(shard_id: int) -> int:
+        return min(shard_size, end_idx - start_idx - shard_id*shard_size)
 
     mol_featurizer = MoleculeFeaturizer(config['dataset']['atom_map'], n_cpus=args.n_cpus)
 
-    # molecules is a list of rdkit molecules.  now we create an iterator that yields sub-lists of molecules. we do this using itertools:
-    chunk_iterator = chunks(molecules, args.chunk_size)
-    n_chunks = len(molecules) // args.chunk_size + 1
-
-    tqdm_iterator = tqdm.tqdm(chunk_iterator, desc='Featurizing molecules', total=n_chunks)
+    conformer_iterator = indexed_conformers(raw_data, n_confs_per_mol, start_idx, end_idx, shard_size, completed_shards)
     failed_molecules_bar = tqdm.tqdm(desc="Failed Molecules", unit="molecules")
+    total_molecules_bar = tqdm.tqdm(desc="Total Molecules", unit="molecules", total=n_remaining)
 
-    # create a tqdm bar to report the total number of molecules processed
-    total_molecules_bar = tqdm.tqdm(desc="Total Molecules", unit="molecules", total=len(molecules))
-
-    failed_molecules = 0
-    for molecule_chunk in tqdm_iterator:
-
-        # TODO: we should collect all the molecules from each individual list into a single list and then featurize them all at once - this would make the multiprocessing actually useful
-        positions, atom_types, atom_charges, bond_types, bond_idxs, num_failed, bond_order_counts = mol_featurizer.featurize_molecules(molecule_chunk)
-
-        failed_molecules += num_failed
-        failed_molecules_bar.update(num_failed)
-        total_molecules_bar.update(len(molecule_chunk))
+    # featurize all remaining conformers in one stream, collecting results by shard and writing each shard as soon as it is complete
+    pending_shards: Dict[int, dict] = defaultdict(dict)
+    for conformer_idx, features in mol_featurizer.featurize_stream(conformer_iterator, chunksize=args.chunk_size):
+        shard_id = (conformer_idx - start_idx) // shard_size
+        pending_shards[shard_id][conformer_idx] = features
 
-        all_positions.extend(positions)
-        all_atom_types.extend(atom_types)
-        all_atom_charges.extend(atom_charges)
-        all_bond_types.extend(bond_types)
-        all_bond_idxs.extend(bond_idxs)
-        all_bond_order_counts += bond_order_counts
+        total_molecules_bar.update(1)
+        if features is None:
+            failed_molecules_bar.update(1)
 
-        # early stopping - a feature only used for debugging / creating small datasets
-        if dataset_size is not None and len(all_positions) > dataset_size and full_dataset:
-            break
+        if len(pending_shards[shard_id]) == expected_shard_size(shard_id):
+            shard_file = shard_dir / f'shard_{shard_id:06d}.pt'
+            manifest['shards'][str(shard_id)] = write_shard(shard_file, pending_shards.pop(shard_id), n_atom_types=len(config['dataset']['atom_map']))
+            save_manifest(manifest, manifest_file)
 
-    # get number of atoms in every data point
-    n_atoms_list = [ x.shape[0] for x in all_positions ]
-    n_bonds_list = [ x.shape[0] for x in all_bond_idxs ]
+    mol_featurizer.close()
+    del raw_data
 
-    # convert n_atoms_list and n_bonds_list to tensors
-    n_atoms_list = torch.tensor(n_atoms_list)
-    n_bonds_list = torch.tensor(n_bonds_list)
+    if len(manifest['shards']) != n_shards:
+        raise RuntimeError(f"expected {n_shards} shards but only {len(manifest['shards'])} were written")
 
-    # concatenate all_positions and all_features into single arrays
-    all_positions = torch.concatenate(all_positions, dim=0)
-    all_atom_types = torch.concatenate(all_atom_types, dim=0)
-    all_atom_charges = torch.concatenate(all_atom_charges, dim=0)
-    all_bond_types = torch.concatenate(all_bond_types, dim=0)
-    all_bond_idxs = torch.concatenate(all_bond_idxs, dim=0)
+    # concatenate the shards into flat arrays
+    all_positions, all_atom_types, all_atom_charges, all_bond_types, all_bond_idxs, dataset_stats, n_atoms_list, n_bonds_list = concatenate_shards(
+        manifest, shard_dir, n_atom_types=len(config['dataset']['atom_map']))
 
     # create an array of indicies to keep track of the start_idx and end_idx of each molecule's node features
     node_idx_array = torch.zeros((len(n_atoms_list), 2), dtype=torch.int32)
@@ -237,10 +354,6 @@ if __name__ == "__main__":
     edge_idx_array[:, 1] = torch.cumsum(n_bonds_list, dim=0)
     edge_idx_array[1:, 0] = edge_idx_array[:-1, 1]
 
-    all_positions = all_positions.type(torch.float32)
-    all_atom_charges = all_atom_charges.type(torch.int32)
-    all_bond_idxs = all_bond_idxs.type(torch.int32)
-
     # create a dictionary to store all the data
     data_dict = {
         'smiles': all_smiles,
@@ -256,39 +369,29 @@ if __name__ == "__main__":
     # save the data
     torch.save(data_dict, output_file)
 
-    # compute the marginal distribution of atom types, p(a)
-    p_a = all_atom_types.sum(dim=0)
-    p_a = p_a / p_a.sum()
-
-    # compute the conditional distribution of charges given atom type, p(c|a)
-    p_c_given_a = compute_p_c_given_a(all_atom_charges, all_atom_types, config['dataset']['atom_map'])
-
-    # compute the marginal distribution of bond types, p(e)
-    p_e = all_bond_order_counts / all_bond_order_counts.sum()
-
-    # compute the marginal distirbution of charges, p(c)
-    charge_vals, charge_counts = torch.unique(all_atom_charges, return_counts=True)
-    p_c = torch.zeros(6, dtype=torch.float32)
-    for c_val, c_count in zip(charge_vals, charge_counts):
-        p_c[c_val+2] = c_count
-    p_c = p_c / p_c.sum()
+    # p(a), p(c), p(e) and p(c|a) come from the counts accumulated while the shards were written
+    p_a, p_c, p_e, p_c_given_a = dataset_stats.marginal_dists()
 
     # save p(a), p(e), p(c) and p(c|a) to a file
-    marginal_dists_file = output_dir / f'{args.split_file.stem}_marginal_dists.pt'
+    marginal_dists_file = output_dir / f'{output_stem}_marginal_dists.pt'
     torch.save((p_a, p_c, p_e, p_c_given_a), marginal_dists_file)
 
 
     # create histogram of number of atoms
     if full_dataset:
-        n_atoms, counts = torch.unique(n_atoms_list, return_counts=True)
-        histogram_file = output_dir / f'{args.split_file.stem}_n_atoms_histogram.pt'
+        n_atoms, counts = dataset_stats.n_atoms_histogram()
+        histogram_file = output_dir / f'{output_stem}_n_atoms_histogram.pt'
         torch.save((n_atoms, counts), histogram_file)
 
 
     # write all_smiles to its own file if we are processing the full dataset
     if full_dataset:
-        smiles_file = output_dir / f'{args.split_file.stem}_smiles.pkl'
+        smiles_file = output_dir / f'{output_stem}_smiles.pkl'
         with open(smiles_file, 'wb') as f:
             pickle.dump(all_smiles, f)
 
-
+    # index the smiles for novelty checks, see flowmol/analysis/smiles_index.py.
+    # runs that process part of the split write an index of their own chunk, as chunks run in parallel. the chunk
+    # indices are merged into the index of the split with build_smiles_index.py --from_chunks
+    smiles_index_file = output_dir / f'{output_stem}_smiles_index.npy'
+    SmilesIndex.from_smiles(all_smiles).save(smiles_index_file)
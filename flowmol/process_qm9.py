@@ -16,7 +16,8 @@ from multiprocessing import Pool
 import pandas as pd
 
 from flowmol.data_processing.geom import MoleculeFeaturizer
-from flowmol.utils.dataset_stats import compute_p_c_given_a
+from flowmol.utils.dataset_stats import MarginalDistAccumulator
+from flowmol.analysis.smiles_index import SmilesIndex
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
@@ -87,7 +88,7 @@ def process_split(split_df, split_name, args, dataset_config):
     all_atom_charges = []
     all_bond_types = []
     all_bond_idxs = []
-    all_bond_order_counts = torch.zeros(5, dtype=torch.int64)
+    dataset_stats = MarginalDistAccumulator(len(dataset_config['atom_map']))
 
     mol_featurizer = MoleculeFeaturizer(config['dataset']['atom_map'], n_cpus=args.n_cpus)
 
@@ -116,7 +117,11 @@ def process_split(split_df, split_name, args, dataset_config):
         all_atom_charges.extend(atom_charges)
         all_bond_types.extend(bond_types)
         all_bond_idxs.extend(bond_idxs)
-        all_bond_order_counts += bond_order_counts
+
+        # accumulate dataset statistics chunk by chunk so we don't need another pass over the full arrays
+        if len(positions) > 0:
+            chunk_n_atoms = torch.tensor([x.shape[0] for x in positions])
+            dataset_stats.update(torch.cat(atom_types), torch.cat(atom_charges), chunk_n_atoms, bond_order_counts)
 
     # get number of atoms in every data point
     n_atoms_list = [ x.shape[0] for x in all_positions ]
@@ -164,26 +169,12 @@ def process_split(split_df, split_name, args, dataset_config):
     torch.save(data_dict, output_file)
 
     # create histogram of number of atoms
-    n_atoms, counts = torch.unique(n_atoms_list, return_counts=True)
+    n_atoms, counts = dataset_stats.n_atoms_histogram()
     histogram_file = output_dir / f'{split_name}_n_atoms_histogram.pt'
     torch.save((n_atoms, counts), histogram_file)
 
-    # compute the marginal distribution of atom types, p(a)
-    p_a = all_atom_types.sum(dim=0)
-    p_a = p_a / p_a.sum()
-
-    # compute the marginal distribution of bond types, p(e)
-    p_e = all_bond_order_counts / all_bond_order_counts.sum()
-
-    # compute the marginal distirbution of charges, p(c)
-    charge_vals, charge_counts = torch.unique(all_atom_charges, return_counts=True)
-    p_c = torch.zeros(6, dtype=torch.float32)
-    for c_val, c_count in zip(charge_vals, charge_counts):
-        p_c[c_val+2] = c_count
-    p_c = p_c / p_c.sum()
-
-    # compute the conditional distribution of charges given atom type, p(c|a)
-    p_c_given_a = compute_p_c_given_a(all_atom_charges, all_atom_types, dataset_config['atom_map'])
+    # compute p(a), p(c), p(e) and p(c|a) from the accumulated counts
+    p_a, p_c, p_e, p_c_given_a = dataset_stats.marginal_dists()
 
     # save p(a), p(e) and p(c|a) to a file
     marginal_dists_file = output_dir / f'{split_name}_marginal_dists.pt'
@@ -194,6 +185,9 @@ def process_split(split_df, split_name, args, dataset_config):
     with open(smiles_file, 'wb') as f:
         pickle.dump(all_smiles, f)
 
+    # index the smiles for novelty checks, see flowmol/analysis/smiles_index.py
+    SmilesIndex.from_smiles(all_smiles).save(output_dir / f'{split_name}_smiles_index.npy')
+
 
 if __name__ == "__main__":
 
@@ -6,6 +6,7 @@ from pytorch_lightning import seed_everything
 from flowmol.models.flowmol import FlowMol
 from flowmol.analysis.molecule_builder import SampledMolecule
 from flowmol.analysis.metrics import SampleAnalyzer
+from flowmol.analysis.valid_sampler import ValidMoleculeSampler
 from typing import List
 from rdkit import Chem
 from flowmol.model_utils.load import read_config_file
@@ -20,6 +21,10 @@ def parse_args():
     p.add_argument('--output_file', type=Path, help='Path to output file', default=None)
 
     p.add_argument('--n_mols', type=int, default=100, help='The number of molecules to generate.')
+    p.add_argument('--n_valid', type=int, default=None, help='If set, sample until this many valid, unique molecules are collected instead of sampling n_mols molecules.')
+    p.add_argument('--max_samples', type=int, default=None, help='Maximum number of molecules to sample when using --n_valid.')
+    p.add_argument('--max_stalled_batches', type=int, default=10, help='When using --n_valid, stop after this many batches in a row yield no new valid, unique molecule.')
+    p.add_argument('--screen_workers', type=int, default=4, help='Number of processes that sanitize molecules when using --n_valid.')
     p.add_argument('--n_atoms_per_mol', type=int, default=None, help="The number of atoms in every molecule. If None, the number of atoms will be sampled independently for each molecule from the training data distribution.")
     p.add_argument('--n_timesteps', type=int, default=20, help="Number of timesteps for integration via Euler's method")
     # p.add_argument('--visualize', action='store_true', help='Visualize the sampled trajectories')
@@ -27,6 +32,7 @@ def parse_args():
     p.add_argument('--ep_traj', action='store_true', help='Save the endpoint trajectory of the sampled molecules')
     p.add_argument('--metrics', action='store_true', help='Compute metrics on the sampled molecules')
     p.add_argument('--max_batch_size', type=int, default=128, help='Maximum batch size for sampling molecules')
+    p.add_argument('--precision', type=str, default='32', choices=['32', 'bf16-mixed', '16-mixed'], help='Precision used to evaluate the model during sampling')
     p.add_argument('--baseline_comparison', action='store_true', help='Whether these samples are for comparison to the baseline. If true, output format will be different.')
     # p.add_argument('--temp', type=float, default=1.0, help='Temperature for sampling categorical features')
 
@@ -43,6 +49,9 @@ def parse_args():
     if args.model_dir is None and args.checkpoint is None:
         raise ValueError('must specify model_dir or checkpoint')
 
+    if args.n_valid is not None and (args.xt_traj or args.ep_traj):
+        raise ValueError('trajectories cannot be saved when sampling with --n_valid')
+
     if args.hc_thresh is not None:
         if args.hc_thresh < 0 or args.hc_thresh > 1:
             raise ValueError('hc_thresh must be on the interval [0, 1]')
@@ -96,6 +105,26 @@ if __name__ == "__main__":
 
     molecules = []
     start = time.time()
+
+    # sample until n_valid valid, unique molecules are collected, this replaces the fixed-size sampling loop below
+    if args.n_valid is not None:
+        valid_sampler = ValidMoleculeSampler(model, device,
+            max_batch_size=args.max_batch_size,
+            n_workers=args.screen_workers,
+            n_atoms_per_mol=args.n_atoms_per_mol,
+            max_stalled_batches=args.max_stalled_batches,
+            n_timesteps=args.n_timesteps,
+            stochasticity=args.stochasticity,
+            high_confidence_threshold=args.hc_thresh,
+            precision=args.precision)
+        molecules = valid_sampler.sample(args.n_valid, max_samples=args.max_samples)
+        n_batches = 0
+        stats = valid_sampler.stats
+        print(f"sampled {stats['n_sampled']} molecules: {stats['n_stable']} passed the valence check, {stats['n_valid']} were valid, {stats['n_unique']} valid and unique were kept")
+        print(f"{stats['valid_unique_per_s']:.2f} valid unique molecules per second")
+        if stats['n_missing'] > 0:
+            print(f"WARNING: {stats['n_missing']} of the requested {args.n_valid} valid, unique molecules were not collected")
+
     for batch_idx in range(n_batches):
 
         n_mols_needed = args.n_mols - len(molecules)
@@ -110,6 +139,7 @@ if __name__ == "__main__":
                 ep_traj=args.ep_traj,
                 stochasticity=args.stochasticity,
                 high_confidence_threshold=args.hc_thresh,
+                precision=args.precision,
             )
         else:
             n_atoms = torch.full((batch_size,), args.n_atoms_per_mol, dtype=torch.long, device=device)
@@ -121,6 +151,7 @@ if __name__ == "__main__":
                 ep_traj=args.ep_traj,
                 stochasticity=args.stochasticity,
                 high_confidence_threshold=args.hc_thresh,
+                precision=args.precision,
                 )
 
         molecules.extend(batch_molecules)
@@ -148,7 +179,7 @@ if __name__ == "__main__":
     if args.metrics:
         processed_data_dir = config['dataset']['processed_data_dir']
         sample_analyzer = SampleAnalyzer(processed_data_dir=Path(processed_data_dir))
-        metrics = sample_analyzer.analyze(molecules)
+        metrics = sample_analyzer.analyze(molecules, novelty=True)
 
         # compute js-divergence of energies
         js_div = sample_analyzer.compute_energy_divergence(molecules)
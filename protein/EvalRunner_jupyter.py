@@ -1,4 +1,5 @@
 import os
+import gc
 import time
 import numpy as np
 import hydra
@@ -6,19 +7,23 @@ import torch
 import subprocess
 import logging
 import pandas as pd
-import shutil
 from datetime import datetime
-from biotite.sequence.io import fasta
 import GPUtil
 from typing import Optional, Union, List
 from analysis import utils as au
 from analysis import metrics
+from analysis.folding import BatchedFolder
+from analysis.diversity import DiversityEngine
+from analysis.designability import DesignabilityPipeline, find_samples
+from analysis.inverse_folding import InverseFolder, fasta_records, write_fasta
+from analysis.result_cache import ResultCache
+from analysis.structure_metrics import structure_metrics
 from data import utils as du
+from data import protein
 from omegaconf import DictConfig, OmegaConf
 from openfold.data import data_transforms
 import esm
 from pathlib import Path
-import mdtraj as md
 from openfold.np import residue_constants
 from tmtools import tm_align
 from openfold.utils.superimposition import superimpose
@@ -55,6 +60,8 @@ class EvalRunner:
 
         self._pmpnn_dir = self._conf.pmpnn_dir
         self._foldseek_database = self._conf.foldseek_database
+        self._inverse_folder = None
+        self._result_cache = None
 
         # Load ESMFold model
         # self._folding_model = esm.pretrained.esmfold_v0().eval()
@@ -98,11 +105,85 @@ class EvalRunner:
             while os.path.isfile(f"{self.model_name}.aria2"):
                 time.sleep(5)
 
+        # ESMFold is loaded on first use and stays resident until release_folding_model is called
+        self._folding_model = None
+        self._batched_folder = None
+
+    @property
+    def folding_model(self):
+        """ESMFold model loaded from self.model_name, kept on self.device between calls."""
+        if self._folding_model is None:
+            # Warning: this will overwrite the default dtype
+            torch.set_default_dtype(torch.float32)
+            model = torch.load(self.model_name, weights_only=False)
+            self._folding_model = model.eval().to(self.device).requires_grad_(False)
+        return self._folding_model
+
+    def release_folding_model(self):
+        """Frees the memory held by the folding model. It is loaded again the next time it is needed."""
+        if self._folding_model is None:
+            return
+        self._folding_model = None
+        self._batched_folder = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    @property
+    def batched_folder(self):
+        """Length-bucketed batched ESMFold inference, see analysis.folding.BatchedFolder."""
+        if self._batched_folder is None:
+            self._batched_folder = BatchedFolder(
+                self.folding_model,
+                self.device,
+                memory_budget_mb=getattr(self._conf, "folding_memory_budget_mb", None),
+                max_batch_size=getattr(self._conf, "folding_max_batch_size", 32),
+                cache=self.result_cache,
+                model_version=self.model_name,
+            )
+        return self._batched_folder
+
+    def fold_sequences(self, sequences: List[str], save_paths: Optional[List[str]] = None):
+        """Folds sequences in batches, which can come from any number of designs.
+
+        Writes each prediction to the matching entry of save_paths if given, and returns a dict per sequence
+        with pdb_string, ptm, plddt and pae.
+        """
+        results = self.batched_folder.fold(sequences)
+        if save_paths is not None:
+            for result, save_path in zip(results, save_paths):
+                with open(save_path, "w") as f:
+                    f.write(result["pdb_string"])
+        return results
+
+    @property
+    def result_cache(self):
+        """Store of folding and ProteinMPNN results at result_cache_path, or None if no path is configured."""
+        if self._result_cache is None and getattr(self._conf, "result_cache_path", None):
+            self._result_cache = ResultCache(self._conf.result_cache_path)
+        return self._result_cache
+
+    @property
+    def inverse_folder(self):
+        """ProteinMPNN loaded on first use and kept in memory, see analysis.inverse_folding.InverseFolder."""
+        if self._inverse_folder is None:
+            if getattr(self._conf, "pmpnn_stand_in", False):
+                # samples uniform sequences, for running the pipeline without ProteinMPNN weights
+                self._inverse_folder = InverseFolder.stand_in(self.device, cache=self.result_cache)
+            else:
+                self._inverse_folder = InverseFolder.from_weights(
+                    self._pmpnn_dir,
+                    self.device,
+                    model_name=getattr(self._conf, "pmpnn_model_name", "v_48_020"),
+                    cache=self.result_cache,
+                )
+        return self._inverse_folder
+
     def _calc_bb_rmsd(self, mask, sample_bb_pos, folded_bb_pos):
         aligned_rmsd = superimpose(
             torch.tensor(sample_bb_pos),
             torch.tensor(folded_bb_pos),
-            mask.unsqueeze(1).repeat(1, 3).T,
+            mask,
         )
         return aligned_rmsd[1].item()
 
@@ -184,71 +265,11 @@ class EvalRunner:
         return top_pdbTM
 
     def calc_mdtraj_metrics(self, pdb_path: str):
-        try:
-            traj = md.load(pdb_path)
-            pdb_ss = md.compute_dssp(traj, simplified=True)
-            pdb_coil_percent = np.mean(pdb_ss == "C")
-            pdb_helix_percent = np.mean(pdb_ss == "H")
-            pdb_strand_percent = np.mean(pdb_ss == "E")
-            pdb_ss_percent = pdb_helix_percent + pdb_strand_percent
-            pdb_rg = md.compute_rg(traj)[0]
-        except IndexError as e:
-            print("Error in calc_mdtraj_metrics: {}".format(e))
-            pdb_ss_percent = 0.0
-            pdb_coil_percent = 0.0
-            pdb_helix_percent = 0.0
-            pdb_strand_percent = 0.0
-            pdb_rg = 0.0
-        return {
-            "non_coil_percent": pdb_ss_percent,
-            "coil_percent": pdb_coil_percent,  # coil
-            "helix_percent": pdb_helix_percent,  # alpha helix
-            "strand_percent": pdb_strand_percent,  # beta sheet
-            "radius_of_gyration": pdb_rg,
-        }
+        return structure_metrics([pdb_path], n_workers=1)[0]
 
-    def run_max_cluster(self, designable_file_path, designable_dir):
-        pmpnn_args = [
-            "./maxcluster64bit",
-            "-l",
-            designable_file_path,
-            os.path.join(designable_dir, "all_by_all_lite"),
-            "-C",
-            "2",
-            "-in",
-            "-Rl",
-            os.path.join(designable_dir, "tm_results.txt"),
-            "-Tm",
-            "0.5",
-        ]
-        process = subprocess.Popen(
-            pmpnn_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        stdout, _ = process.communicate()
-
-        # Extract number of clusters
-        match = re.search(
-            r"INFO\s*:\s*(\d+)\s+Clusters\s+@\s+Threshold\s+(\d+\.\d+)\s+\(\d+\.\d+\)",
-            stdout.decode("utf-8"),
-        )
-        clusters = int(match.group(1))
-        cluster_results_path = os.path.join(designable_dir, "cluster_results.txt")
-        with open(cluster_results_path, "w") as f:
-            f.write(stdout.decode("utf-8"))
-
-        # Extract cluster centroids
-        cluster_lines = stdout.decode("utf-8").split("\n")
-        centroid_section = False
-        for line in cluster_lines:
-            if "Centroids" in line:
-                centroid_section = True
-            if centroid_section:
-                match = re.search(r"(?<=\s)(\/[^\s]+\.pdb)", line)
-                if match is not None:
-                    centroid_path = match.group(1)
-                    copy_name = centroid_path.split("/")[-2] + ".pdb"
-                    shutil.copy(centroid_path, os.path.join(designable_dir, copy_name))
-        return clusters
+    def calc_mdtraj_metrics_all(self, structures: List[Union[str, protein.Protein]], n_workers: int = 4):
+        """calc_mdtraj_metrics of many PDB paths or Proteins at once, see analysis.structure_metrics.structure_metrics."""
+        return structure_metrics(structures, n_workers=n_workers)
 
     def calc_designability(
         self,
@@ -267,49 +288,17 @@ class EvalRunner:
             Writes results in decoy_pdb_dir/sc_results.csv
         """
 
-        # Run PorteinMPNN
-        output_path = os.path.join(decoy_pdb_dir, "parsed_pdbs.jsonl")
-        process = subprocess.Popen(
-            [
-                "python",
-                f"{self._pmpnn_dir}/helper_scripts/parse_multiple_chains.py",
-                f"--input_path={reference_pdb_path}",
-                f"--output_path={output_path}",
-            ]
-        )
-        _ = process.wait()
-        num_tries = 0
-        ret = -1
-        pmpnn_args = [
-            "python",
-            f"{self._pmpnn_dir}/protein_mpnn_run.py",
-            "--out_folder",
-            decoy_pdb_dir,
-            "--jsonl_path",
-            output_path,
-            "--num_seq_per_target",
-            "3",
-            "--sampling_temp",
-            "0.1",
-            "--seed",
-            "38",
-            "--batch_size",
-            "1",
-        ]
-
-        while ret < 0:
-            try:
-                process = subprocess.Popen(
-                    pmpnn_args, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
-                )
-                ret = process.wait()
-            except Exception as e:
-                num_tries += 1
-                self._log.info(f"Failed ProteinMPNN. Attempt {num_tries}/5")
-                torch.cuda.empty_cache()
-                if num_tries > 4:
-                    raise e
+        # Run ProteinMPNN
+        with open(os.path.join(reference_pdb_path, "sample.pdb"), "r") as f:
+            reference_prot = protein.from_pdb_string(f.read())
+        designs = self.inverse_folder.design([reference_prot])[0]
+        native_seq = du.aatype_to_seq(reference_prot.aatype)
+        os.makedirs(os.path.join(decoy_pdb_dir, "seqs"), exist_ok=True)
         mpnn_fasta_path = os.path.join(decoy_pdb_dir, "seqs", "sample.fa")
+        mpnn_records = fasta_records(
+            "sample", native_seq, designs, self.inverse_folder.temperature
+        )
+        write_fasta(mpnn_fasta_path, mpnn_records)
 
         # Run ESMFold on each ProteinMPNN sequence and calculate metrics.
         mpnn_results = {
@@ -325,20 +314,27 @@ class EvalRunner:
 
         esmf_dir = os.path.join(decoy_pdb_dir, "esmf")
         os.makedirs(esmf_dir, exist_ok=True)
-        fasta_seqs = fasta.FastaFile.read(mpnn_fasta_path)
         sample_feats = du.parse_pdb_feats(
             "sample.pdb", os.path.join(reference_pdb_path, "sample.pdb")
         )
-        for i, (header, string) in enumerate(fasta_seqs.items()):
-
-            if i == 0:
-                continue
-            
-            # Run ESMFold
-            esmf_sample_path = os.path.join(esmf_dir, f"sample_{i}.pdb")
-            # _ = self.run_folding(string, esmf_sample_path)
-            ptm, plddt, pae = self.run_folding(string, esmf_sample_path)
-            
+        # the first sequence is the native sequence of the design
+        designed_seqs = mpnn_records[1:]
+        esmf_sample_paths = [
+            os.path.join(esmf_dir, f"sample_{i}.pdb") for i in range(1, len(designed_seqs) + 1)
+        ]
+
+        # Run ESMFold on all sequences in one batched call
+        folding_results = self.fold_sequences(
+            [string for _, string in designed_seqs], esmf_sample_paths
+        )
+
+        for (header, string), esmf_sample_path, folding_result in zip(
+            designed_seqs, esmf_sample_paths, folding_results
+        ):
+            ptm = folding_result["ptm"]
+            plddt = folding_result["plddt"]
+            pae = folding_result["pae"]
+
             esmf_feats = du.parse_pdb_feats("folded_sample", esmf_sample_path)
             sample_seq = du.aatype_to_seq(sample_feats["aatype"])
 
@@ -377,6 +373,16 @@ class EvalRunner:
 
         return mpnn_results
 
+    def calc_designability_all(self, samples_dir: str, output_dir: str, **pipeline_kwargs):
+        """Self-consistency of every sample.pdb under samples_dir, with the ProteinMPNN, ESMFold and alignment
+        stages of different designs overlapped.
+
+        Writes one results table to output_dir/sc_results.csv, and skips designs that are already in it.
+        pipeline_kwargs are passed to analysis.designability.DesignabilityPipeline.
+        """
+        pipeline = DesignabilityPipeline(self, output_dir, **pipeline_kwargs)
+        return pipeline.run(find_samples(samples_dir))
+
     def calc_all_metrics(
         self,
         decoy_pdb_dir: str,
@@ -432,7 +438,6 @@ class EvalRunner:
         from jax.tree_util import tree_map
         import matplotlib.pyplot as plt
         from scipy.special import softmax
-        import gc
 
         def parse_output(output):
             pae = (output["aligned_confidence_probs"][0] * np.arange(64)).mean(-1) * 31
@@ -485,19 +490,7 @@ class EvalRunner:
         else:
             mode = "hetero"
 
-        if "model" not in dir() or self.model_name != model_name_:
-            if "model" in dir():
-                # delete old model from memory
-                del model
-                gc.collect()
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-
-            # Warning: this will overwrite the default dtype
-            torch.set_default_dtype(torch.float32)
-            model = torch.load(self.model_name, weights_only=False)
-            model.eval().cuda().requires_grad_(False)
-            model_name_ = self.model_name
+        model = self.folding_model
 
         # optimized for Tesla T4
         if length > 700:
@@ -548,7 +541,15 @@ class EvalRunner:
         with open(designable_file_path, "w") as f:
             f.write("\n".join(designable_paths))
 
-        clusters = self.run_max_cluster(designable_file_path, cluster_dir)
+        engine = DiversityEngine(
+            tm_threshold=getattr(self._conf, "diversity_tm_threshold", 0.5),
+            n_workers=getattr(self._conf, "diversity_n_workers", 8),
+            cache=self.result_cache,
+        )
+        engine.add(designable_paths)
+        cluster_results = engine.cluster()
+        cluster_results.to_csv(os.path.join(cluster_dir, "cluster_results.csv"), index=False)
+        clusters = cluster_results["cluster"].nunique()
 
         return clusters
 
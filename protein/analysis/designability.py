@@ -0,0 +1,320 @@
+"""Pipelined self-consistency (designability) evaluation of many designs.
+
+Designs flow through four stages connected by bounded queues, so that the GPU stages run while the CPU stages
+work on other designs:
+
+    backbone parsing (process pool) -> inverse folding (ProteinMPNN) -> batched folding (ESMFold) -> alignment metrics (process pool)
+
+Results are appended to a single table, output_dir/sc_results.csv, as soon as every sequence of a design has been
+scored. A rerun skips the designs already in the table, so an interrupted evaluation resumes where it stopped.
+Run from the protein directory:
+
+    python -m analysis.designability --samples_dir example_data --output_dir designability
+"""
+import argparse
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+from openfold.utils.superimposition import superimpose
+from tmtools import tm_align
+
+from analysis.inverse_folding import fasta_records
+from data import protein
+from data import utils as du
+
+# marks the end of the stream of designs in a queue
+done = None
+
+# worker processes are started while other stages run models on CUDA, which a forked child could deadlock on
+spawn_context = multiprocessing.get_context("spawn")
+
+result_columns = [
+    "sample_id", "reference_path", "header", "sequence", "mpnn_score",
+    "sample_path", "tm_score", "bb_rmsd", "ptm", "plddt", "pae",
+]
+
+
+def parse_backbone(reference_path: str) -> protein.Protein:
+    with open(reference_path, "r") as f:
+        return protein.from_pdb_string(f.read())
+
+
+def alignment_metrics(reference_path: str, folded_paths: List[str]) -> List[dict]:
+    """scTM and backbone RMSD of every folded structure against the design, as in EvalRunner.calc_designability."""
+    sample_feats = du.parse_pdb_feats("sample.pdb", reference_path)
+    sample_seq = du.aatype_to_seq(sample_feats["aatype"])
+    res_mask = torch.ones(sample_feats["bb_positions"].shape[0])
+    metrics = []
+    for folded_path in folded_paths:
+        esmf_feats = du.parse_pdb_feats("folded_sample", folded_path)
+        tm_results = tm_align(sample_feats["bb_positions"], esmf_feats["bb_positions"], sample_seq, sample_seq)
+        _, rmsd = superimpose(
+            torch.tensor(sample_feats["bb_positions"]),
+            torch.tensor(esmf_feats["bb_positions"]),
+            res_mask,
+        )
+        metrics.append({"tm_score": tm_results.tm_norm_chain2, "bb_rmsd": rmsd.item()})
+    return metrics
+
+
+class DesignabilityPipeline:
+    """Runs calc_designability for many designs at once, with the stages of every design overlapped.
+
+    The inverse folding and folding stages take every design waiting in their input queue, up to batch_samples,
+    and process them in one batched call to runner.inverse_folder and runner.fold_sequences.
+    """
+
+    def __init__(
+        self,
+        runner,
+        output_dir: str,
+        batch_samples: int = 16,
+        queue_size: int = 32,
+        n_parse_workers: int = 2,
+        n_metric_workers: int = 4,
+    ):
+        """
+        Args:
+            runner: an EvalRunner, which holds the ProteinMPNN and ESMFold models.
+            output_dir: folded structures are written to output_dir/esmf/<sample_id> and results to output_dir/sc_results.csv.
+            batch_samples: most designs in one inverse folding or folding call.
+            queue_size: most designs waiting between two stages.
+        """
+        self.runner = runner
+        self.output_dir = Path(output_dir)
+        self.results_path = self.output_dir / "sc_results.csv"
+        self.batch_samples = batch_samples
+        self.queue_size = queue_size
+        self.n_parse_workers = n_parse_workers
+        self.n_metric_workers = n_metric_workers
+
+        self.stop = threading.Event()
+        self.errors = []
+        self.stats = {}
+
+    def completed_samples(self) -> set:
+        if not self.results_path.exists():
+            return set()
+        return set(pd.read_csv(self.results_path, usecols=["sample_id"])["sample_id"].astype(str))
+
+    def run(self, samples: List[tuple]) -> pd.DataFrame:
+        """Evaluates samples, a list of (sample_id, reference_pdb_path) pairs, and returns the whole results table."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        completed = self.completed_samples()
+        samples = [(str(sample_id), str(path)) for sample_id, path in samples if str(sample_id) not in completed]
+        print(f"{len(completed)} designs already evaluated, {len(samples)} to go")
+
+        self.stop.clear()
+        self.errors = []
+        self.stats = dict(n_samples=0, n_sequences=0, elapsed=0.0)
+        start = time.perf_counter()
+
+        parsed, designed, folded = (queue.Queue(maxsize=self.queue_size) for _ in range(3))
+        threads = [
+            threading.Thread(target=self.guard, args=(self.parse_stage, samples, parsed), name="parse"),
+            threading.Thread(target=self.guard, args=(self.inverse_folding_stage, parsed, designed), name="inverse_folding"),
+            threading.Thread(target=self.guard, args=(self.folding_stage, designed, folded), name="folding"),
+            threading.Thread(target=self.guard, args=(self.metrics_stage, folded), name="metrics"),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+        self.stats["elapsed"] = time.perf_counter() - start
+        if self.results_path.exists():
+            return pd.read_csv(self.results_path)
+        return pd.DataFrame(columns=result_columns)
+
+    def guard(self, stage, *args):
+        """Runs a stage and stops the whole pipeline if it fails."""
+        try:
+            stage(*args)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    def put(self, q: queue.Queue, item):
+        # time out regularly, so that a stage blocked on a full queue notices when the pipeline stops
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, q: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=1.0)
+            except queue.Empty:
+                pass
+        return done
+
+    def get_batch(self, q: queue.Queue):
+        """Waits for one item and takes up to batch_samples, or None once the input is exhausted."""
+        item = self.get(q)
+        if item is done:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_samples:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is done:
+                # put the end marker back so that the next call ends the stage
+                q.put(done)
+                break
+            batch.append(item)
+        return batch
+
+    def parse_stage(self, samples, parsed):
+        with ProcessPoolExecutor(self.n_parse_workers, mp_context=spawn_context) as pool:
+            # at most queue_size backbones are parsed ahead of the inverse folding stage
+            in_flight = deque()
+            for sample_idx in range(len(samples) + 1):
+                if sample_idx < len(samples):
+                    sample_id, reference_path = samples[sample_idx]
+                    in_flight.append((sample_id, reference_path, pool.submit(parse_backbone, reference_path)))
+                while in_flight and (len(in_flight) > self.queue_size or sample_idx == len(samples)):
+                    sample_id, reference_path, future = in_flight.popleft()
+                    self.put(parsed, {"sample_id": sample_id, "reference_path": reference_path, "prot": future.result()})
+                if self.stop.is_set():
+                    pool.shutdown(cancel_futures=True)
+                    break
+        self.put(parsed, done)
+
+    def inverse_folding_stage(self, parsed, designed):
+        inverse_folder = self.runner.inverse_folder
+        while True:
+            batch = self.get_batch(parsed)
+            if batch is None:
+                break
+            designs = inverse_folder.design([item["prot"] for item in batch])
+            for item, sample_designs in zip(batch, designs):
+                native_seq = du.aatype_to_seq(item["prot"].aatype)
+                # the native sequence of the design is not folded
+                item["records"] = fasta_records("sample", native_seq, sample_designs, inverse_folder.temperature)[1:]
+                item["mpnn_scores"] = [d["score"] for d in sample_designs]
+                del item["prot"]
+                self.put(designed, item)
+        self.put(designed, done)
+
+    def folding_stage(self, designed, folded):
+        while True:
+            batch = self.get_batch(designed)
+            if batch is None:
+                break
+            sequences, save_paths = [], []
+            for item in batch:
+                esmf_dir = self.output_dir / "esmf" / item["sample_id"]
+                esmf_dir.mkdir(parents=True, exist_ok=True)
+                item["sample_paths"] = [str(esmf_dir / f"sample_{i}.pdb") for i in range(1, len(item["records"]) + 1)]
+                sequences += [sequence for _, sequence in item["records"]]
+                save_paths += item["sample_paths"]
+
+            # the sequences of every design in the batch are folded together
+            folding_results = self.runner.fold_sequences(sequences, save_paths)
+            pos = 0
+            for item in batch:
+                item["folding_results"] = folding_results[pos : pos + len(item["records"])]
+                pos += len(item["records"])
+                self.put(folded, item)
+        self.put(folded, done)
+
+    def metrics_stage(self, folded):
+        with ProcessPoolExecutor(self.n_metric_workers, mp_context=spawn_context) as pool:
+            pending = []
+            while True:
+                item = self.get(folded)
+                if item is not done:
+                    future = pool.submit(alignment_metrics, item["reference_path"], item["sample_paths"])
+                    pending.append((item, future))
+                # results are written in submission order, waiting for the oldest design when too many are in flight
+                while pending and (pending[0][1].done() or item is done or len(pending) > self.queue_size):
+                    finished_item, future = pending.pop(0)
+                    self.write_results(finished_item, future.result())
+                if item is done:
+                    break
+
+    def write_results(self, item, metrics: List[dict]):
+        rows = []
+        for (header, sequence), mpnn_score, sample_path, folding_result, metric in zip(
+            item["records"], item["mpnn_scores"], item["sample_paths"], item["folding_results"], metrics
+        ):
+            rows.append(
+                {
+                    "sample_id": item["sample_id"],
+                    "reference_path": item["reference_path"],
+                    "header": header,
+                    "sequence": sequence,
+                    "mpnn_score": mpnn_score,
+                    "sample_path": sample_path,
+                    "tm_score": metric["tm_score"],
+                    "bb_rmsd": metric["bb_rmsd"],
+                    "ptm": folding_result["ptm"],
+                    "plddt": folding_result["plddt"],
+                    "pae": folding_result["pae"],
+                }
+            )
+        # rows of a design are appended together, so a design is either complete in the table or missing
+        df = pd.DataFrame(rows, columns=result_columns)
+        df.to_csv(self.results_path, mode="a", header=not self.results_path.exists(), index=False)
+        self.stats["n_samples"] += 1
+        self.stats["n_sequences"] += len(rows)
+
+
+def find_samples(samples_dir: str, pdb_name: str = "sample.pdb") -> List[tuple]:
+    """(sample_id, path) of every pdb_name under samples_dir, with the sample_id being its directory relative to samples_dir."""
+    samples_dir = Path(samples_dir)
+    paths = sorted(samples_dir.rglob(pdb_name))
+    return [(str(p.parent.relative_to(samples_dir)), str(p)) for p in paths]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Pipelined designability evaluation")
+    p.add_argument("--config", type=str, default="configs/evaluation.yaml")
+    p.add_argument("--samples_dir", type=str, required=True, help="directory searched for designs")
+    p.add_argument("--pdb_name", type=str, default="sample.pdb", help="file name of the designs")
+    p.add_argument("--output_dir", type=str, required=True)
+    p.add_argument("--batch_samples", type=int, default=16)
+    p.add_argument("--queue_size", type=int, default=32)
+    p.add_argument("--n_parse_workers", type=int, default=2)
+    p.add_argument("--n_metric_workers", type=int, default=4)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    from EvalRunner_jupyter import EvalRunner
+
+    args = parse_args()
+    runner = EvalRunner(OmegaConf.load(args.config))
+    pipeline = DesignabilityPipeline(
+        runner,
+        args.output_dir,
+        batch_samples=args.batch_samples,
+        queue_size=args.queue_size,
+        n_parse_workers=args.n_parse_workers,
+        n_metric_workers=args.n_metric_workers,
+    )
+    results = pipeline.run(find_samples(args.samples_dir, args.pdb_name))
+    stats = pipeline.stats
+    print(
+        f"evaluated {stats['n_samples']} designs ({stats['n_sequences']} sequences) in {stats['elapsed']:.1f} s, "
+        f"designable fraction (scTM > 0.5) {np.mean(results.groupby('sample_id')['tm_score'].max() > 0.5):.3f}"
+    )
+    if runner.result_cache is not None:
+        print(runner.result_cache.summary())
@@ -0,0 +1,234 @@
+"""In-process all-vs-all TM-score clustering of designs, which replaced the maxcluster binary.
+
+calc_diversity used to run ./maxcluster64bit with average linkage at a TM-score threshold of 0.5 and read the number
+of clusters and the centroids from its output. Here every unordered pair of CA traces is aligned once with tmtools
+in a process pool, and the designs are clustered with average linkage on 1 - TM-score. The TM-score of a pair is
+the mean of its TM-scores normalized by either structure, which makes it symmetric.
+
+With a ResultCache, TM-scores are stored by the hashes of both structures, so pairs compared in earlier runs are
+not aligned again. Structures added to a DiversityEngine are only aligned against each other and the structures
+already in it, and the clusters are then recomputed from the stored scores. Run from the protein directory:
+
+    python -m analysis.diversity --pdb_csv pdb_path.csv --output cluster/cluster_results.csv
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+from tmtools import tm_align
+
+from analysis.result_cache import ResultCache, pair_key, structure_key
+from analysis.structure_metrics import load_structure
+from data import protein
+from data import residue_constants
+from data import utils as du
+
+ca_idx = residue_constants.atom_order["CA"]
+
+# CA traces and sequences of every structure, set once in each worker process
+_worker_structures = None
+
+
+def _init_worker(structures):
+    global _worker_structures
+    _worker_structures = structures
+
+
+def _align_pairs(i_idx: np.ndarray, j_idx: np.ndarray) -> np.ndarray:
+    """[n_pairs, 2] TM-scores of structures i and j, normalized by i and by j."""
+    scores = np.zeros((len(i_idx), 2))
+    for k, (i, j) in enumerate(zip(i_idx, j_idx)):
+        ca_i, seq_i = _worker_structures[i]
+        ca_j, seq_j = _worker_structures[j]
+        result = tm_align(ca_i, ca_j, seq_i, seq_j)
+        scores[k] = result.tm_norm_chain1, result.tm_norm_chain2
+    return scores
+
+
+class DiversityEngine:
+    """Pairwise TM-scores and average linkage clusters of a growing set of structures.
+
+    Usage:
+        engine = DiversityEngine(cache=runner.result_cache)
+        engine.add(pdb_paths)
+        clusters = engine.cluster()
+    """
+
+    def __init__(
+        self,
+        tm_threshold: float = 0.5,
+        n_workers: int = 8,
+        chunk_size: int = 256,
+        cache: Optional[ResultCache] = None,
+    ):
+        """
+        Args:
+            tm_threshold: clusters are cut where the average TM-score between two clusters falls below it, as -Tm of maxcluster.
+            n_workers: processes that run TM-align.
+            chunk_size: pairs aligned per task.
+            cache: store of TM-scores, looked up before aligning.
+        """
+        self.tm_threshold = tm_threshold
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+        self.names = []
+        self.keys = []
+        self.structures = []
+        self.similarity = np.zeros((0, 0))
+        self.stats = dict(n_pairs=0, n_cached=0, n_aligned=0, elapsed=0.0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, structures: List[Union[str, Path, protein.Protein]], names: Optional[List[str]] = None):
+        """Adds PDB paths or Proteins and computes their TM-scores against each other and the structures added before.
+
+        names identify the structures in the clusters, by default their paths.
+        """
+        start = time.perf_counter()
+        if names is None:
+            names = [
+                f"structure_{len(self) + i}" if isinstance(s, protein.Protein) else str(s)
+                for i, s in enumerate(structures)
+            ]
+        n_old = len(self)
+        for name, s in zip(names, structures):
+            prot = s if isinstance(s, protein.Protein) else load_structure(s)
+            if prot is None:
+                print(f"WARNING: skipping {name}, which has no atoms")
+                continue
+            ca_mask = prot.atom_mask[:, ca_idx] > 0
+            ca = np.ascontiguousarray(prot.atom_positions[ca_mask, ca_idx], dtype=np.float64)
+            sequence = du.aatype_to_seq(prot.aatype[ca_mask])
+            self.names.append(name)
+            self.keys.append(structure_key(ca, sequence))
+            self.structures.append((ca, sequence))
+
+        # every pair with at least one new structure, each unordered pair once
+        n = len(self)
+        j_idx = np.concatenate([np.full(j, j) for j in range(n_old, n)] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        i_idx = np.concatenate([np.arange(j) for j in range(n_old, n)] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        scores = self.pair_scores(i_idx, j_idx)
+
+        similarity = np.eye(n)
+        similarity[:n_old, :n_old] = self.similarity
+        similarity[i_idx, j_idx] = scores
+        similarity[j_idx, i_idx] = scores
+        self.similarity = similarity
+        self.stats["elapsed"] += time.perf_counter() - start
+
+    def pair_scores(self, i_idx: np.ndarray, j_idx: np.ndarray) -> np.ndarray:
+        """Symmetric TM-scores of the pairs of structures (i_idx, j_idx), from the cache or aligned."""
+        scores = np.full(len(i_idx), np.nan)
+        pair_keys = [pair_key(self.keys[i], self.keys[j]) for i, j in zip(i_idx, j_idx)]
+        # a structure hash in the first position of pair_key gets the TM-score normalized by its own length
+        in_order = np.array([self.keys[i] <= self.keys[j] for i, j in zip(i_idx, j_idx)], dtype=bool)
+
+        identical = np.array([self.keys[i] == self.keys[j] for i, j in zip(i_idx, j_idx)], dtype=bool)
+        scores[identical] = 1.0
+        if self.cache is not None:
+            cached = self.cache.get_tm_scores([k for k, same in zip(pair_keys, identical) if not same])
+            for k, key in enumerate(pair_keys):
+                if key in cached:
+                    scores[k] = np.mean(cached[key])
+            self.stats["n_cached"] += len(cached)
+
+        todo = np.flatnonzero(np.isnan(scores))
+        tm = self.align(i_idx[todo], j_idx[todo])
+        scores[todo] = tm.mean(axis=1)
+        if self.cache is not None and len(todo) > 0:
+            self.cache.put_tm_scores([
+                (pair_keys[k], *(tm[t] if in_order[k] else tm[t, ::-1]))
+                for t, k in enumerate(todo)
+            ])
+
+        self.stats["n_pairs"] += len(i_idx)
+        self.stats["n_aligned"] += len(todo)
+        return scores
+
+    def align(self, i_idx: np.ndarray, j_idx: np.ndarray) -> np.ndarray:
+        """[n_pairs, 2] TM-scores of the pairs, normalized by i and by j, aligned with TM-align in a process pool."""
+        if len(i_idx) == 0:
+            return np.zeros((0, 2))
+        chunks = [
+            (i_idx[k : k + self.chunk_size], j_idx[k : k + self.chunk_size])
+            for k in range(0, len(i_idx), self.chunk_size)
+        ]
+        if self.n_workers <= 1:
+            _init_worker(self.structures)
+            return np.concatenate([_align_pairs(i, j) for i, j in chunks])
+        # the CA traces are sent to every worker once, tasks only hold indices
+        with ProcessPoolExecutor(self.n_workers, initializer=_init_worker, initargs=(self.structures,)) as pool:
+            return np.concatenate(list(pool.map(_align_pairs, *zip(*chunks))))
+
+    def cluster(self) -> pd.DataFrame:
+        """Cluster of every structure, numbered from 1 by decreasing size, and the centroid of its cluster.
+
+        The centroid of a cluster is the member with the highest mean TM-score to the other members.
+        """
+        n = len(self)
+        if n == 0:
+            return pd.DataFrame(columns=["name", "cluster", "centroid", "is_centroid"])
+        if n == 1:
+            labels = np.ones(1, dtype=np.int64)
+        else:
+            distance = 1 - self.similarity
+            np.fill_diagonal(distance, 0)
+            tree = linkage(squareform(distance, checks=False), method="average")
+            labels = fcluster(tree, t=1 - self.tm_threshold, criterion="distance")
+
+        # renumber clusters by decreasing size, like maxcluster
+        unique, counts = np.unique(labels, return_counts=True)
+        order = unique[np.argsort(-counts, kind="stable")]
+        cluster = np.empty(n, dtype=np.int64)
+        centroids = {}
+        for c, label in enumerate(order, start=1):
+            members = np.flatnonzero(labels == label)
+            cluster[members] = c
+            centroids[c] = members[np.argmax(self.similarity[np.ix_(members, members)].mean(axis=1))]
+        return pd.DataFrame({
+            "name": self.names,
+            "cluster": cluster,
+            "centroid": [self.names[centroids[c]] for c in cluster],
+            "is_centroid": [centroids[c] == i for i, c in enumerate(cluster)],
+        })
+
+    def centroids(self) -> List[str]:
+        """Names of the cluster centroids, from the largest cluster to the smallest."""
+        clusters = self.cluster()
+        return clusters[clusters["is_centroid"]].sort_values("cluster")["name"].tolist()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="TM-score clustering of designs")
+    p.add_argument("--pdb_csv", type=str, required=True, help="csv file without header, with a PDB path per line")
+    p.add_argument("--output", type=str, required=True, help="csv file for the cluster of every design")
+    p.add_argument("--tm_threshold", type=float, default=0.5)
+    p.add_argument("--n_workers", type=int, default=8)
+    p.add_argument("--cache_path", type=str, default=None, help="SQLite result cache that keeps the TM-scores")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cache = ResultCache(args.cache_path) if args.cache_path is not None else None
+    engine = DiversityEngine(tm_threshold=args.tm_threshold, n_workers=args.n_workers, cache=cache)
+    engine.add(pd.read_csv(args.pdb_csv, header=None)[0].tolist())
+    clusters = engine.cluster()
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    clusters.to_csv(args.output, index=False)
+    stats = engine.stats
+    print(
+        f"{clusters['cluster'].nunique()} clusters of {len(engine)} designs, "
+        f"{stats['n_aligned']} of {stats['n_pairs']} pairs aligned in {stats['elapsed']:.1f} s"
+    )
+    if cache is not None:
+        print(cache.summary())
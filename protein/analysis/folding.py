@@ -0,0 +1,233 @@
+import re
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from analysis.result_cache import ResultCache, folding_key
+
+
+# trunk chunk sizes tried for a bucket, from fastest to most memory efficient
+chunk_sizes = (None, 128, 64, 32)
+
+
+def clean_sequence(sequence: str) -> str:
+    """Same cleaning as EvalRunner_jupyter.run_folding: upper case residues with ':' between chains."""
+    sequence = re.sub("[^A-Z:]", "", sequence.replace("/", ":").upper())
+    sequence = re.sub(":+", ":", sequence)
+    sequence = re.sub("^[:]+", "", sequence)
+    sequence = re.sub("[:]+$", "", sequence)
+    return sequence
+
+
+class BatchedFolder:
+    """Folds many sequences with ESMFold in padded batches of sequences with similar lengths.
+
+    Unique sequences are sorted by length and split into buckets whose longest sequence is at most max_length_ratio
+    times the shortest, so little compute is spent on padding. The batch size and trunk chunk size of a bucket are
+    chosen from a memory budget with a rough estimate of ESMFold's activation memory. A batch that still runs out of
+    memory is split in half, and a single sequence is retried with smaller chunks. Every out of memory error doubles
+    the estimate, so the batches that follow are planned more conservatively.
+
+    With a ResultCache, sequences folded before with the same model version and settings are read from it instead.
+    """
+
+    # rough activation memory of ESMFold inference per residue pair, per triangle attention row of a pair and per residue
+    pair_bytes = 4096
+    attention_bytes = 16
+    residue_bytes = 1 << 17
+
+    def __init__(
+        self,
+        model,
+        device,
+        memory_budget_mb: Optional[float] = None,
+        max_batch_size: int = 32,
+        max_length_ratio: float = 1.1,
+        num_recycles: Optional[int] = 3,
+        chain_linker: int = 25,
+        linker_residue: str = "X",
+        residue_index_offset: int = 512,
+        cache: Optional[ResultCache] = None,
+        model_version: str = "esmfold_v1",
+    ):
+        """
+        Args:
+            model: an ESMFold model.
+            memory_budget_mb: memory available to activations, by default 80% of the free memory on device.
+            max_batch_size: most sequences folded together.
+            max_length_ratio: most the longest sequence of a bucket can exceed its shortest, as a ratio.
+            num_recycles, chain_linker, residue_index_offset: passed to ESMFold, defaults match
+                EvalRunner_jupyter.run_folding. num_recycles None uses the model's default, as infer_pdb does.
+            linker_residue: residue repeated chain_linker times between chains, "X" as in run_folding or
+                "G" as in ESMFold's infer_pdb.
+            cache: store of folding results, looked up before folding.
+            model_version: identifies the weights in cache keys.
+        """
+        self.model = model
+        self.device = device
+        self.memory_budget_mb = memory_budget_mb
+        self.max_batch_size = max_batch_size
+        self.max_length_ratio = max_length_ratio
+        self.num_recycles = num_recycles
+        self.chain_linker = chain_linker
+        self.linker_residue = linker_residue
+        self.residue_index_offset = residue_index_offset
+        self.cache = cache
+        self.model_version = model_version
+
+        self.memory_scale = 1.0
+        self.stats = dict(n_sequences=0, n_unique=0, n_cached=0, n_batches=0, n_oom=0, elapsed=0.0)
+
+    def memory_budget(self) -> float:
+        """Bytes that a batch may use."""
+        if self.memory_budget_mb is not None:
+            return self.memory_budget_mb * 2**20
+        if str(self.device).startswith("cuda"):
+            free, _ = torch.cuda.mem_get_info(self.device)
+            # memory cached by torch but not in use is also available
+            cached = torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+            return 0.8 * (free + cached)
+        return 4 * 2**30
+
+    @property
+    def effective_recycles(self) -> int:
+        """Number of recycles ESMFold runs, resolving num_recycles None to the trunk's max_recycles."""
+        if self.num_recycles is not None:
+            return self.num_recycles
+        return self.model.cfg.trunk.max_recycles
+
+    def folded_length(self, sequence: str) -> int:
+        """Number of residues ESMFold folds, counting the linkers between chains."""
+        chains = sequence.split(":")
+        return sum(len(c) for c in chains) + self.chain_linker * (len(chains) - 1)
+
+    def estimate_memory(self, length: int, chunk_size: Optional[int]) -> float:
+        """Estimated bytes to fold one sequence of length residues."""
+        attention_rows = length if chunk_size is None else min(chunk_size, length)
+        per_sequence = length**2 * (self.pair_bytes + self.attention_bytes * attention_rows) + length * self.residue_bytes
+        return self.memory_scale * per_sequence
+
+    def plan(self, length: int, n_sequences: int):
+        """Batch size and chunk size for n_sequences of at most length residues.
+
+        Takes the largest chunk size that fits the whole bucket, or a full batch, in one go, and otherwise the
+        chunk size that fits the most sequences.
+        """
+        budget = self.memory_budget()
+        target = min(n_sequences, self.max_batch_size)
+        best_batch_size, best_chunk_size = 1, chunk_sizes[-1]
+        for chunk_size in chunk_sizes:
+            batch_size = int(min(budget // self.estimate_memory(length, chunk_size), target))
+            if batch_size >= target:
+                return target, chunk_size
+            if batch_size > best_batch_size:
+                best_batch_size, best_chunk_size = batch_size, chunk_size
+        return best_batch_size, best_chunk_size
+
+    def buckets(self, lengths: np.ndarray) -> List[List[int]]:
+        """Indices of lengths grouped into buckets of similar length, from short to long."""
+        order = np.argsort(lengths, kind="stable")
+        buckets = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end == len(order) or lengths[order[end]] > self.max_length_ratio * lengths[order[start]]:
+                buckets.append(order[start:end].tolist())
+                start = end
+        return buckets
+
+    def fold(self, sequences: List[str]) -> List[Dict]:
+        """Folds sequences, returning a dict per sequence with pdb_string, ptm, plddt and pae.
+
+        plddt and pae are means over the residues of the sequence. Duplicate sequences are folded once.
+        """
+        start = time.perf_counter()
+        sequences = [clean_sequence(s) for s in sequences]
+        unique = list(dict.fromkeys(sequences))
+
+        results = {}
+        if self.cache is not None:
+            keys = {
+                s: folding_key(s, self.model_version, self.effective_recycles, self.linker_residue * self.chain_linker)
+                for s in unique
+            }
+            cached = self.cache.get_folding(list(keys.values()))
+            results = {s: cached[keys[s]] for s in unique if keys[s] in cached}
+            self.stats["n_cached"] += len(results)
+            unique = [s for s in unique if s not in results]
+        lengths = np.array([self.folded_length(s) for s in unique])
+
+        for bucket in self.buckets(lengths):
+            bucket_seqs = [unique[i] for i in bucket]
+            max_length = int(lengths[bucket].max())
+            pos = 0
+            while pos < len(bucket_seqs):
+                # planned again for every batch, so that an out of memory error shrinks the rest of the bucket
+                batch_size, chunk_size = self.plan(max_length, len(bucket_seqs) - pos)
+                batch = bucket_seqs[pos : pos + batch_size]
+                batch_results = self.fold_batch(batch, chunk_size)
+                for sequence, result in zip(batch, batch_results):
+                    results[sequence] = result
+                if self.cache is not None:
+                    self.cache.put_folding([(keys[s], s, r) for s, r in zip(batch, batch_results)])
+                pos += len(batch)
+
+        self.stats["n_sequences"] += len(sequences)
+        self.stats["n_unique"] += len(results)
+        self.stats["elapsed"] += time.perf_counter() - start
+        return [results[s] for s in sequences]
+
+    def fold_batch(self, sequences: List[str], chunk_size: Optional[int]) -> List[Dict]:
+        try:
+            self.model.set_chunk_size(chunk_size)
+            with torch.no_grad():
+                output = self.model.infer(
+                    sequences,
+                    num_recycles=self.num_recycles,
+                    chain_linker=self.linker_residue * self.chain_linker,
+                    residue_index_offset=self.residue_index_offset,
+                )
+                results = self.parse_output(output)
+            self.stats["n_batches"] += 1
+            return results
+        except torch.cuda.OutOfMemoryError:
+            pass
+
+        # retried outside of the except block, which would keep the tensors of the failed batch alive
+        output = None
+        torch.cuda.empty_cache()
+        self.stats["n_oom"] += 1
+        self.memory_scale *= 2
+        if len(sequences) > 1:
+            half = (len(sequences) + 1) // 2
+            return self.fold_batch(sequences[:half], chunk_size) + self.fold_batch(sequences[half:], chunk_size)
+        smaller_chunk_sizes = [c for c in chunk_sizes if c is not None and (chunk_size is None or c < chunk_size)]
+        if len(smaller_chunk_sizes) == 0:
+            raise torch.cuda.OutOfMemoryError(
+                f"ESMFold ran out of memory on a sequence of {self.folded_length(sequences[0])} residues with chunk size {chunk_size}"
+            )
+        return self.fold_batch(sequences, smaller_chunk_sizes[0])
+
+    def parse_output(self, output) -> List[Dict]:
+        pdb_strings = self.model.output_to_pdb(output)
+        ptm = output["ptm"].float().cpu().numpy()
+        plddt = output["plddt"][..., 1].float().cpu().numpy()
+        # padding and chain linkers have no atoms
+        mask = (output["atom37_atom_exists"][..., 1] == 1).cpu().numpy()
+        # expected aligned error, computed as in EvalRunner_jupyter.run_folding
+        probs = output["aligned_confidence_probs"].float()
+        pae = ((probs * torch.arange(probs.shape[-1], device=probs.device)).mean(-1) * 31).cpu().numpy()
+
+        results = []
+        for i, pdb_string in enumerate(pdb_strings):
+            m = mask[i]
+            results.append(
+                {
+                    "pdb_string": pdb_string,
+                    "ptm": float(ptm[i]),
+                    "plddt": float(plddt[i][m].mean()),
+                    "pae": float(pae[i][m][:, m].mean()),
+                }
+            )
+        return results
@@ -0,0 +1,264 @@
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from analysis.result_cache import ResultCache, backbone_atom_idxs, backbone_key
+from data import protein
+from data import residue_constants
+
+# ProteinMPNN residue alphabet, sequences are sampled as indices into it
+mpnn_alphabet = "ACDEFGHIKLMNPQRSTVWYX"
+
+# ProteinMPNN's index of every residue_constants.restypes_with_x residue type
+aatype_to_mpnn = np.array([mpnn_alphabet.index(r) for r in residue_constants.restypes_with_x])
+
+
+def featurize(proteins: List[protein.Protein], device) -> Dict[str, torch.Tensor]:
+    """ProteinMPNN inputs for a batch of proteins, padded to the longest one.
+
+    Follows tied_featurize of protein_mpnn_utils with every residue designed: residues missing a backbone atom are
+    masked, and residue indices restart at an offset of 100 in every chain.
+    """
+    batch_size = len(proteins)
+    max_length = max(p.aatype.shape[0] for p in proteins)
+    X = np.zeros((batch_size, max_length, 4, 3), dtype=np.float32)
+    S = np.zeros((batch_size, max_length), dtype=np.int64)
+    mask = np.zeros((batch_size, max_length), dtype=np.float32)
+    chain_encoding = np.zeros((batch_size, max_length), dtype=np.int64)
+    residue_idx = -100 * np.ones((batch_size, max_length), dtype=np.int64)
+
+    for i, prot in enumerate(proteins):
+        length = prot.aatype.shape[0]
+        X[i, :length] = prot.atom_positions[:, backbone_atom_idxs]
+        mask[i, :length] = prot.atom_mask[:, backbone_atom_idxs].all(axis=-1)
+        S[i, :length] = aatype_to_mpnn[prot.aatype]
+        # chains are numbered from 1 in order of appearance, 0 is padding
+        _, first_idxs, chain_ordinal = np.unique(prot.chain_index, return_index=True, return_inverse=True)
+        chain_ordinal = np.argsort(np.argsort(first_idxs))[chain_ordinal]
+        chain_encoding[i, :length] = chain_ordinal + 1
+        residue_idx[i, :length] = np.arange(length) + 100 * chain_ordinal
+
+    X[mask == 0] = 0.0
+    feats = {
+        "X": X,
+        "S": S,
+        "mask": mask,
+        "chain_M": mask.copy(),
+        "chain_encoding_all": chain_encoding,
+        "residue_idx": residue_idx,
+    }
+    return {k: torch.from_numpy(v).to(device) for k, v in feats.items()}
+
+
+def sequence_scores(log_probs: torch.Tensor, S: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Mean negative log likelihood of each sequence over its masked residues, the score of protein_mpnn_run."""
+    nll = -torch.gather(log_probs, -1, S.unsqueeze(-1)).squeeze(-1)
+    return (nll * mask).sum(-1) / mask.sum(-1)
+
+
+def load_protein_mpnn(pmpnn_dir: str, model_name: str = "v_48_020", device="cpu"):
+    """Loads the ProteinMPNN model used by protein_mpnn_run.py from a checkout of the ProteinMPNN repository."""
+    pmpnn_dir = os.path.abspath(pmpnn_dir)
+    if pmpnn_dir not in sys.path:
+        sys.path.insert(0, pmpnn_dir)
+    from protein_mpnn_utils import ProteinMPNN
+
+    checkpoint_path = os.path.join(pmpnn_dir, "vanilla_model_weights", f"{model_name}.pt")
+    if not os.path.isfile(checkpoint_path):
+        raise FileNotFoundError(f"ProteinMPNN weights not found at {checkpoint_path}")
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model = ProteinMPNN(
+        ca_only=False,
+        num_letters=21,
+        node_features=128,
+        edge_features=128,
+        hidden_dim=128,
+        num_encoder_layers=3,
+        num_decoder_layers=3,
+        augment_eps=0.0,
+        k_neighbors=checkpoint["num_edges"],
+    )
+    model.load_state_dict(checkpoint["model_state_dict"])
+    return model.to(device).eval().requires_grad_(False)
+
+
+class StandInProteinMPNN(torch.nn.Module):
+    """Has the sample and forward interface of ProteinMPNN but samples residues uniformly, and needs no weights.
+
+    Lets the inverse folding stage, and everything downstream of it, run without a ProteinMPNN checkout.
+    """
+
+    def sample(self, X, randn, S_true, chain_mask, chain_encoding_all, residue_idx, mask=None, temperature=1.0,
+               omit_AAs_np=None, **kwargs):
+        logits = torch.zeros(*S_true.shape, len(mpnn_alphabet), device=X.device)
+        if omit_AAs_np is not None:
+            logits[..., torch.from_numpy(omit_AAs_np).to(X.device) > 0] = -float("inf")
+        probs = torch.softmax(logits, dim=-1)
+        S = torch.multinomial(probs.view(-1, probs.shape[-1]), 1).view(S_true.shape)
+        return {"S": S, "probs": probs, "decoding_order": torch.argsort(randn, dim=-1)}
+
+    def forward(self, X, S, mask, chain_M, residue_idx, chain_encoding_all, randn, use_input_decoding_order=False,
+                decoding_order=None):
+        return torch.full((*S.shape, len(mpnn_alphabet)), -np.log(len(mpnn_alphabet)), device=X.device)
+
+
+class InverseFolder:
+    """ProteinMPNN kept in memory, designing sequences for many backbones per forward pass.
+
+    Replaces the parse_multiple_chains.py and protein_mpnn_run.py subprocesses of calc_designability. Backbones are
+    read directly from Protein objects, each is repeated num_seqs times, and the copies are sorted by length and
+    sampled in padded batches of up to max_batch_size. Sampling settings default to those calc_designability passed
+    to protein_mpnn_run.py. Sequences of complexes have their chains separated by '/'.
+    """
+
+    def __init__(
+        self,
+        model,
+        device,
+        num_seqs: int = 3,
+        temperature: float = 0.1,
+        seed: int = 38,
+        max_batch_size: int = 64,
+        omit_aas: str = "X",
+        cache: Optional[ResultCache] = None,
+        model_version: str = "v_48_020",
+    ):
+        """
+        Args:
+            cache: store of designed sequences, looked up before designing.
+            model_version: identifies the weights in cache keys.
+        """
+        self.model = model
+        self.device = device
+        self.num_seqs = num_seqs
+        self.temperature = temperature
+        self.seed = seed
+        self.max_batch_size = max_batch_size
+        self.omit_aas_np = np.array([aa in omit_aas for aa in mpnn_alphabet], dtype=np.float32)
+        self.cache = cache
+        self.model_version = model_version
+        self.stats = dict(n_backbones=0, n_cached=0, n_sequences=0, n_batches=0, elapsed=0.0)
+
+    @classmethod
+    def from_weights(cls, pmpnn_dir: str, device, model_name: str = "v_48_020", **kwargs) -> "InverseFolder":
+        return cls(load_protein_mpnn(pmpnn_dir, model_name, device), device, model_version=model_name, **kwargs)
+
+    @classmethod
+    def stand_in(cls, device, **kwargs) -> "InverseFolder":
+        return cls(StandInProteinMPNN().to(device), device, model_version="stand_in", **kwargs)
+
+    def design(self, proteins: List[protein.Protein], seed: Optional[int] = None) -> List[List[Dict]]:
+        """Samples num_seqs sequences for every protein.
+
+        Returns a list per protein of dicts with the designed sequence and its score. Sampling is seeded with seed,
+        or self.seed, so the same call returns the same sequences. With a cache, backbones designed before with the
+        same model and settings are not designed again, and their stored sequences are returned.
+        """
+        start = time.perf_counter()
+        seed = self.seed if seed is None else seed
+        designs = [None] * len(proteins)
+        if self.cache is not None:
+            keys = [backbone_key(p, self.model_version, seed, self.num_seqs, self.temperature) for p in proteins]
+            cached = self.cache.get_designs(keys)
+            designs = [cached.get(key) for key in keys]
+            self.stats["n_cached"] += sum(d is not None for d in designs)
+
+        # every backbone without designs is repeated num_seqs times
+        copies = [(i, j) for i in range(len(proteins)) if designs[i] is None for j in range(self.num_seqs)]
+        copies.sort(key=lambda c: proteins[c[0]].aatype.shape[0])
+        new_designs = {i: [None] * self.num_seqs for i, _ in copies}
+
+        fork_devices = [self.device] if str(self.device).startswith("cuda") else []
+        with torch.random.fork_rng(devices=fork_devices), torch.no_grad():
+            torch.manual_seed(seed)
+            for batch_start in range(0, len(copies), self.max_batch_size):
+                batch = copies[batch_start : batch_start + self.max_batch_size]
+                results = self.sample_batch([proteins[i] for i, _ in batch])
+                for (i, j), result in zip(batch, results):
+                    new_designs[i][j] = result
+
+        for i, protein_designs in new_designs.items():
+            designs[i] = protein_designs
+        if self.cache is not None:
+            self.cache.put_designs([(keys[i], protein_designs) for i, protein_designs in new_designs.items()])
+
+        self.stats["n_backbones"] += len(proteins)
+        self.stats["n_sequences"] += len(copies)
+        self.stats["elapsed"] += time.perf_counter() - start
+        return designs
+
+    def sample_batch(self, proteins: List[protein.Protein]) -> List[Dict]:
+        feats = featurize(proteins, self.device)
+        X, S, mask = feats["X"], feats["S"], feats["mask"]
+        chain_M, residue_idx, chain_encoding_all = feats["chain_M"], feats["residue_idx"], feats["chain_encoding_all"]
+        batch_size, max_length = S.shape
+        n_letters = len(mpnn_alphabet)
+
+        randn = torch.randn(chain_M.shape, device=self.device)
+        sample_dict = self.model.sample(
+            X,
+            randn,
+            S,
+            chain_M,
+            chain_encoding_all,
+            residue_idx,
+            mask=mask,
+            temperature=self.temperature,
+            omit_AAs_np=self.omit_aas_np,
+            bias_AAs_np=np.zeros(n_letters),
+            chain_M_pos=torch.ones_like(chain_M),
+            omit_AA_mask=torch.zeros(batch_size, max_length, n_letters, device=self.device),
+            pssm_coef=torch.zeros(batch_size, max_length, device=self.device),
+            pssm_bias=torch.zeros(batch_size, max_length, n_letters, device=self.device),
+            pssm_multi=0.0,
+            pssm_log_odds_flag=False,
+            pssm_log_odds_mask=torch.ones(batch_size, max_length, n_letters, device=self.device),
+            pssm_bias_flag=False,
+            bias_by_res=torch.zeros(batch_size, max_length, n_letters, device=self.device),
+        )
+        S_sample = sample_dict["S"]
+
+        # score the samples in the order they were decoded, as protein_mpnn_run does
+        log_probs = self.model(
+            X,
+            S_sample,
+            mask,
+            chain_M,
+            residue_idx,
+            chain_encoding_all,
+            torch.randn(chain_M.shape, device=self.device),
+            use_input_decoding_order=True,
+            decoding_order=sample_dict["decoding_order"],
+        )
+        scores = sequence_scores(log_probs, S_sample, mask).cpu().numpy()
+
+        S_sample = S_sample.cpu().numpy()
+        chain_encoding_all = chain_encoding_all.cpu().numpy()
+        results = []
+        for i in range(batch_size):
+            # every residue of a chain is kept, also those with missing backbone atoms, as protein_mpnn_run does with
+            # chain_M, so the sequence has the length of the structure. padding has chain encoding 0
+            chains = [
+                "".join(mpnn_alphabet[s] for s in S_sample[i][chain_encoding_all[i] == c])
+                for c in np.unique(chain_encoding_all[i][chain_encoding_all[i] > 0])
+            ]
+            results.append({"sequence": "/".join(chains), "score": float(scores[i])})
+        self.stats["n_batches"] += 1
+        return results
+
+
+def fasta_records(name: str, native_sequence: str, designs: List[Dict], temperature: float) -> List[Tuple[str, str]]:
+    """(header, sequence) pairs in the layout of protein_mpnn_run.py output, with the native sequence first."""
+    records = [(f"{name}, native", native_sequence)]
+    for i, design in enumerate(designs, start=1):
+        records.append((f"T={temperature}, sample={i}, score={design['score']:.4f}", design["sequence"]))
+    return records
+
+
+def write_fasta(fasta_path: str, records: List[Tuple[str, str]]):
+    with open(fasta_path, "w") as f:
+        f.write("".join(f">{header}\n{sequence}\n" for header, sequence in records))
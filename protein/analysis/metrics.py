@@ -1,10 +1,11 @@
 """Metrics."""
 
-import mdtraj as md
 import numpy as np
+import torch
 from openfold.np import residue_constants
 from tmtools import tm_align
 import data.utils as du
+from analysis.structure_metrics import structure_metrics
 from openfold.utils.superimposition import superimpose
 
 
@@ -37,28 +38,7 @@ def calc_aligned_rmsd(pos_1, pos_2):
 
 
 def calc_mdtraj_metrics(pdb_path):
-    try:
-        traj = md.load(pdb_path)
-        pdb_ss = md.compute_dssp(traj, simplified=True)
-        pdb_coil_percent = np.mean(pdb_ss == "C")
-        pdb_helix_percent = np.mean(pdb_ss == "H")
-        pdb_strand_percent = np.mean(pdb_ss == "E")
-        pdb_ss_percent = pdb_helix_percent + pdb_strand_percent
-        pdb_rg = md.compute_rg(traj)[0]
-    except IndexError as e:
-        print("Error in calc_mdtraj_metrics: {}".format(e))
-        pdb_ss_percent = 0.0
-        pdb_coil_percent = 0.0
-        pdb_helix_percent = 0.0
-        pdb_strand_percent = 0.0
-        pdb_rg = 0.0
-    return {
-        "non_coil_percent": pdb_ss_percent,
-        "coil_percent": pdb_coil_percent,
-        "helix_percent": pdb_helix_percent,
-        "strand_percent": pdb_strand_percent,
-        "radius_of_gyration": pdb_rg,
-    }
+    return structure_metrics([pdb_path], n_workers=1)[0]
 
 
 def calc_ca_ca_metrics(ca_pos, bond_tol=0.1, clash_tol=1.0):
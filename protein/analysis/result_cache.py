@@ -0,0 +1,153 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from data import protein
+from data import residue_constants
+
+# most keys looked up in one query, below SQLite's limit on query parameters
+max_query_keys = 500
+
+# N, CA, C, O, the atoms ProteinMPNN reads
+backbone_atom_idxs = [residue_constants.atom_order[a] for a in ["N", "CA", "C", "O"]]
+
+
+def folding_key(sequence: str, model_version: str, num_recycles: int, chain_linker: str) -> str:
+    """Key of a folding result: the hash of the sequence and of the settings that change the prediction.
+
+    num_recycles is the number of recycles actually run and chain_linker the linker sequence inserted between chains.
+    """
+    content = f"{model_version}|recycles={num_recycles}|linker={chain_linker}|{sequence}"
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def backbone_key(prot: protein.Protein, model_version: str, seed: int, num_seqs: int, temperature: float) -> str:
+    """Key of the sequences designed for a backbone: the hash of its backbone atoms, chains and the sampling settings.
+
+    Coordinates are rounded to the precision of a PDB file, so a backbone read back from a PDB has the same key.
+    """
+    backbone = np.round(prot.atom_positions[:, backbone_atom_idxs], 3).astype(np.float32) + np.float32(0.0) # no -0.0
+    backbone_mask = prot.atom_mask[:, backbone_atom_idxs].astype(np.uint8)
+    h = hashlib.sha256(f"{model_version}|seed={seed}|n={num_seqs}|T={temperature}".encode())
+    h.update(np.ascontiguousarray(backbone).tobytes())
+    h.update(np.ascontiguousarray(backbone_mask).tobytes())
+    h.update(np.asarray(prot.chain_index, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def structure_key(ca_positions: np.ndarray, sequence: str) -> str:
+    """Key of a structure in TM-score comparisons: the hash of its CA coordinates, rounded as in a PDB file, and sequence."""
+    ca = np.round(ca_positions, 3).astype(np.float32) + np.float32(0.0)
+    h = hashlib.sha256(sequence.encode())
+    h.update(np.ascontiguousarray(ca).tobytes())
+    return h.hexdigest()
+
+
+def pair_key(key_1: str, key_2: str) -> str:
+    """Key of a TM-score comparison of two structure_keys, in a fixed order so both orders share it."""
+    return f"{key_1}|{key_2}" if key_1 <= key_2 else f"{key_2}|{key_1}"
+
+
+class ResultCache:
+    """Content-addressed store of ESMFold and ProteinMPNN results in a SQLite database.
+
+    Folding results (the predicted structure as a PDB string, pTM, mean pLDDT and mean PAE) are keyed by folding_key,
+    designed sequences by backbone_key and the TM-scores of a pair of structures by pair_key. BatchedFolder and InverseFolder only run their models on keys that are
+    not in the store, so duplicate sequences and designs evaluated again in later experiments cost no GPU time.
+    DiversityEngine likewise only aligns pairs of structures that are not in the store.
+    The database can be shared by several processes. Hits and misses are counted per table in self.stats.
+    """
+
+    tables = {
+        "folding": "key TEXT PRIMARY KEY, sequence TEXT, pdb_string BLOB, ptm REAL, plddt REAL, pae REAL, created REAL",
+        "inverse_folding": "key TEXT PRIMARY KEY, designs TEXT, created REAL",
+        "tm_scores": "key TEXT PRIMARY KEY, tm_1 REAL, tm_2 REAL, created REAL",
+    }
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # the pipeline uses the cache from several threads, queries are serialized with a lock
+        self.connection = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        for table, columns in self.tables.items():
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.stats = {table: dict(hits=0, misses=0) for table in self.tables}
+
+    def lookup(self, table: str, columns: str, keys: List[str]) -> Dict[str, tuple]:
+        rows = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for i in range(0, len(unique_keys), max_query_keys):
+                chunk = unique_keys[i : i + max_query_keys]
+                query = f"SELECT key, {columns} FROM {table} WHERE key IN ({','.join('?' * len(chunk))})"
+                for row in self.connection.execute(query, chunk):
+                    rows[row[0]] = row[1:]
+            self.stats[table]["hits"] += sum(k in rows for k in keys)
+            self.stats[table]["misses"] += sum(k not in rows for k in keys)
+        return rows
+
+    def insert(self, table: str, rows: List[tuple]):
+        if len(rows) == 0:
+            return
+        with self.lock:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {table} VALUES ({','.join('?' * len(rows[0]))})", rows
+            )
+            self.connection.commit()
+
+    def get_folding(self, keys: List[str]) -> Dict[str, dict]:
+        rows = self.lookup("folding", "pdb_string, ptm, plddt, pae", keys)
+        return {
+            key: {"pdb_string": zlib.decompress(pdb_string).decode(), "ptm": ptm, "plddt": plddt, "pae": pae}
+            for key, (pdb_string, ptm, plddt, pae) in rows.items()
+        }
+
+    def put_folding(self, items: List[Tuple[str, str, dict]]):
+        """Stores (key, sequence, result) triples, with results as returned by BatchedFolder.fold."""
+        now = time.time()
+        self.insert("folding", [
+            (key, sequence, zlib.compress(r["pdb_string"].encode()), r["ptm"], r["plddt"], r["pae"], now)
+            for key, sequence, r in items
+        ])
+
+    def get_designs(self, keys: List[str]) -> Dict[str, List[dict]]:
+        rows = self.lookup("inverse_folding", "designs", keys)
+        return {key: json.loads(designs) for key, (designs,) in rows.items()}
+
+    def put_designs(self, items: List[Tuple[str, List[dict]]]):
+        """Stores (key, designs) pairs, with designs as returned by InverseFolder.design for one backbone."""
+        now = time.time()
+        self.insert("inverse_folding", [(key, json.dumps(designs), now) for key, designs in items])
+
+    def get_tm_scores(self, keys: List[str]) -> Dict[str, Tuple[float, float]]:
+        """TM-scores of pairs, normalized by the first and by the second structure in pair_key order."""
+        return self.lookup("tm_scores", "tm_1, tm_2", keys)
+
+    def put_tm_scores(self, items: List[Tuple[str, float, float]]):
+        """Stores (pair_key, tm_1, tm_2) triples."""
+        now = time.time()
+        self.insert("tm_scores", [(key, tm_1, tm_2, now) for key, tm_1, tm_2 in items])
+
+    def hit_rate(self, table: str) -> float:
+        n = self.stats[table]["hits"] + self.stats[table]["misses"]
+        return self.stats[table]["hits"] / n if n > 0 else 0.0
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{table} cache {s['hits']}/{s['hits'] + s['misses']} hits ({100 * self.hit_rate(table):.1f}%)"
+            for table, s in self.stats.items()
+        )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
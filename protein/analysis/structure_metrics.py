@@ -0,0 +1,162 @@
+"""Batched secondary structure fractions and radius of gyration of many structures.
+
+Gives the same metrics as calc_mdtraj_metrics, which loaded one PDB file per call with md.load and ran DSSP and
+compute_rg on a one-frame trajectory. Here structures are atom37 arrays, either read with data.pdb_reader or
+passed in memory, and structures with the same residues are stacked into one multi-frame trajectory, so that DSSP
+runs once per group. Groups are processed in a process pool.
+"""
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import mdtraj as md
+import numpy as np
+
+from data import protein
+from data import residue_constants
+from data.pdb_reader import read_pdb_chains
+
+# DSSP only reads the backbone, so the trajectory of a group holds just these atoms
+dssp_atoms = ["N", "CA", "C", "O"]
+dssp_atom_idxs = [residue_constants.atom_order[a] for a in dssp_atoms]
+
+metric_names = ["non_coil_percent", "coil_percent", "helix_percent", "strand_percent", "radius_of_gyration"]
+
+
+def zero_metrics() -> Dict[str, float]:
+    return {name: 0.0 for name in metric_names}
+
+
+def load_structure(pdb_path: Union[str, Path]) -> Optional[protein.Protein]:
+    """All chains of a PDB file as one Protein, or None if it has no atoms."""
+    chains = list(read_pdb_chains(pdb_path).values())
+    if len(chains) == 0:
+        return None
+    return protein.Protein(
+        atom_positions=np.concatenate([c["atom_positions"] for c in chains]),
+        atom_mask=np.concatenate([c["atom_mask"] for c in chains]),
+        aatype=np.concatenate([c["aatype"] for c in chains]),
+        residue_index=np.concatenate([c["residue_index"] for c in chains]),
+        chain_index=np.concatenate([np.full(len(c["aatype"]), i) for i, c in enumerate(chains)]),
+        b_factors=np.concatenate([c["b_factors"] for c in chains]),
+    )
+
+
+def dssp_topology(aatype: np.ndarray, chain_index: np.ndarray, residue_index: np.ndarray, bb_mask: np.ndarray) -> md.Topology:
+    """Topology of the backbone atoms in bb_mask [N, 4], with the residue names and chains of a PDB file."""
+    topology = md.Topology()
+    chains = {}
+    for i in range(len(aatype)):
+        if chain_index[i] not in chains:
+            chains[chain_index[i]] = topology.add_chain()
+        res_name = residue_constants.restype_1to3.get(residue_constants.restypes_with_x[aatype[i]], "UNK")
+        residue = topology.add_residue(res_name, chains[chain_index[i]], resSeq=int(residue_index[i]))
+        for j, atom_name in enumerate(dssp_atoms):
+            if bb_mask[i, j]:
+                topology.add_atom(atom_name, md.element.get_by_symbol(atom_name[0]), residue)
+    return topology
+
+
+def radius_of_gyration(atom_positions: np.ndarray, atom_mask: np.ndarray) -> np.ndarray:
+    """Radius of gyration in nm of every structure in atom_positions [B, N, 37, 3], over the atoms in atom_mask [B, N, 37].
+
+    Every atom has the same weight, as in md.compute_rg.
+    """
+    pos = atom_positions.reshape(len(atom_positions), -1, 3) / 10  # angstroms to nm
+    mask = atom_mask.reshape(len(atom_mask), -1)
+    n_atoms = mask.sum(axis=1)
+    center = (pos * mask[..., None]).sum(axis=1) / n_atoms[:, None]
+    sq_dists = np.sum((pos - center[:, None]) ** 2, axis=-1)
+    return np.sqrt((sq_dists * mask).sum(axis=1) / n_atoms)
+
+
+def group_metrics(
+        aatype: np.ndarray,
+        chain_index: np.ndarray,
+        residue_index: np.ndarray,
+        bb_mask: np.ndarray,
+        atom_positions: np.ndarray,
+        atom_mask: np.ndarray,
+    ) -> List[Dict[str, float]]:
+    """Metrics of a group of structures with the same residues and backbone atoms.
+
+    atom_positions [B, N, 37, 3] and atom_mask [B, N, 37] hold the structures of the group, the other arguments
+    are shared by all of them.
+    """
+    try:
+        topology = dssp_topology(aatype, chain_index, residue_index, bb_mask)
+        xyz = atom_positions[:, :, dssp_atom_idxs][:, bb_mask] / 10  # angstroms to nm
+        ss = md.compute_dssp(md.Trajectory(xyz.astype(np.float32), topology), simplified=True)
+        rg = radius_of_gyration(atom_positions, atom_mask)
+    except IndexError as e:
+        print("Error in calc_mdtraj_metrics: {}".format(e))
+        return [zero_metrics() for _ in range(len(atom_positions))]
+
+    helix = np.mean(ss == "H", axis=1)
+    strand = np.mean(ss == "E", axis=1)
+    return [
+        {
+            "non_coil_percent": float(helix[i] + strand[i]),
+            "coil_percent": float(np.mean(ss[i] == "C")),
+            "helix_percent": float(helix[i]),
+            "strand_percent": float(strand[i]),
+            "radius_of_gyration": float(rg[i]),
+        }
+        for i in range(len(atom_positions))
+    ]
+
+
+def structure_metrics(
+        structures: List[Union[str, Path, protein.Protein]],
+        n_workers: int = 4,
+    ) -> List[Dict[str, float]]:
+    """Secondary structure fractions and radius of gyration of every structure, in the format of calc_mdtraj_metrics.
+
+    structures are PDB file paths or Proteins, for example from au.create_full_prot, which skips writing and
+    parsing a PDB file. Files are read with data.pdb_reader, so only atom37 atoms of the first model are counted,
+    where md.load also kept hydrogens. Structures with the same length, residue types, chains and backbone atoms
+    share one DSSP trajectory.
+    """
+    pool = ProcessPoolExecutor(n_workers) if n_workers > 1 else None
+    try:
+        paths = [i for i, s in enumerate(structures) if not isinstance(s, protein.Protein)]
+        loaded = (pool.map if pool is not None else map)(load_structure, [structures[i] for i in paths])
+        prots = list(structures)
+        for i, prot in zip(paths, loaded):
+            prots[i] = prot
+
+        groups = defaultdict(list)
+        for i, prot in enumerate(prots):
+            if prot is None:
+                continue
+            bb_mask = prot.atom_mask[:, dssp_atom_idxs] > 0
+            key = (prot.aatype.astype(np.int64).tobytes(), prot.chain_index.astype(np.int64).tobytes(), bb_mask.tobytes())
+            groups[key].append(i)
+
+        args = []
+        for idxs in groups.values():
+            first = prots[idxs[0]]
+            args.append((
+                first.aatype,
+                first.chain_index,
+                first.residue_index,
+                first.atom_mask[:, dssp_atom_idxs] > 0,
+                np.stack([prots[i].atom_positions for i in idxs]),
+                np.stack([prots[i].atom_mask for i in idxs]),
+            ))
+        group_results = (pool.map if pool is not None else map)(group_metrics, *zip(*args)) if args else []
+
+        results = [None] * len(structures)
+        for idxs, metrics in zip(groups.values(), group_results):
+            for i, m in zip(idxs, metrics):
+                results[i] = m
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for i, m in enumerate(results):
+        if m is None:
+            print("Error in calc_mdtraj_metrics: no atoms in {}".format(structures[i]))
+            results[i] = zero_metrics()
+    return results
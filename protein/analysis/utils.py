@@ -1,6 +1,7 @@
 import numpy as np
 import os
 import re
+import threading
 from data import protein
 from openfold.utils import rigid_utils
 
@@ -33,6 +34,75 @@ def create_full_prot(
         b_factors=b_factors)
 
 
+# next free index for every indexed file path, so that its directory is only listed once per process
+_next_pdb_index = {}
+_next_pdb_index_lock = threading.Lock()
+
+
+def allocate_pdb_path(file_path: str) -> str:
+    """file_path with the next free _<index> suffix. The file is created, so no other writer can take the same index.
+
+    The largest index in the directory is looked up on the first call for file_path, later calls count up from it
+    and skip any index another process has created in the meantime.
+    """
+    with _next_pdb_index_lock:
+        if file_path not in _next_pdb_index:
+            file_dir = os.path.dirname(file_path)
+            file_name = os.path.basename(file_path).strip('.pdb')
+            existing_files = [x for x in os.listdir(file_dir or '.') if file_name in x]
+            max_existing_idx = max([
+                int(re.findall(r'_(\d+).pdb', x)[0]) for x in existing_files
+                if re.findall(r'_(\d+).pdb', x)] + [0])
+            _next_pdb_index[file_path] = max_existing_idx + 1
+
+        idx = _next_pdb_index[file_path]
+        while True:
+            save_path = file_path.replace('.pdb', '') + f'_{idx}.pdb'
+            try:
+                # creating the file with O_EXCL fails if it exists, also across processes
+                os.close(os.open(save_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                idx += 1
+        _next_pdb_index[file_path] = idx + 1
+    return save_path
+
+
+class PDBTrajectoryWriter:
+    """Writes the frames of a trajectory to a multi-model PDB file as they are produced, one model per frame.
+
+    Usage:
+        with PDBTrajectoryWriter(path, aatype) as writer:
+            for pos37 in frames:
+                writer.write_frame(pos37)
+    """
+
+    def __init__(self, file_path: str, aatype: np.ndarray=None, b_factors: np.ndarray=None):
+        self.file_path = file_path
+        self.aatype = aatype
+        self.b_factors = b_factors
+        self.n_frames = 0
+        self.file = open(file_path, 'w')
+
+    def write_frame(self, pos37: np.ndarray):
+        atom37_mask = np.sum(np.abs(pos37), axis=-1) > 1e-7
+        prot = create_full_prot(
+            pos37, atom37_mask, aatype=self.aatype, b_factors=self.b_factors)
+        self.file.write(protein.to_pdb(prot, model=self.n_frames + 1, add_end=False))
+        self.n_frames += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write('END')
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def write_prot_to_pdb(
         prot_pos: np.ndarray,
         file_path: str,
@@ -40,35 +110,24 @@ def write_prot_to_pdb(
         overwrite=False,
         no_indexing=False,
         b_factors=None,
+        index: int=None,
     ):
-    if overwrite:
-        max_existing_idx = 0
-    else:
-        file_dir = os.path.dirname(file_path)
-        file_name = os.path.basename(file_path).strip('.pdb')
-        existing_files = [x for x in os.listdir(file_dir) if file_name in x]
-        max_existing_idx = max([
-            int(re.findall(r'_(\d+).pdb', x)[0]) for x in existing_files if re.findall(r'_(\d+).pdb', x)
-            if re.findall(r'_(\d+).pdb', x)] + [0])
-    if not no_indexing:
-        save_path = file_path.replace('.pdb', '') + f'_{max_existing_idx+1}.pdb'
-    else:
+    """Writes atom37 positions of one structure [N, 37, 3] or of a trajectory [T, N, 37, 3] to a PDB file.
+
+    The file is file_path with an _<index> suffix: index if given, 1 with overwrite, and otherwise the next free
+    index from allocate_pdb_path. With no_indexing the file is file_path itself.
+    """
+    if prot_pos.ndim not in (3, 4):
+        raise ValueError(f'Invalid positions shape {prot_pos.shape}')
+    if no_indexing:
         save_path = file_path
-    with open(save_path, 'w') as f:
-        if prot_pos.ndim == 4:
-            for t, pos37 in enumerate(prot_pos):
-                atom37_mask = np.sum(np.abs(pos37), axis=-1) > 1e-7
-                prot = create_full_prot(
-                    pos37, atom37_mask, aatype=aatype, b_factors=b_factors)
-                pdb_prot = protein.to_pdb(prot, model=t + 1, add_end=False)
-                f.write(pdb_prot)
-        elif prot_pos.ndim == 3:
-            atom37_mask = np.sum(np.abs(prot_pos), axis=-1) > 1e-7
-            prot = create_full_prot(
-                prot_pos, atom37_mask, aatype=aatype, b_factors=b_factors)
-            pdb_prot = protein.to_pdb(prot, model=1, add_end=False)
-            f.write(pdb_prot)
-        else:
-            raise ValueError(f'Invalid positions shape {prot_pos.shape}')
-        f.write('END')
+    elif index is not None or overwrite:
+        index = 1 if index is None else index
+        save_path = file_path.replace('.pdb', '') + f'_{index}.pdb'
+    else:
+        save_path = allocate_pdb_path(file_path)
+
+    with PDBTrajectoryWriter(save_path, aatype=aatype, b_factors=b_factors) as writer:
+        for pos37 in (prot_pos if prot_pos.ndim == 4 else [prot_pos]):
+            writer.write_frame(pos37)
     return save_path
@@ -0,0 +1,97 @@
+"""Per-sequence ESMFold latency of EvalRunner_jupyter.run_folding, with the folding model reloaded for every sequence
+(the previous behaviour of run_folding) and with the model kept resident.
+
+The workload mirrors a designability run: n_samples designs with n_seqs_per_sample ProteinMPNN sequences each.
+Run from the protein directory:
+
+    python -m benchmarks.folding_latency --n_samples 100 --output benchmarks/folding_latency.json
+"""
+import argparse
+import json
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from EvalRunner_jupyter import EvalRunner
+
+amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="ESMFold latency benchmark")
+    p.add_argument("--config", type=str, default="configs/evaluation.yaml")
+    p.add_argument("--n_samples", type=int, default=100, help="number of designs in the simulated designability run")
+    p.add_argument("--n_seqs_per_sample", type=int, default=3, help="ProteinMPNN sequences folded per design")
+    p.add_argument("--lengths", type=int, nargs="+", default=[70], help="sequence lengths, cycled over designs")
+    p.add_argument("--modes", type=str, nargs="+", default=["reload", "resident"], choices=["reload", "resident"])
+    p.add_argument("--reload_samples", type=int, default=None, help="only fold this many designs in reload mode, which is slow")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--output", type=str, default=None)
+    return p.parse_args()
+
+
+def random_sequences(n_samples, n_seqs_per_sample, lengths, seed):
+    rng = np.random.default_rng(seed)
+    sequences = []
+    for sample_idx in range(n_samples):
+        length = lengths[sample_idx % len(lengths)]
+        for _ in range(n_seqs_per_sample):
+            sequences.append("".join(rng.choice(list(amino_acids), size=length)))
+    return sequences
+
+
+def sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def time_folding(runner, sequences, mode, out_dir):
+    times = []
+    for i, sequence in enumerate(sequences):
+        if mode == "reload":
+            runner.release_folding_model()
+        sync(runner.device)
+        start = time.perf_counter()
+        runner.run_folding(sequence, f"{out_dir}/seq_{i}.pdb")
+        sync(runner.device)
+        times.append(time.perf_counter() - start)
+    return {
+        "n_sequences": len(times),
+        "mean_s": statistics.mean(times),
+        "median_s": statistics.median(times),
+        "first_s": times[0],
+        "total_s": sum(times),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conf = OmegaConf.load(args.config)
+    runner = EvalRunner(conf)
+
+    sequences = random_sequences(args.n_samples, args.n_seqs_per_sample, args.lengths, args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for mode in args.modes:
+            mode_sequences = sequences
+            if mode == "reload" and args.reload_samples is not None:
+                mode_sequences = sequences[: args.reload_samples * args.n_seqs_per_sample]
+            runner.release_folding_model()
+            results[mode] = time_folding(runner, mode_sequences, mode, out_dir)
+            print(
+                f"{mode:<10} {results[mode]['n_sequences']:5d} sequences, "
+                f"mean {results[mode]['mean_s']*1000:9.1f} ms, median {results[mode]['median_s']*1000:9.1f} ms per sequence"
+            )
+
+    if "reload" in results and "resident" in results:
+        speedup = results["reload"]["mean_s"] / results["resident"]["mean_s"]
+        results["speedup"] = speedup
+        print(f"resident model is {speedup:.1f}x faster per sequence")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "device": runner.device, "results": results}, f, indent=2)
@@ -0,0 +1,115 @@
+"""ESMFold throughput of a self-consistency evaluation, folding ProteinMPNN sequences one at a time with
+EvalRunner_jupyter.run_folding and in length-bucketed batches with EvalRunner_jupyter.fold_sequences.
+
+The workload mirrors scTM evaluation over many backbones: n_samples designs with lengths drawn from
+[min_length, max_length] and n_seqs_per_sample sequences each. Both modes fold the first n_check sequences
+and the largest difference of their pTM and pLDDT is reported, as batching pads sequences and should not
+change the predictions. Run from the protein directory:
+
+    python -m benchmarks.folding_throughput --n_samples 1000 --sequential_samples 50 --output benchmarks/folding_throughput.json
+"""
+import argparse
+import json
+import tempfile
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from EvalRunner_jupyter import EvalRunner
+
+amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="ESMFold throughput benchmark")
+    p.add_argument("--config", type=str, default="configs/evaluation.yaml")
+    p.add_argument("--n_samples", type=int, default=1000, help="number of designs in the simulated evaluation")
+    p.add_argument("--n_seqs_per_sample", type=int, default=8, help="ProteinMPNN sequences folded per design")
+    p.add_argument("--min_length", type=int, default=50)
+    p.add_argument("--max_length", type=int, default=300)
+    p.add_argument("--modes", type=str, nargs="+", default=["sequential", "batched"], choices=["sequential", "batched"])
+    p.add_argument("--sequential_samples", type=int, default=None, help="only fold this many designs in sequential mode, which is slow")
+    p.add_argument("--memory_budget_mb", type=float, default=None, help="memory budget of the batched mode, by default 80%% of free memory")
+    p.add_argument("--max_batch_size", type=int, default=32)
+    p.add_argument("--n_check", type=int, default=16, help="sequences whose predictions are compared between modes")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--output", type=str, default=None)
+    return p.parse_args()
+
+
+def random_sequences(n_samples, n_seqs_per_sample, min_length, max_length, seed):
+    rng = np.random.default_rng(seed)
+    sequences = []
+    for length in rng.integers(min_length, max_length + 1, size=n_samples):
+        for _ in range(n_seqs_per_sample):
+            sequences.append("".join(rng.choice(list(amino_acids), size=length)))
+    return sequences
+
+
+def sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+def fold(runner, sequences, mode, out_dir):
+    """Returns the elapsed time and the (ptm, plddt) of every sequence."""
+    save_paths = [f"{out_dir}/seq_{i}.pdb" for i in range(len(sequences))]
+    sync(runner.device)
+    start = time.perf_counter()
+    if mode == "sequential":
+        scores = [runner.run_folding(s, p)[:2] for s, p in zip(sequences, save_paths)]
+    else:
+        scores = [(r["ptm"], r["plddt"]) for r in runner.fold_sequences(sequences, save_paths)]
+    sync(runner.device)
+    return time.perf_counter() - start, np.array(scores, dtype=float)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    conf = OmegaConf.load(args.config)
+    conf.folding_memory_budget_mb = args.memory_budget_mb
+    conf.folding_max_batch_size = args.max_batch_size
+    runner = EvalRunner(conf)
+
+    sequences = random_sequences(args.n_samples, args.n_seqs_per_sample, args.min_length, args.max_length, args.seed)
+    results = {}
+    check_scores = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        # load the model and warm up before timing
+        runner.fold_sequences(sequences[:1])
+
+        for mode in args.modes:
+            mode_sequences = sequences
+            if mode == "sequential" and args.sequential_samples is not None:
+                mode_sequences = sequences[: args.sequential_samples * args.n_seqs_per_sample]
+            if mode == "batched":
+                runner.batched_folder.stats = dict(n_sequences=0, n_unique=0, n_batches=0, n_oom=0, elapsed=0.0)
+            elapsed, scores = fold(runner, mode_sequences, mode, out_dir)
+            check_scores[mode] = scores[: args.n_check]
+            results[mode] = {
+                "n_sequences": len(mode_sequences),
+                "total_s": elapsed,
+                "sequences_per_s": len(mode_sequences) / elapsed,
+            }
+            if mode == "batched":
+                results[mode].update({k: runner.batched_folder.stats[k] for k in ["n_batches", "n_oom"]})
+            print(
+                f"{mode:<10} {len(mode_sequences):6d} sequences in {elapsed:8.1f} s, "
+                f"{results[mode]['sequences_per_s']:7.2f} sequences/s"
+            )
+
+    if "sequential" in results and "batched" in results:
+        speedup = results["batched"]["sequences_per_s"] / results["sequential"]["sequences_per_s"]
+        n_check = min(len(check_scores["sequential"]), len(check_scores["batched"]))
+        max_diff = np.abs(check_scores["sequential"][:n_check] - check_scores["batched"][:n_check]).max(axis=0)
+        results["speedup"] = speedup
+        results["max_ptm_diff"] = float(max_diff[0])
+        results["max_plddt_diff"] = float(max_diff[1])
+        print(f"batched folding is {speedup:.1f}x faster")
+        print(f"largest difference over {n_check} sequences: pTM {max_diff[0]:.4f}, pLDDT {max_diff[1]:.4f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "device": runner.device, "results": results}, f, indent=2)
@@ -0,0 +1,85 @@
+"""Batched secondary structure and radius of gyration metrics (analysis.structure_metrics) against the per-file
+md.load loop of calc_mdtraj_metrics they replaced.
+
+The PDB files under --pdb_dir are repeated up to --n_structures, as designs of a run share their lengths.
+Batched metrics are timed from PDB files and from in-memory Proteins, compared to the old loop, and the script
+exits with an error if they disagree. Run from the protein directory:
+
+    python -m benchmarks.structure_metrics --pdb_dir example_data --n_structures 1000 --output benchmarks/structure_metrics.json
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import mdtraj as md
+import numpy as np
+
+from analysis.structure_metrics import load_structure, metric_names, structure_metrics
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="structure metrics benchmark")
+    p.add_argument("--pdb_dir", type=str, default="example_data")
+    p.add_argument("--n_structures", type=int, default=1000)
+    p.add_argument("--n_workers", type=int, default=4)
+    p.add_argument("--atol", type=float, default=1e-3, help="largest allowed difference of any metric")
+    p.add_argument("--output", type=str, default=None)
+    return p.parse_args()
+
+
+def mdtraj_metrics(pdb_path):
+    """calc_mdtraj_metrics as it was, one md.load per file."""
+    traj = md.load(pdb_path)
+    pdb_ss = md.compute_dssp(traj, simplified=True)
+    helix, strand = np.mean(pdb_ss == "H"), np.mean(pdb_ss == "E")
+    return {
+        "non_coil_percent": helix + strand,
+        "coil_percent": np.mean(pdb_ss == "C"),
+        "helix_percent": helix,
+        "strand_percent": strand,
+        "radius_of_gyration": md.compute_rg(traj)[0],
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pdb_paths = sorted(str(p) for p in Path(args.pdb_dir).rglob("*.pdb"))
+    if len(pdb_paths) == 0:
+        sys.exit(f"no PDB files under {args.pdb_dir}")
+    paths = [pdb_paths[i % len(pdb_paths)] for i in range(args.n_structures)]
+
+    start = time.perf_counter()
+    expected = [mdtraj_metrics(p) for p in paths]
+    results = {"mdtraj_s": time.perf_counter() - start}
+    print(f"{'md.load loop':<18} {results['mdtraj_s']:8.2f} s")
+
+    start = time.perf_counter()
+    from_files = structure_metrics(paths, n_workers=args.n_workers)
+    results["batched_files_s"] = time.perf_counter() - start
+
+    prots = [load_structure(p) for p in paths]
+    start = time.perf_counter()
+    from_memory = structure_metrics(prots, n_workers=args.n_workers)
+    results["batched_memory_s"] = time.perf_counter() - start
+
+    for mode in ["files", "memory"]:
+        elapsed = results[f"batched_{mode}_s"]
+        results[f"speedup_{mode}"] = results["mdtraj_s"] / elapsed
+        print(f"{'batched ' + mode:<18} {elapsed:8.2f} s, {results[f'speedup_{mode}']:.1f}x faster")
+
+    errors = {
+        name: max(abs(float(e[name]) - b[name]) for e, b in zip(expected, from_files))
+        for name in metric_names
+    }
+    results["max_abs_error"] = errors
+    print("largest differences to md.load: " + ", ".join(f"{k} {v:.2e}" for k, v in errors.items()))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+    if max(errors.values()) > args.atol or from_files != from_memory:
+        print(f"ERROR: batched structure metrics differ from md.load by more than {args.atol}")
+        sys.exit(1)
@@ -0,0 +1,109 @@
+"""Batched torch superimposition (openfold.utils.superimposition.superimpose) against the per-structure Biopython
+SVDSuperimposer loop it replaced.
+
+Structures are random backbones with a random rotation, translation and noise applied, padded to the same length
+with a random number of masked positions. A few are mirrored, so that the reflection correction is exercised.
+The results of both implementations are compared and the script exits with an error if they disagree.
+Run from the protein directory:
+
+    python -m benchmarks.superimposition --n_structures 1000 --n_residues 500 --output benchmarks/superimposition.json
+"""
+import argparse
+import json
+import sys
+import time
+
+import torch
+
+from openfold.utils.superimposition import _superimpose_biopython, superimpose
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="superimposition benchmark")
+    p.add_argument("--n_structures", type=int, default=1000)
+    p.add_argument("--n_residues", type=int, default=500)
+    p.add_argument("--devices", type=str, nargs="+", default=None, help="devices to time the batched implementation on, by default cpu and cuda if available")
+    p.add_argument("--n_repeats", type=int, default=5, help="timed runs of the batched implementation")
+    p.add_argument("--atol", type=float, default=1e-3, help="largest allowed difference in angstroms")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--output", type=str, default=None)
+    return p.parse_args()
+
+
+def random_rotations(n, generator):
+    q, r = torch.linalg.qr(torch.randn(n, 3, 3, generator=generator, dtype=torch.float64))
+    q = q * torch.sign(torch.diagonal(r, dim1=-2, dim2=-1))[:, None, :]
+    # make every rotation proper
+    q[:, :, 2] *= torch.sign(torch.linalg.det(q))[:, None]
+    return q
+
+
+def make_structures(n_structures, n_residues, seed):
+    generator = torch.Generator().manual_seed(seed)
+    # random walk with 3.8 angstrom steps, roughly the spacing of consecutive CA atoms
+    steps = torch.randn(n_structures, n_residues, 3, generator=generator, dtype=torch.float64)
+    reference = torch.cumsum(3.8 * steps / steps.norm(dim=-1, keepdim=True), dim=1)
+
+    coords = reference @ random_rotations(n_structures, generator) + 10 * torch.randn(n_structures, 1, 3, generator=generator, dtype=torch.float64)
+    coords = coords + 0.5 * torch.randn(coords.shape, generator=generator, dtype=torch.float64)
+    # mirrored structures, whose best proper rotation is not the SVD solution
+    coords[::10, :, 0] *= -1
+
+    lengths = torch.randint(n_residues // 2, n_residues + 1, (n_structures,), generator=generator)
+    mask = (torch.arange(n_residues)[None, :] < lengths[:, None]).float()
+    return reference.float(), coords.float(), mask
+
+
+def sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, n_repeats, device):
+    fn()
+    times = []
+    for _ in range(n_repeats):
+        sync(device)
+        start = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    devices = args.devices or (["cpu", "cuda"] if torch.cuda.is_available() else ["cpu"])
+    reference, coords, mask = make_structures(args.n_structures, args.n_residues, args.seed)
+
+    start = time.perf_counter()
+    expected = _superimpose_biopython(reference, coords, mask, return_transform=True)
+    results = {"biopython_s": time.perf_counter() - start}
+    print(f"{'biopython':<14} {results['biopython_s'] * 1000:10.1f} ms")
+
+    # correctness against the Biopython implementation
+    batched = superimpose(reference, coords, mask, return_transform=True)
+    errors = {
+        "superimposed": (batched[0] - expected[0]).abs().max().item(),
+        "rmsd": (batched[1] - expected[1]).abs().max().item(),
+        "rot": (batched[2] - expected[2].to(batched[2].dtype)).abs().max().item(),
+        "tran": (batched[3] - expected[3].to(batched[3].dtype)).abs().max().item(),
+    }
+    results["max_abs_error"] = errors
+    print("largest differences to biopython: " + ", ".join(f"{k} {v:.2e}" for k, v in errors.items()))
+
+    for device in devices:
+        r, c, m = reference.to(device), coords.to(device), mask.to(device)
+        elapsed = time_fn(lambda: superimpose(r, c, m), args.n_repeats, device)
+        results[f"batched_{device}_s"] = elapsed
+        results[f"speedup_{device}"] = results["biopython_s"] / elapsed
+        print(f"{'batched ' + device:<14} {elapsed * 1000:10.1f} ms, {results[f'speedup_{device}']:.1f}x faster")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+    # rotations and translations are reported but not checked, the superimposed coords and RMSDs are what callers use
+    if errors["superimposed"] > args.atol or errors["rmsd"] > args.atol:
+        print(f"ERROR: batched superimposition differs from biopython by more than {args.atol}")
+        sys.exit(1)
@@ -0,0 +1,188 @@
+"""Vectorized reader of the ATOM and HETATM records of PDB files into atom37 features."""
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Union
+
+import numpy as np
+
+from data import residue_constants
+
+# bumped when the parsed features change, so that older sidecar caches are ignored
+CACHE_VERSION = 2
+
+RAW_FEATS = ['atom_positions', 'atom_mask', 'aatype', 'residue_index', 'b_factors']
+
+_atom37_index = {name.encode(): i for i, name in enumerate(residue_constants.atom_types)}
+_restype_index = {
+    res3.encode(): residue_constants.restype_order.get(res1, residue_constants.restype_num)
+    for res3, res1 in residue_constants.restype_3to1.items()
+}
+
+
+def _lookup(values: np.ndarray, table: Dict[bytes, int], default: int) -> np.ndarray:
+    """Maps every entry of a bytes array through table, looking up each distinct value once."""
+    unique, inverse = np.unique(values, return_inverse=True)
+    return np.array([table.get(v, default) for v in unique], dtype=np.int64)[inverse]
+
+
+def read_atom_records(pdb_bytes: bytes) -> np.ndarray:
+    """ATOM and HETATM lines of the first model as an [n_atoms, 80] array of bytes."""
+    lines = []
+    for line in pdb_bytes.splitlines():
+        if line.startswith(b'ENDMDL'):
+            break
+        if line.startswith(b'ATOM  ') or line.startswith(b'HETATM'):
+            lines.append(line)
+    records = np.array(lines, dtype='S80') # pads short lines with null bytes
+    return records.view(np.uint8).reshape(len(lines), 80)
+
+
+def _column(records: np.ndarray, start: int, end: int) -> np.ndarray:
+    """Fixed-width field [start, end) of every record, as a bytes array with surrounding spaces removed."""
+    field = np.ascontiguousarray(records[:, start:end]).view(f'S{end - start}').ravel()
+    return np.char.strip(field)
+
+
+def parse_pdb_chains(pdb_bytes: bytes) -> Dict[str, Dict[str, np.ndarray]]:
+    """Parses PDB file contents into atom37 features per chain, in order of appearance.
+
+    Gives the same features as parse_pdb_feats did with Biopython's PDBParser and process_chain: every residue of a
+    chain is kept, residue types that are not standard are 'X', atoms that are not in atom37 are ignored, and only the
+    first model is read. Where an atom has alternate locations, the one with the highest occupancy is used, the first
+    listed one on ties, as Biopython's DisorderedAtom selects it.
+    """
+    records = read_atom_records(pdb_bytes)
+    if records.shape[0] == 0:
+        return {}
+
+    chain_ids = np.ascontiguousarray(records[:, 21:22]).view('S1').ravel()
+    # a new residue starts wherever the residue name, chain, residue number or insertion code changes
+    residue_keys = np.ascontiguousarray(records[:, 17:27]).view('S10').ravel()
+    residue_start = np.ones(records.shape[0], dtype=bool)
+    residue_start[1:] = residue_keys[1:] != residue_keys[:-1]
+    residue_idx = np.cumsum(residue_start) - 1
+    first_atoms = np.flatnonzero(residue_start)
+
+    atom37_idx = _lookup(_column(records, 12, 16), _atom37_index, -1)
+    aatype = _lookup(_column(records[first_atoms], 17, 20), _restype_index, residue_constants.restype_num)
+    residue_index = _column(records[first_atoms], 22, 26).astype(np.int64)
+    coords = np.stack([_column(records, s, s + 8).astype(np.float64) for s in (30, 38, 46)], axis=-1)
+    b_factors = _column(records, 60, 66)
+    b_factors = np.where(b_factors == b'', b'0', b_factors).astype(np.float64)
+    occupancies = _column(records, 54, 60)
+    occupancies = np.where(occupancies == b'', b'1', occupancies).astype(np.float64)
+
+    # scatter atoms into atom37 slots, keeping the highest occupancy (then the first) of any duplicates
+    n_residues = first_atoms.shape[0]
+    keep = atom37_idx >= 0
+    flat_slots = residue_idx[keep] * residue_constants.atom_type_num + atom37_idx[keep]
+    order = np.lexsort((np.arange(flat_slots.shape[0]), -occupancies[keep], flat_slots))
+    flat_slots, first = np.unique(flat_slots[order], return_index=True)
+    first = order[first]
+    atom_positions = np.zeros((n_residues * residue_constants.atom_type_num, 3))
+    atom_mask = np.zeros(n_residues * residue_constants.atom_type_num)
+    atom_b_factors = np.zeros(n_residues * residue_constants.atom_type_num)
+    atom_positions[flat_slots] = coords[keep][first]
+    atom_mask[flat_slots] = 1.
+    atom_b_factors[flat_slots] = b_factors[keep][first]
+    feats = {
+        'atom_positions': atom_positions.reshape(n_residues, residue_constants.atom_type_num, 3),
+        'atom_mask': atom_mask.reshape(n_residues, residue_constants.atom_type_num),
+        'aatype': aatype,
+        'residue_index': residue_index,
+        'b_factors': atom_b_factors.reshape(n_residues, residue_constants.atom_type_num),
+    }
+
+    residue_chains = chain_ids[first_atoms]
+    _, first_residues = np.unique(residue_chains, return_index=True)
+    chains = {}
+    for chain_bytes in residue_chains[np.sort(first_residues)]:
+        chain_mask = residue_chains == chain_bytes
+        chains[chain_bytes.decode()] = {k: v[chain_mask] for k, v in feats.items()}
+    return chains
+
+
+def _sidecar_path(pdb_path: Path) -> Path:
+    return pdb_path.with_name(pdb_path.name + '.feats.npz')
+
+
+def _load_sidecar(sidecar_path: Path, stat: os.stat_result, pdb_bytes: bytes = None):
+    """Chains stored in a sidecar cache, or None if it is missing or was written for different file contents."""
+    if not sidecar_path.exists():
+        return None
+    try:
+        with np.load(sidecar_path) as cached:
+            if int(cached['version']) != CACHE_VERSION:
+                return None
+            fresh = int(cached['mtime_ns']) == stat.st_mtime_ns and int(cached['size']) == stat.st_size
+            if not fresh and (pdb_bytes is None or str(cached['sha1']) != hashlib.sha1(pdb_bytes).hexdigest()):
+                return None
+            return {
+                str(chain_id): {k: cached[f'{k}_{i}'] for k in RAW_FEATS}
+                for i, chain_id in enumerate(cached['chain_ids'])
+            }
+    except (OSError, KeyError, ValueError) as e:
+        print(f'WARNING: ignoring unreadable feature cache {sidecar_path}: {e}')
+        return None
+
+
+def _save_sidecar(sidecar_path: Path, stat: os.stat_result, pdb_bytes: bytes, chains):
+    arrays = {
+        'version': CACHE_VERSION,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': hashlib.sha1(pdb_bytes).hexdigest(),
+        'chain_ids': np.array(list(chains.keys())),
+    }
+    for i, chain_feats in enumerate(chains.values()):
+        arrays.update({f'{k}_{i}': v for k, v in chain_feats.items()})
+    # written to a temporary file and renamed, so that concurrent readers never see a partial cache
+    tmp_path = sidecar_path.with_name(f'{sidecar_path.name}.{os.getpid()}.tmp.npz')
+    try:
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, sidecar_path)
+    except OSError as e:
+        print(f'WARNING: could not write feature cache {sidecar_path}: {e}')
+
+
+def read_pdb_chains(pdb_path: Union[str, Path], cache: bool = False) -> Dict[str, Dict[str, np.ndarray]]:
+    """Atom37 features per chain of a PDB file, see parse_pdb_chains.
+
+    With cache, the features are also saved to a <pdb_path>.feats.npz sidecar and read from it while the PDB file
+    keeps the same modification time and size, or failing that, the same content hash.
+    """
+    pdb_path = Path(pdb_path)
+    if not cache:
+        return parse_pdb_chains(pdb_path.read_bytes())
+
+    sidecar_path = _sidecar_path(pdb_path)
+    stat = pdb_path.stat()
+    chains = _load_sidecar(sidecar_path, stat)
+    if chains is not None:
+        return chains
+    pdb_bytes = pdb_path.read_bytes()
+    chains = _load_sidecar(sidecar_path, stat, pdb_bytes)
+    if chains is None:
+        chains = parse_pdb_chains(pdb_bytes)
+    _save_sidecar(sidecar_path, stat, pdb_bytes, chains)
+    return chains
+
+
+def read_pdb_dir(
+        pdb_dir: Union[str, Path],
+        pattern: str = '*.pdb',
+        n_workers: int = 8,
+        cache: bool = False,
+    ) -> Dict[str, Dict[str, Dict[str, np.ndarray]]]:
+    """Atom37 features per chain of every PDB file matching pattern under pdb_dir, read in a process pool.
+
+    Returns a dict from the path of each file to its chains.
+    """
+    paths = sorted(str(p) for p in Path(pdb_dir).rglob(pattern))
+    if n_workers <= 1:
+        return {p: read_pdb_chains(p, cache) for p in paths}
+    with ProcessPoolExecutor(n_workers) as pool:
+        chains = pool.map(read_pdb_chains, paths, [cache] * len(paths), chunksize=max(1, len(paths) // (4 * n_workers)))
+        return dict(zip(paths, chains))
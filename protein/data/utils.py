@@ -10,8 +10,7 @@ import torch
 # from torch_scatter import scatter_add, scatter
 from Bio.PDB.Chain import Chain
 from data import protein
-import dataclasses
-from Bio import PDB
+from data import pdb_reader
 
 Rigid = ru.Rigid
 Protein = protein.Protein
@@ -351,6 +350,7 @@ def parse_pdb_feats(
         scale_factor=1.,
         # TODO: Make the default behaviour read all chains.
         chain_id='A',
+        cache=False,
     ):
     """
     Args:
@@ -358,22 +358,17 @@ def parse_pdb_feats(
         pdb_path: path to PDB file to read.
         scale_factor: factor to scale atom positions.
         mean_center: whether to mean center atom positions.
+        cache: keep the parsed atom37 features in a .npz file next to the PDB file,
+            see data.pdb_reader.read_pdb_chains.
     Returns:
         Dict with CHAIN_FEATS features extracted from PDB with specified
         preprocessing.
     """
-    parser = PDB.PDBParser(QUIET=True)
-    structure = parser.get_structure(pdb_name, pdb_path)
-    struct_chains = {
-        chain.id: chain
-        for chain in structure.get_chains()}
+    struct_chains = pdb_reader.read_pdb_chains(pdb_path, cache=cache)
 
     def _process_chain_id(x):
-        chain_prot = process_chain(struct_chains[x], x)
-        chain_dict = dataclasses.asdict(chain_prot)
-
         # Process features
-        feat_dict = {x: chain_dict[x] for x in CHAIN_FEATS}
+        feat_dict = {k: struct_chains[x][k] for k in CHAIN_FEATS}
         return parse_chain_feats(
             feat_dict, scale_factor=scale_factor)
 
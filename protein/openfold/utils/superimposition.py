@@ -46,6 +46,70 @@ def superimpose(reference, coords, mask, return_transform=False):
     """
         Superimposes coordinates onto a reference by minimizing RMSD using SVD.
 
+        The Kabsch algorithm is run for the whole batch at once on the device
+        of the inputs, with the same conventions as Biopython's
+        SVDSuperimposer: superimposed = coords @ rot + tran, and the sign of
+        the last singular vector is flipped when needed so that rot is a
+        proper rotation rather than a reflection. Masked positions are zero
+        in the superimposed coords.
+
+        Args:
+            reference:
+                [*, N, 3] reference tensor
+            coords:
+                [*, N, 3] tensor
+            mask:
+                [*, N] tensor
+        Returns:
+            A tuple of [*, N, 3] superimposed coords and [*] final RMSDs,
+            followed by [B, 3, 3] rotations and [B, 3] translations, with B
+            the flattened batch size, if return_transform is True.
+    """
+    batch_dims = reference.shape[:-2]
+    flat_reference = reference.reshape((-1,) + reference.shape[-2:])
+    flat_coords = coords.reshape((-1,) + reference.shape[-2:])
+    flat_mask = mask.reshape((-1,) + mask.shape[-1:])
+
+    # the 3x3 SVDs are cheap, so the alignment is computed in double precision
+    r = flat_reference.double()
+    c = flat_coords.double()
+    m = (flat_mask > 0.).to(r.dtype)[..., None]
+    n = m.sum(dim=-2).clamp(min=1.)
+
+    r_mean = (r * m).sum(dim=-2) / n
+    c_mean = (c * m).sum(dim=-2) / n
+    r_centered = (r - r_mean[..., None, :]) * m
+    c_centered = (c - c_mean[..., None, :]) * m
+
+    # correlation matrix and its SVD, rot = u @ vt
+    corr = c_centered.transpose(-1, -2) @ r_centered
+    u, _, vt = torch.linalg.svd(corr)
+    sign = 1. - 2. * (torch.linalg.det(u @ vt) < 0).to(vt.dtype)
+    vt = torch.cat([vt[..., :2, :], vt[..., 2:, :] * sign[..., None, None]], dim=-2)
+    rot = u @ vt
+    tran = r_mean - (c_mean[..., None, :] @ rot).squeeze(-2)
+
+    superimposed = (c @ rot + tran[..., None, :]) * m
+    sq_dists = ((superimposed - r) ** 2).sum(dim=-1) * m.squeeze(-1)
+    rmsds = torch.sqrt(sq_dists.sum(dim=-1) / n.squeeze(-1))
+
+    superimposed_reshaped = superimposed.to(coords.dtype).reshape(
+        batch_dims + coords.shape[-2:]
+    )
+    rmsds_reshaped = rmsds.to(coords.dtype).reshape(
+        batch_dims
+    )
+    if return_transform:
+        return superimposed_reshaped, rmsds_reshaped, rot.to(coords.dtype), tran.to(coords.dtype)
+    return superimposed_reshaped, rmsds_reshaped
+
+
+def _superimpose_biopython(reference, coords, mask, return_transform=False):
+    """
+        Reference implementation of superimpose, which superimposes one
+        structure at a time with Biopython's SVDSuperimposer. Kept to check
+        the batched implementation against (see benchmarks/superimposition.py).
+
         Args:
             reference:
                 [*, N, 3] reference tensor